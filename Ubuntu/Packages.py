@@ -1,16 +1,56 @@
+import argparse
+import functools
+import json
 import os
+import re
 import subprocess
+import sys
 import time
 
-def run_command(command):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import aptrepo, catalog, debfile, depgraph, dpkg, executor, journal, manifest, state, target, trace
+
+# 'bar' draws progress bars, 'silent' suppresses them (default when stdout is not a terminal)
+PROGRESS_MODE = os.environ.get('SETUP_PROGRESS', 'bar' if sys.stdout.isatty() else 'silent')
+
+# apt update is skipped while the package lists are younger than this many seconds
+# and the sources files are unchanged since the last update. Paths are on the target
+# system; see common/target.py for provisioning an offline root filesystem.
+APT_LISTS_TTL = int(os.environ.get('SETUP_APT_TTL', 3600))
+APT_LISTS_DIR = '/var/lib/apt/lists'
+APT_SOURCES = ['/etc/apt/sources.list', '/etc/apt/sources.list.d']
+CACHE_DIR = state.CACHE_DIR
+APT_UPDATE_STAMP = os.path.join(CACHE_DIR, 'apt-update.stamp')
+
+DEB_INDEX = os.path.join(CACHE_DIR, 'deb-index.json')
+LOCAL_REPO_DIR = os.path.join(CACHE_DIR, 'local-repo')
+
+# Package categories offered in the menu and in manifests: {category: [package names]}
+CATEGORIES_FILE = os.environ.get('SETUP_CATEGORIES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'categories.json'))
+
+def load_categories(path):
     try:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            return (False, stderr.strip())
-        return (True, stdout.strip())
-    except subprocess.CalledProcessError as e:
-        return (False, str(e))
+        with open(path) as categories_file:
+            categories = json.load(categories_file)
+        if not isinstance(categories, dict) or not all(
+                isinstance(names, list) and all(isinstance(n, str) for n in names) for names in categories.values()):
+            raise ValueError("expected an object mapping each category to a list of package names")
+    except (OSError, ValueError) as e:
+        print(f"Could not read package categories from {path}: {e}")
+        return {}
+    return categories
+
+PACKAGE_CATEGORIES = load_categories(CATEGORIES_FILE)
+
+APT_STATUS_RE = re.compile(r'^(dlstatus|pmstatus):.*?:(\d+(?:\.\d+)?):')
+APT_MISSING_RE = re.compile(r'^E: Unable to locate package (\S+)$', re.MULTILINE)
+
+def run_command(command, lock=None):
+    result = executor.run_sync(command, lock=lock)
+    if result.returncode != 0:
+        return (False, result.stderr.strip())
+    return (True, result.stdout.strip())
 
 def print_progress_bar(progress, description):
     bar_length = 20
@@ -18,147 +58,468 @@ def print_progress_bar(progress, description):
     text = f"\r{description} [{'■' * block + '□' * (bar_length - block)}] {progress}%"
     print(text, end='', flush=True)
 
-def simulate_progress(description):
-    stages = [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
-    for progress in stages:
-        print_progress_bar(progress, description)
-        time.sleep(0.5)
-    print(f"\n")
-
-def install_packages(package_list):
-    run_command(['sudo', 'apt', 'update'])
-    run_command(['sudo', 'apt', 'upgrade', '-y'])
-
-    for package in package_list:
-        simulate_progress(f"Installing {package}")
-        run_command(['sudo', 'apt', 'install', '-y', package])
-
-def uninstall_packages(package_list):
-    for package in package_list:
-        simulate_progress(f"Uninstalling {package}")
-        run_command(['sudo', 'apt', 'remove', '-y', package])
+def apt_command(*args):
+    # apt reports download and dpkg progress as machine-readable lines on stdout, and waits
+    # for a dpkg lock held by another process (unattended-upgrades, ...) instead of failing
+    return (['sudo', 'apt', '-o', 'APT::Status-Fd=1', '-o', 'Dpkg::Use-Pty=0',
+             '-o', f"DPkg::Lock::Timeout={executor.LOCK_TIMEOUT}"] + target.apt_options() + list(args))
+
+# root -> installed packages and their dependencies of that target, built on first use in
+# a session and brought up to date from the dpkg status after every transaction
+_dependency_graphs = {}
+
+def status_path():
+    return target.path(dpkg.DPKG_STATUS)
+
+@functools.lru_cache(maxsize=None)
+def autoremove_settings(root):
+    # (keep recommended, keep suggested, never-autoremove patterns) as apt is configured on
+    # the target at root (target.ROOT); apt's defaults when apt-config can't tell
+    settings = {'APT::AutoRemove::RecommendsImportant': 'true', 'APT::AutoRemove::SuggestsImportant': 'true'}
+    never = []
+    result = executor.run_sync(['apt-config', 'dump'] + target.apt_options())
+    for line in result.stdout.splitlines() if result.returncode == 0 else []:
+        key, _, value = line.partition(' ')
+        value = value.strip().rstrip(';').strip('"')
+        if key == 'APT::NeverAutoRemove::' and value:
+            never.append(value)
+        elif key in settings:
+            settings[key] = value
+    return (settings['APT::AutoRemove::RecommendsImportant'] == 'true',
+            settings['APT::AutoRemove::SuggestsImportant'] == 'true', tuple(never))
+
+def dependency_graph():
+    graph = _dependency_graphs.get(target.ROOT)
+    if graph is None:
+        graph = _dependency_graphs[target.ROOT] = depgraph.DependencyGraph(*autoremove_settings(target.ROOT))
+    graph.update(dpkg.load_status(status_path()), dpkg.auto_installed(target.path(dpkg.EXTENDED_STATES)))
+    return graph
+
+def update_stamp():
+    if target.is_host():
+        return APT_UPDATE_STAMP
+    return os.path.join(CACHE_DIR, f"apt-update-{state.fingerprint(target.ROOT)[:16]}.stamp")
+
+def catalog_dir():
+    # The catalog of the package lists, per target like the update stamp
+    if target.is_host():
+        return os.path.join(CACHE_DIR, 'catalog')
+    return os.path.join(CACHE_DIR, f"catalog-{state.fingerprint(target.ROOT)[:16]}")
+
+def package_catalog():
+    # Everything the package lists offer; rebuilt only for the lists an apt update changed
+    package_index, errors = catalog.load_catalog(target.path(APT_LISTS_DIR), catalog_dir())
+    for list_name, reason in errors:
+        print(f"Skipping package list {list_name}: {reason}")
+    return package_index
+
+def status_progress(line):
+    # Percent done for an APT::Status-Fd line, None for regular output. apt reports dpkg's
+    # unpack and configure steps as pmstatus lines, so dpkg's own status stream isn't needed.
+    match = APT_STATUS_RE.match(line)
+    if not match:
+        return None
+    percent = float(match.group(2))
+    # Downloads fill the first third of the bar, unpacking and configuring the rest
+    if match.group(1) == 'dlstatus':
+        return percent * 0.3
+    return 30 + percent * 0.7
+
+def run_with_progress(command, description):
+    show_bar = PROGRESS_MODE == 'bar'
+    output_lines = []
+    shown = {'progress': 0}
+
+    def on_line(line):
+        percent = status_progress(line)
+        if percent is None:
+            output_lines.append(line)
+        elif show_bar and int(percent) > shown['progress']:
+            shown['progress'] = int(percent)
+            print_progress_bar(shown['progress'], description)
+
+    if show_bar:
+        print_progress_bar(0, description)
+    # Everything started through here touches the dpkg database
+    result = executor.run_sync(command, lock=executor.DPKG_LOCK, on_line=on_line)
+    if show_bar:
+        if result.returncode == 0 and shown['progress'] < 100:
+            print_progress_bar(100, description)
+        print()
+
+    if result.returncode != 0:
+        return (False, result.stderr.strip())
+    return (True, ''.join(output_lines).strip())
+
+def sources_signature():
+    entries = []
+    for path in map(target.path, APT_SOURCES):
+        if os.path.isdir(path):
+            paths = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+        else:
+            paths = [path]
+        for source in paths:
+            try:
+                st = os.stat(source)
+            except OSError:
+                continue
+            entries.append(f"{source}:{st.st_mtime_ns}:{st.st_size}")
+    return '\n'.join(entries)
 
-    run_command(['sudo', 'apt', 'autoremove', '-y'])
+def package_lists_fresh(ttl=APT_LISTS_TTL):
+    try:
+        with open(update_stamp()) as stamp:
+            recorded_sources = stamp.read()
+        last_update = os.path.getmtime(update_stamp())
+    except OSError:
+        return False
 
-def install_custom_packages(packages):
-    run_command(['sudo', 'apt', 'update'])
-    run_command(['sudo', 'apt', 'upgrade', '-y'])
+    if recorded_sources != sources_signature():
+        return False
+    return time.time() - last_update < ttl
 
-    success_list = []
-    failure_list = []
+@trace.step
+def update_package_lists(force=False):
+    if not force and package_lists_fresh():
+        return True
 
-    for package in packages:
-        simulate_progress(f"Installing {package}")
-        success, message = run_command(['sudo', 'apt', 'install', '-y', package])
-        if success:
-            print(f"Installing {package} completed.\n")
-            success_list.append(package)
-        else:
-            print(f"Installing {package} failed.\n")
-            if "Unable to locate package" in message:
-                reason = "Package not found"
-            elif "already installed" in message:
-                reason = "Package already installed"
-            else:
-                reason = message
-            failure_list.append((package, reason))
+    success, message = run_with_progress(apt_command('update'), "Updating package lists")
+    if success:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(update_stamp(), 'w') as stamp:
+            stamp.write(sources_signature())
+    else:
+        print(f"Updating package lists failed: {message}")
+    return success
+
+@trace.step
+def upgrade_packages():
+    update_package_lists()
+    journal.intent('packages:upgrade')
+    success, message = run_with_progress(apt_command('upgrade', '-y'), "Upgrading installed packages")
+    if success:
+        journal.done('packages:upgrade')
+        print("Upgrading installed packages completed.")
+    else:
+        journal.failed('packages:upgrade', message)
+        print(f"Upgrading installed packages failed: {message}")
+
+# apt errors that fail a transaction whatever packages are in it
+BATCH_FAILURES = [
+    (("Could not get lock", "Unable to acquire the dpkg frontend lock"), "Package database is locked by another process"),
+    (("Temporary failure resolving", "Could not resolve", "Could not connect to", "Unable to connect to"),
+     "Package archive unreachable"),
+    (("No space left on device", "You don't have enough free space"), "Not enough disk space"),
+]
+
+def batch_failure(message):
+    # The reason apt gave when it is not about any one package, else None
+    for patterns, reason in BATCH_FAILURES:
+        if any(pattern in message for pattern in patterns):
+            return reason
+    return None
+
+def classify_failure(package, message):
+    dpkg_state = dpkg.state_of(package, status_path())
+    if dpkg_state == 'installed':
+        return "Package already installed"
+    elif dpkg_state in ('half-installed', 'unpacked', 'half-configured', 'triggers-awaited', 'triggers-pending'):
+        return f"Package left {dpkg_state}, run 'sudo dpkg --configure -a'"
+    elif "Unable to locate package" in message:
+        return "Package not found"
+    elif batch_failure(message):
+        return batch_failure(message)
+    elif "unmet dependencies" in message:
+        return "Unmet dependencies"
+    return message
+
+def split_installed(packages):
+    # Packages dpkg already has installed never need an apt run
+    installed = [p for p in packages if dpkg.is_installed(p, status_path())]
+    return [p for p in packages if p not in installed], installed
+
+@trace.step
+def install_batch(packages, apt_options=()):
+    # Install the whole list in one apt transaction. If apt rejects it because of some of
+    # the packages, split the list in half and retry each half until they are isolated.
+    # Entries may pin a version as name=version.
+    if not packages:
+        return [], []
+
+    command = apt_command(*apt_options, 'install', '-y', *packages)
+    success, message = run_with_progress(command, f"Installing {', '.join(packages)}")
+    if success:
+        return list(packages), []
+    if len(packages) == 1:
+        return [], [(packages[0], classify_failure(packages[0].split('=')[0], message))]
+    # A held lock, an unreachable archive or a full disk fails every half just the same
+    reason = batch_failure(message)
+    if reason:
+        return [], [(p, reason) for p in packages]
+
+    # Packages apt could not find at all are known failures, no need to bisect for them.
+    # apt names them without any =version pin.
+    unknown = set(APT_MISSING_RE.findall(message))
+    missing = [p for p in packages if p in unknown or p.split('=')[0] in unknown]
+    if missing:
+        remaining = [p for p in packages if p not in missing]
+        success_list, failure_list = install_batch(remaining, apt_options)
+        return success_list, [(p, "Package not found") for p in missing] + failure_list
+
+    middle = len(packages) // 2
+    first_success, first_failure = install_batch(packages[:middle], apt_options)
+    second_success, second_failure = install_batch(packages[middle:], apt_options)
+    return first_success + second_success, first_failure + second_failure
+
+def print_summary(title, success_heading, failure_heading, success_list, failure_list, skipped_list=None):
+    print(f"\n{title}:")
+    if skipped_list:
+        print("Already installed:")
+        for idx, package in enumerate(skipped_list, 1):
+            print(f"{idx}. {package}")
 
-    print("\nCustom Package Installation Summary:")
     if success_list:
-        print("Successfully installed packages:")
+        print(f"{success_heading}:")
         for idx, package in enumerate(success_list, 1):
             print(f"{idx}. {package}")
 
     if failure_list:
-        print("\nUnsuccessful installations:")
+        print(f"\n{failure_heading}:")
         for idx, (package, reason) in enumerate(failure_list, 1):
             print(f"{idx}. {package}: {reason}")
 
-def install_deb_packages(deb_files):
-    success_list = []
-    failure_list = []
+def journaled_install(packages):
+    # install_batch, journaled so an interrupted run can be picked up with 'setup.py resume'
+    with journal.batch({'packages': packages}, target.ROOT):
+        for package in packages:
+            journal.intent(f"packages:install:{package}")
+        success_list, failure_list = install_batch(packages)
+        for package in success_list:
+            journal.done(f"packages:install:{package}")
+        for package, reason in failure_list:
+            journal.failed(f"packages:install:{package}", reason)
+    return success_list, failure_list
 
-    for deb_file in deb_files:
-        deb_filename = os.path.basename(deb_file)
-        simulate_progress(f"Installing {deb_filename}")
-        success, message = run_command(['sudo', 'dpkg', '-i', deb_file])
-        if success:
-            print(f"Installing {deb_filename} completed.\n")
-            success_list.append(deb_filename)
-        else:
-            dependencies = extract_dependencies(message)
-            if dependencies:
-                print(f"Missing dependencies for {deb_filename}: {', '.join(dependencies)}")
-                choice = input("Do you want to install these dependencies? (y/n): ")
-                if choice.lower() == 'y':
-                    install_dependencies(dependencies)
-                    # Retry the installation after dependencies are resolved
-                    simulate_progress(f"Reinstalling {deb_filename}")
-                    success, message = run_command(['sudo', 'dpkg', '-i', deb_file])
-                    if success:
-                        print(f"Reinstalling {deb_filename} completed.\n")
-                        success_list.append(deb_filename)
-                    else:
-                        print(f"Reinstalling {deb_filename} failed.\n")
-                        failure_list.append((deb_filename, "Failed after dependency installation"))
-                else:
-                    print("User opted not to install dependencies.")
-                    failure_list.append((deb_filename, "Dependency installation declined by user"))
-            else:
-                failure_list.append((deb_filename, "Dependency issues, but unable to parse dependencies."))
+def install_packages(package_list):
+    package_list, skipped_list = split_installed(package_list)
+    if package_list:
+        update_package_lists()
+
+    success_list, failure_list = journaled_install(package_list)
+
+    print_summary("Package Installation Summary", "Successfully installed packages",
+                  "Unsuccessful installations", success_list, failure_list, skipped_list)
+    return failure_list
+
+def print_removal_preview(graph, removed, autoremoved):
+    requested = [name for name, cause in removed.items() if cause is None]
+    print(f"\nRemoving {', '.join(requested)}")
+    dependents = [name for name, cause in removed.items() if cause is not None]
+    if dependents:
+        print("Also removed, as they depend on it:")
+        for name in sorted(dependents):
+            print(f"  {name} (needs {removed[name]}, {format_size(graph.size_of([name]))})")
+    if autoremoved:
+        print("No longer needed, removed as well:")
+        for name in autoremoved:
+            print(f"  {name} ({format_size(graph.size_of([name]))})")
+    essential = [name for name in removed if graph.packages[name].essential]
+    if essential:
+        print(f"\033[91mWarning: {', '.join(essential)} {'is' if len(essential) == 1 else 'are'} essential to the system.\033[0m")
+    count = len(removed) + len(autoremoved)
+    print(f"{count} package{'s' if count != 1 else ''} to remove, "
+          f"{format_size(graph.size_of(list(removed) + autoremoved))} of disk space freed")
+
+@trace.step
+def uninstall_packages(package_list, assume_yes=False):
+    # Removes the packages, everything depending on them and what is no longer needed in
+    # one apt transaction, after showing what that takes along. Returns the removed names.
+    graph = dependency_graph()
+    packages = []
+    for package in package_list:
+        if package.split(':')[0] not in graph.packages:
+            print(f"{package} is not installed, skipping.")
+            continue
+        packages.append(package.split(':')[0])
+    if not packages:
+        return []
+
+    removed, autoremoved = graph.removal(packages)
+    print_removal_preview(graph, removed, autoremoved)
+    if not assume_yes and input("Do you want to continue? (y/n): ").lower() != 'y':
+        print("Nothing was removed.")
+        return []
+
+    before = set(graph.packages)
+    success, message = run_with_progress(apt_command('remove', '--autoremove', '-y', *packages),
+                                         f"Uninstalling {', '.join(packages)}")
+    graph = dependency_graph()
+    gone = sorted(before - set(graph.packages))
+    if not success:
+        print(f"Uninstalling failed: {message}")
+    if gone:
+        print(f"Removed {len(gone)} package{'s' if len(gone) != 1 else ''}: {', '.join(gone)}")
+    return gone
 
-    print("\nDEB Package Installation Summary:")
-    if success_list:
-        print("Successfully installed DEB packages:")
-        for idx, package in enumerate(success_list, 1):
-            print(f"{idx}. {package}")
+def install_custom_packages(packages):
+    packages, skipped_list = split_installed(packages)
+    if packages:
+        update_package_lists()
 
-    if failure_list:
-        print("\nUnsuccessful DEB installations:")
-        for idx, (package, reason) in enumerate(failure_list, 1):
-            print(f"{idx}. {package}: {reason}")
+    success_list, failure_list = journaled_install(packages)
+    for package in success_list:
+        print(f"Installing {package} completed.")
+    for package, reason in failure_list:
+        print(f"Installing {package} failed.")
 
-def extract_dependencies(dpkg_message):
-    # This function needs to parse the dpkg error message to find missing dependencies
-    lines = dpkg_message.split('\n')
-    dependencies = []
-    for line in lines:
-        if 'depends on' in line:
-            parts = line.split('depends on')[1].split(';')[0].strip().split(',')
-            for part in parts:
-                dep = part.strip().split()[0]  # Only take the package name
-                if dep not in dependencies:
-                    dependencies.append(dep)
-    return dependencies
-
-def install_dependencies(dependencies):
-    for dep in dependencies:
-        success, message = run_command(['sudo', 'apt', 'install', '-y', dep])
-        if success:
-            print(f"Installing dependency {dep} completed.\n")
+    print_summary("Custom Package Installation Summary", "Successfully installed packages",
+                  "Unsuccessful installations", success_list, failure_list, skipped_list)
+
+def read_deb_files(deb_files):
+    debs = []
+    failure_list = []
+    for deb_file in deb_files:
+        try:
+            fields = dict(debfile.index_entry(deb_file)['control'])
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            failure_list.append((os.path.basename(deb_file), f"Unable to read package metadata: {e}"))
+            continue
+        fields['Filename'] = deb_file
+        debs.append(fields)
+    return debs, failure_list
+
+@trace.step
+def publish_local_repository(entries):
+    # Expose the .debs as a file: apt source so one apt transaction can install them
+    # together with their dependencies from the local files and the archive alike
+    aptrepo.write_repository(LOCAL_REPO_DIR, entries)
+    update_options, install_options = aptrepo.register_source(LOCAL_REPO_DIR, target.path('/etc/apt/sources.list.d'))
+    success, message = run_with_progress(apt_command(*update_options, 'update'), "Indexing local DEB repository")
+    if not success:
+        print(f"Indexing local DEB repository failed: {message}")
+        return None
+    return install_options
+
+def journal_debs(deb_files, failure_list):
+    # Outcome of each .deb in the journal, keyed by its absolute path
+    reasons = dict(failure_list)
+    for deb_file in deb_files:
+        op = f"packages:deb:{os.path.abspath(deb_file)}"
+        if os.path.basename(deb_file) in reasons:
+            journal.failed(op, reasons[os.path.basename(deb_file)])
         else:
-            print(f"Installing dependency {dep} failed.\n")
+            journal.done(op)
+
+def install_deb_packages(deb_files, assume_yes=False, repo_entries=()):
+    # Journaled like install_packages
+    with journal.batch({'debs': [os.path.abspath(d) for d in deb_files]}, target.ROOT):
+        for deb_file in deb_files:
+            journal.intent(f"packages:deb:{os.path.abspath(deb_file)}")
+        failure_list = install_deb_files(deb_files, assume_yes, repo_entries)
+        journal_debs(deb_files, failure_list)
+    return failure_list
+
+@trace.step
+def install_deb_files(deb_files, assume_yes=False, repo_entries=()):
+    debs, failure_list = read_deb_files(deb_files)
+    success_list = []
+
+    skipped_list = [os.path.basename(d['Filename']) for d in debs
+                    if dpkg.installed_version(d['Package'], status_path()) == d.get('Version')]
+    debs = [d for d in debs if os.path.basename(d['Filename']) not in skipped_list]
+    if not debs:
+        print_summary("DEB Package Installation Summary", "Successfully installed DEB packages",
+                      "Unsuccessful DEB installations", success_list, failure_list, skipped_list)
+        return failure_list
+
+    # Other packages in the local repository can satisfy dependencies too
+    entries = {entry['path']: entry for entry in repo_entries}
+    for deb in debs:
+        entries.setdefault(deb['Filename'], debfile.index_entry(deb['Filename']))
+
+    # Show what the selection pulls in from the archive before anything runs
+    available = dict(dpkg.installed_packages(status_path()))
+    available.update({entry['control']['Package']: entry['control'] for entry in entries.values()})
+    provides = dpkg.provided_by(available)
+    missing = {}
+    for deb in debs:
+        missing[deb['Package']] = [group[0][0] for group in dpkg.unsatisfied_relations(deb, available, provides)]
+    dependencies = list(dict.fromkeys(dep for deps in missing.values() for dep in deps))
+
+    if dependencies:
+        print(f"Missing dependencies: {', '.join(dependencies)}")
+        choice = 'y' if assume_yes else input("Do you want to install these dependencies? (y/n): ")
+        if choice.lower() != 'y':
+            print("User opted not to install dependencies.")
+            for deb in [d for d in debs if missing[d['Package']]]:
+                failure_list.append((os.path.basename(deb['Filename']), "Dependency installation declined by user"))
+                debs.remove(deb)
+
+    if debs:
+        update_package_lists()
+        install_options = publish_local_repository(list(entries.values()))
+        if install_options is None:
+            failure_list += [(os.path.basename(d['Filename']), "Local repository could not be indexed") for d in debs]
+            debs = []
+        specs = {f"{d['Package']}={d['Version']}": os.path.basename(d['Filename']) for d in debs}
+        installed, failed = install_batch(list(specs), install_options or ())
+        for spec in installed:
+            print(f"Installing {specs[spec]} completed.")
+            success_list.append(specs[spec])
+        for spec, reason in failed:
+            print(f"Installing {specs[spec]} failed.")
+            failure_list.append((specs[spec], reason))
+
+    print_summary("DEB Package Installation Summary", "Successfully installed DEB packages",
+                  "Unsuccessful DEB installations", success_list, failure_list, skipped_list)
+    return failure_list
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
 
 def show_deb_package_menu():
     deb_dir = os.path.join(os.getcwd(), "DEB")
+    sort_by = 'name'
+    name_filter = ''
     while True:
         if not os.path.exists(deb_dir):
             os.makedirs(deb_dir)
 
-        deb_files = [f for f in os.listdir(deb_dir) if f.endswith('.deb')]
-        deb_files.sort()
+        entries, errors = debfile.scan_directory(deb_dir, DEB_INDEX)
+        newest, superseded = debfile.newest_versions(entries)
+        offered = list(newest)
+        if name_filter:
+            offered = [e for e in offered if name_filter in e['control'].get('Package', '')
+                       or name_filter in e['control'].get('Version', '')]
+        if sort_by == 'version':
+            offered.sort(key=functools.cmp_to_key(
+                lambda a, b: dpkg.compare_versions(b['control'].get('Version', '0'), a['control'].get('Version', '0'))))
+        else:
+            offered.sort(key=lambda e: e['control'].get('Package', ''))
+        deb_files = [e['path'] for e in offered]
 
-        if not deb_files:
+        if not deb_files and not name_filter:
             print("\033[91mPlease add DEB files in the DEB directory, then press 'Refresh'.\033[0m")
             print("1. Refresh")
             print("2. Back")
         else:
             print("\nAvailable DEB packages:")
-            for idx, deb_file in enumerate(deb_files, start=1):
-                print(f"{idx}. {deb_file}")
+            for idx, entry in enumerate(offered, start=1):
+                control = entry['control']
+                print(f"{idx}. {control.get('Package')} {control.get('Version')} "
+                      f"({control.get('Architecture')}, {format_size(entry['size'])})")
+            for entry in superseded:
+                print(f"   Skipping {os.path.basename(entry['path'])}: a newer version is available")
+            for filename, reason in errors:
+                print(f"   Skipping {filename}: {reason}")
 
             print(f"{len(deb_files) + 1}. Install All")
             print(f"{len(deb_files) + 2}. Back")
+            print(f"S. Sort by {'version' if sort_by == 'name' else 'name'}")
+            print(f"F. Filter by name or version{f' (current: {name_filter})' if name_filter else ''}")
             print("\nNote: To install multiple DEB packages, enter their numbers separated by commas (e.g., 1,2)")
 
         choice = input("Enter your choice: ")
@@ -166,17 +527,21 @@ def show_deb_package_menu():
         if choice.isdigit():
             choice = int(choice)
             if 1 <= choice <= len(deb_files):
-                deb_files_full_path = [os.path.join(deb_dir, deb_files[choice - 1])]
-                install_deb_packages(deb_files_full_path)
+                install_deb_packages([deb_files[choice - 1]], repo_entries=newest)
             elif choice == len(deb_files) + 1:
-                install_deb_packages([os.path.join(deb_dir, f) for f in deb_files])
+                if deb_files:
+                    install_deb_packages(deb_files, repo_entries=newest)
             elif choice == len(deb_files) + 2:
                 return
+        elif choice.lower() == 's':
+            sort_by = 'version' if sort_by == 'name' else 'name'
+        elif choice.lower() == 'f':
+            name_filter = input("Show packages whose name or version contains (empty to clear): ").strip()
         elif ',' in choice:
             try:
                 indices = [int(i) - 1 for i in choice.split(',')]
-                selected_deb_files = [os.path.join(deb_dir, deb_files[i]) for i in indices if 0 <= i < len(deb_files)]
-                install_deb_packages(selected_deb_files)
+                selected_deb_files = [deb_files[i] for i in indices if 0 <= i < len(deb_files)]
+                install_deb_packages(selected_deb_files, repo_entries=newest)
             except ValueError:
                 print("Invalid input. Please enter numbers separated by commas.")
         else:
@@ -203,9 +568,24 @@ def install_termcolor():
     else:
         return False
 
+def describe_package(package, package_index):
+    # "installed", "missing: 1.2-1, 3.4 MB" or "not in the package lists"
+    if dpkg.is_installed(package, status_path()):
+        return "installed"
+    info = package_index.get(package)
+    if info:
+        return f"missing: {info['version']}, {format_size(info['size'])}"
+    # Without any package lists nothing can be said about availability
+    return "not in the package lists" if len(package_index) else "missing"
+
 def show_package_menu(category, packages):
     while True:
-        print(f"\n{category} Packages: {', '.join(packages)}")
+        # The status index is re-read only when dpkg has changed it, and the catalog only
+        # when an apt update changed the lists, so this stays cheap between loops
+        package_index = package_catalog()
+        states = [describe_package(p, package_index) for p in packages]
+        print(f"\n{category} Packages: {', '.join(f'{p} [{state}]' for p, state in zip(packages, states))}")
+        print(f"{states.count('installed')} of {len(packages)} installed")
         print("1. Install All")
         print("2. Uninstall All")
         print("3. Back")
@@ -221,40 +601,168 @@ def show_package_menu(category, packages):
         else:
             print("Invalid choice!")
 
+def show_search(package_index, term):
+    if not term:
+        return
+    matches = package_index.search(term)
+    if not matches:
+        print(f"No packages match '{term}'.")
+        return
+    for name in matches:
+        info = package_index.get(name)
+        installed = " [installed]" if dpkg.is_installed(name, status_path()) else ""
+        print(f"  {name} {info['version']} ({format_size(info['size'])}, {info['section'] or 'no section'}){installed}")
+
+def is_deb_path(name):
+    # apt install takes a local .deb by its path, e.g. ./tool_1.0_amd64.deb
+    return name.endswith('.deb') and os.sep in name
+
+def choose_custom_packages():
+    # Asks for package names and checks them against the catalog, so typos show up before
+    # anything runs. Virtual names one package provides and paths of local .debs are taken
+    # too. Returns the names to install, an empty list when there is nothing to do.
+    package_index = package_catalog()
+    while True:
+        text = input("Enter the packages you want to install (space-separated), or ?term to search: ").strip()
+        if not text.startswith('?'):
+            break
+        show_search(package_index, text[1:].strip())
+    # Local .debs by absolute path, so the journal still finds them when resumed elsewhere
+    names = list(dict.fromkeys(os.path.abspath(n) if is_deb_path(n) else n for n in text.split()))
+    if not names or not len(package_index):
+        # No package lists downloaded yet, apt checks the names after updating them
+        return names
+
+    found = []
+    download = 0
+    debs, unreadable = read_deb_files([n for n in names if is_deb_path(n)])
+    debs = {deb['Filename']: deb for deb in debs}
+    for name in names:
+        if is_deb_path(name):
+            deb = debs.get(name)
+            if deb is None:
+                print(f"  {name}: {dict(unreadable)[os.path.basename(name)]}")
+                continue
+            found.append(name)
+            installed = " [installed]" if dpkg.installed_version(deb['Package'], status_path()) == deb.get('Version') else ""
+            print(f"  {name}: local {deb['Package']} {deb.get('Version')}, "
+                  f"{format_size(int(deb.get('Installed-Size') or 0) * 1024)} installed{installed}")
+            continue
+        info = package_index.get(name)
+        provider = None
+        if info is None:
+            providers = package_index.providers(name)
+            if len(providers) > 1:
+                # apt won't choose between several providers either
+                print(f"  {name}: virtual package provided by {', '.join(providers)}, name one of them")
+                continue
+            if providers:
+                provider = providers[0]
+                info = package_index.get(provider)
+        if info is None:
+            suggestions = package_index.suggest(name)
+            hint = f", did you mean {', '.join(suggestions)}?" if suggestions else ""
+            print(f"  {name}: not found in the package lists{hint}")
+            continue
+        found.append(name)
+        is_installed = dpkg.is_installed(provider or name, status_path())
+        if not is_installed:
+            download += info['size']
+        via = f" (provided by {provider})" if provider else ""
+        print(f"  {name}{via} {info['version']}: {format_size(info['size'])} download, "
+              f"{format_size(info['installed_size'])} installed{' [installed]' if is_installed else ''}")
+    if not found:
+        return []
+    choice = input(f"Install {len(found)} package(s), {format_size(download)} to download? (y/n): ")
+    return found if choice.lower() == 'y' else []
+
+def manifest_packages(section):
+    packages = []
+    for category in section.get('categories', []):
+        if category not in PACKAGE_CATEGORIES:
+            raise ValueError(f"Unknown package category: {category}")
+        packages += PACKAGE_CATEGORIES[category]
+    packages += section.get('install', [])
+    return list(dict.fromkeys(packages))
+
+def plan_manifest(section):
+    # Works out and prints what the [packages] section of a setup.py manifest would change.
+    # Returns the plan apply_manifest carries out, see common/manifest.py.
+    packages = manifest_packages(section)
+    deb_files = section.get('debs', [])
+    desired = {'packages': packages, 'debs': [[d, state.file_stamp(d)] for d in deb_files],
+               'upgrade': bool(section.get('upgrade'))}
+    watched = [status_path()]
+
+    print("\nPackages:")
+    if manifest.is_converged('packages', desired, watched):
+        return {'pending': 0}
+
+    missing, installed = split_installed(packages)
+    debs, unreadable = read_deb_files(deb_files)
+    pending_debs = [d['Filename'] for d in debs if dpkg.installed_version(d['Package'], status_path()) != d.get('Version')]
+    pending_debs += [d for d in deb_files if os.path.basename(d) in dict(unreadable)]
+    if section.get('upgrade'):
+        print("  upgrade installed packages")
+    for package in missing:
+        print(f"  install {package}")
+    for package in installed:
+        print(f"  keep {package} (already installed)")
+    for deb_file in deb_files:
+        print(f"  {'install' if deb_file in pending_debs else 'keep'} {deb_file}")
+    pending = len(missing) + len(pending_debs) + bool(section.get('upgrade'))
+    return manifest.settle_plan('packages', {'pending': pending, 'desired': desired, 'watched': watched,
+                                             'missing': missing, 'debs': pending_debs})
+
+def apply_manifest(section, dry_run=False, scheduler=None, plan=None):
+    # Installs the [packages] section of a setup.py manifest without prompting, following
+    # plan when setup.py already made and printed one
+    plan = plan if plan is not None else plan_manifest(section)
+    missing, pending_debs = plan.get('missing', []), plan.get('debs', [])
+    operations = ['packages:upgrade'] if section.get('upgrade') else []
+    operations += [f"packages:install:{package}" for package in missing]
+    operations += [f"packages:deb:{os.path.abspath(deb_file)}" for deb_file in pending_debs]
+
+    def add_jobs(scheduler, failures):
+        # Everything that runs apt queues up on the dpkg lock; apt update goes first
+        update = scheduler.add('packages:update', update_package_lists, lock='dpkg')
+        jobs = [update]
+        if section.get('upgrade'):
+            jobs.append(scheduler.add('packages:upgrade', upgrade_packages, deps=[update], lock='dpkg'))
+        if missing:
+            jobs.append(scheduler.add('packages:install', lambda: failures.extend(install_packages(missing)),
+                                      deps=[update], lock='dpkg'))
+        if pending_debs:
+            jobs.append(scheduler.add('packages:debs', lambda: failures.extend(install_deb_packages(pending_debs, assume_yes=True)),
+                                      deps=[update], lock='dpkg'))
+        return jobs
+    return manifest.apply_plan('packages', plan, operations, add_jobs, dry_run, scheduler)
+
 def main():
+    categories = list(PACKAGE_CATEGORIES)
+    extra = len(categories)
     while True:
         print("\nSelect the type of packages to manage:")
-        print("1. Package Management")
-        print("2. System Utilities")
-        print("3. Development Tools")
-        print("4. Automation")
-        print("5. Monitoring")
-        print("6. Custom Package Installation")
-        print("7. Advanced")
-        print("8. Back")
-
-        choice = input("Enter your choice (1-8): ")
-
-        if choice == '1':
-            packages = ["python3-pip", "virtualenv"]
-            show_package_menu("Package Management", packages)
-        elif choice == '2':
-            packages = ["htop", "ncdu", "curl", "wget"]
-            show_package_menu("System Utilities", packages)
-        elif choice == '3':
-            packages = ["git", "docker.io", "code"]
-            show_package_menu("Development Tools", packages)
-        elif choice == '4':
-            packages = ["ansible", "cron"]
-            show_package_menu("Automation", packages)
-        elif choice == '5':
-            packages = ["netdata"]
-            show_package_menu("Monitoring", packages)
-        elif choice == '6':
-            custom_packages = input("Enter the packages you want to install (space-separated): ")
-            packages = custom_packages.split()
-            install_custom_packages(packages)
-        elif choice == '7':
+        for idx, category in enumerate(categories, start=1):
+            print(f"{idx}. {category}")
+        print(f"{extra + 1}. Custom Package Installation")
+        print(f"{extra + 2}. Upgrade Installed Packages")
+        print(f"{extra + 3}. Advanced")
+        print(f"{extra + 4}. Back")
+
+        choice = input(f"Enter your choice (1-{extra + 4}): ")
+        choice = int(choice) if choice.isdigit() else 0
+
+        if 1 <= choice <= extra:
+            category = categories[choice - 1]
+            show_package_menu(category, PACKAGE_CATEGORIES[category])
+        elif choice == extra + 1:
+            packages = choose_custom_packages()
+            if packages:
+                install_custom_packages(packages)
+        elif choice == extra + 2:
+            upgrade_packages()
+        elif choice == extra + 3:
             if check_termcolor():
                 show_deb_package_menu()
             else:
@@ -262,11 +770,14 @@ def main():
                     show_deb_package_menu()
                 else:
                     print("Returning to the main menu...")
-        elif choice == '8':
+        elif choice == extra + 4:
             print("Returning to the main menu...")
             return
         else:
             print("Invalid choice. Please try again.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Install and remove packages")
+    parser.add_argument('--root', default=target.ROOT, help="provision the root filesystem in this directory")
+    target.set_root(parser.parse_args().root)
     main()
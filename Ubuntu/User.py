@@ -1,10 +1,78 @@
 import os
 import subprocess
+import argparse
+import collections
 import getpass
-import shutil
+import json
+import secrets
+import socket
 import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import accounts, executor, homedir, journal, keygen, keysource, manifest, sshkeys, target, trace
+
+# Key sources, overridable to point at a mirror or a local stand-in server
+LAUNCHPAD_URL = os.environ.get('SETUP_LAUNCHPAD_URL', 'https://launchpad.net')
+GITHUB_URL = os.environ.get('SETUP_GITHUB_URL', 'https://github.com')
+
+# Commands that rewrite /etc/passwd, /etc/shadow or /etc/group must not overlap
+ACCOUNT_COMMANDS = {'useradd', 'usermod', 'userdel', 'chpasswd', 'passwd', 'newusers', 'gpasswd'}
+
+def account_lock(command):
+    program = command[1] if command[0] == 'sudo' else command[0]
+    return executor.PASSWD_LOCK if program in ACCOUNT_COMMANDS else None
+
+def account_command(command):
+    # Account commands edit the target system's files, see common/target.py
+    return target.account_command(command) if account_lock(command) else command
+
+def run_checked(command, input=None, timeout=None):
+    # shadow tools give up at once when another process (adduser in a package's postinst, ...)
+    # holds the passwd lock; wait for it like apt waits for the dpkg lock
+    deadline = time.monotonic() + executor.LOCK_TIMEOUT
+    delay = 0.1
+    while True:
+        try:
+            return executor.run_sync(account_command(command), input=input, timeout=timeout,
+                                     lock=account_lock(command), check=True)
+        except subprocess.CalledProcessError as e:
+            if 'try again later' not in (e.stderr or '') or time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+def hash_passwords(passwords):
+    # SHA-512 crypt hashes made on this host. chpasswd --root would hash through the target's
+    # PAM stack inside the chroot, which an image being built may not be able to run yet.
+    result = run_checked(['openssl', 'passwd', '-6', '-stdin'], input=''.join(f"{p}\n" for p in passwords))
+    return result.stdout.split()
+
+@trace.step
+def set_passwords(pairs):
+    # One chpasswd run for all (username, password) pairs
+    if not pairs:
+        return
+    if target.is_host():
+        run_checked(['sudo', 'chpasswd'], input=''.join(f"{name}:{password}\n" for name, password in pairs))
+    else:
+        hashes = hash_passwords([password for _, password in pairs])
+        run_checked(['sudo', 'chpasswd', '-e'], input=''.join(f"{name}:{hashed}\n"
+                                                             for (name, _), hashed in zip(pairs, hashes)))
+
+def change_password(username, password):
+    # Returns the CommandResult of passwd, or of chpasswd for an offline target
+    if target.is_host():
+        return executor.run_sync(['sudo', 'passwd', username], input=f"{password}\n{password}\n",
+                                 lock=executor.PASSWD_LOCK)
+    hashed = hash_passwords([password])[0]
+    return executor.run_sync(account_command(['sudo', 'chpasswd', '-e']), input=f"{username}:{hashed}\n",
+                             lock=executor.PASSWD_LOCK)
 
 def create_user():
+    # A passwordless key is most likely wanted; have one ready by the time the names are typed
+    keygen.shared_pool().reserve(1)
     while True:
         print("\nSelect the type of user:")
         print("1. Administrator")
@@ -23,6 +91,9 @@ def create_user():
             continue
 
         username = input("Enter username: ")
+        if user_exists(username):
+            print(f"User {username} already exists.")
+            continue
         first_name = input("Enter first name: ")
         last_name = input("Enter last name: ")
 
@@ -30,7 +101,7 @@ def create_user():
             print("\nSelect authentication method:")
             print("1. Password")
             print("2. RSA with passphrase")
-            print("3. Generate RSA (passwordless)")
+            print("3. Generate key (passwordless)")
             print("4. Back")
             auth_method = input("Enter your choice (1/2/3/4): ")
 
@@ -41,17 +112,7 @@ def create_user():
                     print("Passwords do not match! Please try again.")
                     continue
                 try:
-                    # Create the user with /bin/bash as the default shell
-                    subprocess.run(['sudo', 'useradd', '-m', '-s', '/bin/bash', '-c', f"{first_name} {last_name}", username], check=True)
-                    subprocess.run(['sudo', 'chpasswd'], input=f"{username}:{password}".encode(), check=True)
-                    if is_admin:
-                        subprocess.run(['sudo', 'usermod', '-aG', 'sudo', username], check=True)
-
-                    # Copy default files from /etc/skel to the user's home directory
-                    home_dir = f"/home/{username}"
-                    subprocess.run(['sudo', 'cp', '-r', '/etc/skel/.', home_dir], check=True)
-                    subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", home_dir], check=True)
-
+                    add_user(username, f"{first_name} {last_name}", is_admin, password=password)
                     print(f"User {username} created with password authentication.")
                 except subprocess.CalledProcessError as e:
                     print(f"Error creating user: {e}")
@@ -72,7 +133,9 @@ def create_user():
                     elif rsa_source == '2':
                         rsa_key = fetch_rsa_key('github')
                     elif rsa_source == '3':
-                        rsa_key = generate_rsa_key(username, passphrase=True)
+                        rsa_key, private_key = generate_rsa_key(username, passphrase=True, key_type=choose_key_type())
+                        if private_key:
+                            print(f"Private key saved to {private_key}.")
                     elif rsa_source == '4':
                         break
                     else:
@@ -80,31 +143,9 @@ def create_user():
                         continue
 
                     if rsa_key:
-                        if rsa_key.startswith("<!DOCTYPE html>") or "Error: Page not found" in rsa_key:
-                            print("Invalid username or RSA key not found. Please try again.")
-                            continue
-
                         print(f"Fetched RSA key: {rsa_key}")
                         try:
-                            # Create the user with /bin/bash as the default shell
-                            subprocess.run(['sudo', 'useradd', '-m', '-s', '/bin/bash', '-c', f"{first_name} {last_name}", username], check=True)
-                            home_dir = f"/home/{username}"
-                            ssh_dir = os.path.join(home_dir, '.ssh')
-                            os.makedirs(ssh_dir, exist_ok=True)
-                            auth_keys_file = os.path.join(ssh_dir, 'authorized_keys')
-
-                            with open(auth_keys_file, 'w') as auth_file:
-                                auth_file.write(rsa_key)
-                            subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", ssh_dir], check=True)
-                            subprocess.run(['sudo', 'chmod', '700', ssh_dir], check=True)
-                            subprocess.run(['sudo', 'chmod', '600', auth_keys_file], check=True)
-                            if is_admin:
-                                subprocess.run(['sudo', 'usermod', '-aG', 'sudo', username], check=True)
-
-                            # Copy default files from /etc/skel to the user's home directory
-                            subprocess.run(['sudo', 'cp', '-r', '/etc/skel/.', home_dir], check=True)
-                            subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", home_dir], check=True)
-
+                            auth_keys_file = add_user(username, f"{first_name} {last_name}", is_admin, rsa_key=rsa_key)
                             print(f"User {username} created with RSA authentication.")
                             print(f"RSA key added to {auth_keys_file}.")
                         except subprocess.CalledProcessError as e:
@@ -115,40 +156,17 @@ def create_user():
                 break
 
             elif auth_method == '3':
-                rsa_key = generate_rsa_key(username, passphrase=False)
+                rsa_key, private_key = generate_rsa_key(username, passphrase=False, key_type=choose_key_type())
                 if rsa_key:
                     try:
-                        # Create the user with /bin/bash as the default shell
-                        subprocess.run(['sudo', 'useradd', '-m', '-s', '/bin/bash', '-c', f"{first_name} {last_name}", username], check=True)
-                        home_dir = f"/home/{username}"
-                        ssh_dir = os.path.join(home_dir, '.ssh')
-                        os.makedirs(ssh_dir, exist_ok=True)
-                        auth_keys_file = os.path.join(ssh_dir, 'authorized_keys')
-
-                        temp_key_path = f"/tmp/{username}_rsa_key"
-                        temp_pub_key_path = f"{temp_key_path}.pub"
-                        with open(auth_keys_file, 'w') as auth_file:
-                            auth_file.write(rsa_key)
-                        shutil.move(temp_key_path, os.path.join(ssh_dir, 'id_rsa'))
-                        shutil.move(temp_pub_key_path, os.path.join(ssh_dir, 'id_rsa.pub'))
-                        subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", ssh_dir], check=True)
-                        subprocess.run(['sudo', 'chmod', '700', ssh_dir], check=True)
-                        subprocess.run(['sudo', 'chmod', '600', os.path.join(ssh_dir, 'id_rsa')], check=True)
-                        subprocess.run(['sudo', 'chmod', '644', os.path.join(ssh_dir, 'id_rsa.pub')], check=True)
-                        subprocess.run(['sudo', 'chmod', '600', auth_keys_file], check=True)
-                        if is_admin:
-                            subprocess.run(['sudo', 'usermod', '-aG', 'sudo', username], check=True)
-
-                        # Copy default files from /etc/skel to the user's home directory
-                        subprocess.run(['sudo', 'cp', '-r', '/etc/skel/.', home_dir], check=True)
-                        subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", home_dir], check=True)
-
-                        print(f"User {username} created with RSA authentication.")
-                        print(f"RSA key added to {auth_keys_file}.")
+                        auth_keys_file = add_user(username, f"{first_name} {last_name}", is_admin,
+                                                  rsa_key=rsa_key, private_key=private_key)
+                        print(f"User {username} created with key authentication.")
+                        print(f"Key added to {auth_keys_file}.")
                     except subprocess.CalledProcessError as e:
                         print(f"Error creating user: {e}")
                 else:
-                    print("Failed to generate RSA key. Please try again.")
+                    print("Failed to generate the key. Please try again.")
                 break
 
             elif auth_method == '4':
@@ -159,6 +177,210 @@ def create_user():
 
         break
 
+@trace.step
+def add_user(username, full_name, is_admin, password=None, rsa_key=None, private_key=None):
+    # Creates the account without prompting; used by the menus and by setup.py's manifest mode.
+    # Returns the authorized_keys path when a key was installed.
+    # Create the user with /bin/bash as the default shell; the home is built from skel below
+    run_checked(['sudo', 'useradd', '-M', '-s', '/bin/bash', '-c', full_name, username])
+    populate_homes([username])
+    if password is not None:
+        set_passwords([(username, password)])
+
+    auth_keys_file = None
+    if rsa_key:
+        auth_keys_file = install_rsa_key(username, accounts.home_of(username, target.ROOT), rsa_key, private_key)
+    if is_admin:
+        run_checked(['sudo', 'usermod', '-aG', 'sudo', username])
+    return auth_keys_file
+
+@trace.step
+def populate_homes(usernames, skel=None):
+    # Builds the home directories in one walk of skel, with owner and mode set as each file is
+    # created, in parallel across users. Needs root, so without it the helper runs once under sudo.
+    # Homes, skel and the login.defs giving the home mode are on the target system
+    skel = skel or target.path('/etc/skel')
+    login_defs = target.path(homedir.LOGIN_DEFS)
+    specs = []
+    for username in usernames:
+        info = accounts.user_info(username, target.ROOT)
+        specs.append((target.path(info['home']), info['uid'], info['gid']))
+    if os.geteuid() == 0:
+        errors = [f"{home}: {error}" for home, error in homedir.build_homes(specs, skel, login_defs=login_defs) if error]
+        if errors:
+            raise subprocess.CalledProcessError(1, ['build_homes'], '', '\n'.join(errors))
+    else:
+        run_checked(['sudo', sys.executable, homedir.__file__, 'build', '--skel', skel, '--login-defs', login_defs] +
+                    [f"{name}:{uid}:{gid}:{home}" for name, (home, uid, gid) in zip(usernames, specs)])
+
+def key_entry(username, home_dir, rsa_key, private_key=None, exclusive=False, revoke=()):
+    # The homedir.install_keys arguments for installing rsa_key for username. Numeric ids,
+    # the account may only exist on the target system.
+    info = accounts.user_info(username, target.ROOT)
+    return {'home': target.path(home_dir), 'uid': info['uid'], 'gid': info['gid'],
+            'add': [rsa_key] if rsa_key else [], 'revoke': list(revoke), 'exclusive': exclusive,
+            'private_key': private_key}
+
+@trace.step
+def install_keys(entries):
+    # Installs the keys of many accounts in one pass over key_entry() entries: in this
+    # process as root, else with one run of the helper under sudo. Returns {home: error}.
+    if not entries:
+        return {}
+    if os.geteuid() == 0:
+        return homedir.install_all_keys(entries)
+    result = executor.run_sync(['sudo', sys.executable, homedir.__file__, 'keys'], input=json.dumps(entries))
+    errors = dict(line.split('\t', 1) for line in result.stdout.splitlines() if '\t' in line)
+    if result.returncode != 0 and not errors:
+        reason = result.stderr.strip() or f"exited with {result.returncode}"
+        errors = {entry['home']: reason for entry in entries}
+    return errors
+
+@trace.step
+def install_rsa_key(username, home_dir, rsa_key, private_key=None, exclusive=False, revoke=()):
+    # Merges rsa_key into authorized_keys by fingerprint: keys already there are kept once,
+    # exclusive drops every other key and revoke removes the listed keys or fingerprints.
+    # private_key is a keypair from generate_rsa_key, moved into ~/.ssh under its own name.
+    entry = key_entry(username, home_dir, rsa_key, private_key, exclusive, revoke)
+    auth_keys_file = os.path.join(entry['home'], '.ssh', 'authorized_keys')
+
+    # Nothing to run when the merge would not change the file
+    if not private_key:
+        try:
+            lines, index = sshkeys.read_authorized_keys(auth_keys_file)
+            if sshkeys.merge_authorized_keys(lines, index, entry['add'], revoke, exclusive) == lines:
+                return auth_keys_file
+        except OSError:
+            # Not readable from here, or not a plain file: the helper decides
+            pass
+    errors = install_keys([entry])
+    if errors:
+        raise subprocess.CalledProcessError(1, ['install_keys'], '', errors[entry['home']])
+    return auth_keys_file
+
+def bulk_add_users(users):
+    # Creates many accounts with one newusers pass, one chpasswd feed per password
+    # mode and one update of the sudo group. Returns (created, failures).
+    pending, keys, private_keys, failures = prepare_accounts(users)
+    pending, create_failures = create_accounts(pending)
+    created, finish_failures = finish_accounts(pending, keys, private_keys)
+    return created, failures + create_failures + finish_failures
+
+@trace.step
+def prepare_accounts(users):
+    # Fetches or generates the keys; touches no account files.
+    # Returns (users to create, {name: key}, {name: private key path}, failures).
+    # Every account is journaled from here until finish_accounts, see journal_failures.
+    for user in users:
+        journal.intent(f"users:create:{user['name']}")
+    failures = []
+    pending = []
+    keys = {}
+    private_keys = {}
+    reserve_keys(users)
+    prefetch_keys(users)
+    for user in users:
+        if user_exists(user['name']):
+            failures.append((user['name'], "User already exists"))
+            continue
+        if user['auth'] != 'password':
+            keys[user['name']], private_keys[user['name']] = manifest_key(user)
+            if not keys[user['name']]:
+                failures.append((user['name'], f"No SSH key available from {user['auth']}"))
+                continue
+        pending.append(user)
+    journal_failures(failures)
+    return pending, keys, private_keys, failures
+
+@trace.step
+def create_accounts(pending):
+    # The part that edits passwd/shadow/group. Returns (users created, failures).
+    failures = []
+    if not pending:
+        return [], failures
+
+    # newusers wants some password; use throwaway ones, the real state is set right after
+    entries = ''.join(f"{u['name']}:{secrets.token_urlsafe(24)}:::{u.get('full_name', u['name'])}:/home/{u['name']}:/bin/bash\n"
+                      for u in pending)
+    try:
+        run_checked(['sudo', 'newusers'], input=entries)
+    except subprocess.CalledProcessError as e:
+        created = [u for u in pending if user_exists(u['name'])]
+        failures += [(u['name'], f"newusers failed: {e.stderr.strip()}") for u in pending if u not in created]
+        pending = created
+
+    set_passwords([(u['name'], u['password']) for u in pending if u['auth'] == 'password'])
+    # Key-only accounts get a locked password, as useradd leaves them
+    locked = ''.join(f"{u['name']}:!\n" for u in pending if u['auth'] != 'password')
+    if locked:
+        run_checked(['sudo', 'chpasswd', '-e'], input=locked)
+
+    admins = [u['name'] for u in pending if u.get('admin')]
+    if admins:
+        members = sorted(sudo_members() | set(admins))
+        run_checked(['sudo', 'gpasswd', '-M', ','.join(members), 'sudo'])
+    journal_failures(failures)
+    return pending, failures
+
+@trace.step
+def finish_accounts(pending, keys, private_keys):
+    # Builds the homes and installs the keys. Returns (usernames, failures).
+    failures = []
+    if pending:
+        populate_homes([u['name'] for u in pending])
+
+    # All keys go in with one pass of the helper
+    entries = {u['name']: key_entry(u['name'], accounts.home_of(u['name'], target.ROOT), keys[u['name']],
+                                    private_keys[u['name']]) for u in pending if u['name'] in keys}
+    errors = install_keys(list(entries.values()))
+    created = []
+    for user in pending:
+        username = user['name']
+        error = errors.get(entries[username]['home']) if username in entries else None
+        if error:
+            failures.append((username, f"Account created but the key could not be installed: {error}"))
+        else:
+            created.append(username)
+    for username in created:
+        journal.done(f"users:create:{username}")
+    journal_failures(failures)
+    return created, failures
+
+def journal_failures(failures):
+    for username, reason in failures:
+        journal.failed(f"users:create:{username}", reason)
+
+def bulk_create_users():
+    path = input("Enter the path of the CSV or JSON user list: ").strip()
+    try:
+        users = manifest.load_user_list(path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {path}: {e}")
+        return
+
+    reserve_keys(users)
+    admins = sum(1 for u in users if u.get('admin'))
+    print(f"{len(users)} users ({admins} administrators) found in {path}.")
+    if input("Create these users? (y/n): ").lower() != 'y':
+        return
+    try:
+        # Journaled so an interrupted run can be picked up with 'setup.py resume'
+        with journal.batch({'user_list': os.path.abspath(path)}, target.ROOT):
+            created, failures = bulk_add_users(users)
+    except subprocess.CalledProcessError as e:
+        print(f"Error creating users: {e}")
+        return
+
+    print("\nBulk User Creation Summary:")
+    if created:
+        print("Created users:")
+        for idx, username in enumerate(created, 1):
+            print(f"{idx}. {username}")
+    if failures:
+        print("\nUsers not created:")
+        for idx, (username, reason) in enumerate(failures, 1):
+            print(f"{idx}. {username}: {reason}")
+
 def delete_user():
     username = input("Enter username to delete: ")
     if not user_exists(username):
@@ -166,23 +388,182 @@ def delete_user():
         return
 
     try:
-        # Attempt to kill all processes owned by the user
-        subprocess.run(['sudo', 'pkill', '-u', username], check=True)
+        # Attempt to kill all processes owned by the user; an offline target has none
+        if target.is_host():
+            run_checked(['sudo', 'pkill', '-u', username])
     except subprocess.CalledProcessError:
         print(f"Warning: Could not kill all processes owned by {username}. Proceeding with forceful deletion.")
         try:
             # Forcefully kill all processes owned by the user
-            subprocess.run(['sudo', 'pkill', '-9', '-u', username], check=True)
+            run_checked(['sudo', 'pkill', '-9', '-u', username])
         except subprocess.CalledProcessError:
             print(f"Warning: Forceful process termination for {username} also failed. Proceeding with user deletion.")
 
     try:
         # Delete the user
-        subprocess.run(['sudo', 'userdel', '-r', username], check=True)
+        run_checked(['sudo', 'userdel', '-r', username])
         print(f"User {username} deleted.")
     except subprocess.CalledProcessError as e:
         print(f"Error deleting user: {e}")
 
+@trace.step
+def trash_homes(homes):
+    # Moves the homes into the trash next to them and starts a background purge of each
+    # trash directory used; returns {home: trashed path or None}. Needs root, so without it
+    # the helper does both under sudo, which the purge then keeps running as.
+    if os.geteuid() == 0:
+        trashed = {}
+        for home in homes:
+            try:
+                trashed[home] = homedir.trash_home(home)
+            except OSError:
+                trashed[home] = None
+        for trash in sorted({os.path.dirname(path) for path in trashed.values() if path}):
+            started = time.monotonic()
+            try:
+                command = homedir.start_purge(trash)
+            except OSError as e:
+                print(f"Warning: Could not start removing {trash}: {e}")
+                continue
+            # Only the start is recorded, the purge outlives this process
+            trace.command(command, 0, started, time.monotonic() - started)
+        return trashed
+    result = executor.run_sync(['sudo', sys.executable, homedir.__file__, 'trash', '--purge',
+                                '--rate', str(homedir.PURGE_RATE)] + homes)
+    trashed = dict.fromkeys(homes)
+    for line in result.stdout.splitlines():
+        home, _, path = line.partition('\t')
+        trashed[home] = path or None
+    for line in result.stderr.splitlines():
+        print(f"Warning: {line}")
+    return trashed
+
+def home_kept(name, home, uid, other_homes):
+    # Why userdel -r would leave home in place, or None when it can go
+    home = os.path.normpath(home)
+    if home == '/' or any(other == home or other.startswith(home + '/') for other in other_homes):
+        return f"{home} is used by another account, not removing"
+    try:
+        owner = os.lstat(target.path(home)).st_uid
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        return f"{home} could not be checked ({e}), not removing"
+    if owner != uid:
+        return f"{home} not owned by {name}, not removing"
+    return None
+
+@trace.step
+def bulk_delete_users(usernames):
+    # Removes the accounts, then renames their homes into a trash directory on the same
+    # filesystem and leaves the actual deletion to a throttled background purge.
+    # Returns (deleted, failures, trash directories being purged).
+    failures = [(name, "User does not exist") for name in usernames if not user_exists(name)]
+    usernames = [name for name in usernames if user_exists(name)]
+    if not usernames:
+        return [], failures, []
+    infos = {name: accounts.user_info(name, target.ROOT) for name in usernames}
+
+    # Ask every user's processes to stop at once, then kill whatever is left
+    if target.is_host():
+        executor.run_many([['sudo', 'pkill', '-u', name] for name in usernames])
+        executor.run_many([['sudo', 'pkill', '-9', '-u', name] for name in usernames])
+
+    # userdel has no batch mode; without -r each call only edits the account files
+    deleted = []
+    results = executor.run_many([account_command(['sudo', 'userdel', name]) for name in usernames],
+                                lock=executor.PASSWD_LOCK)
+    for name, result in zip(usernames, results):
+        if result.returncode == 0:
+            deleted.append(name)
+        else:
+            failures.append((name, result.stderr.strip() or f"userdel exited with {result.returncode}"))
+
+    # The mail spool is what userdel -r would have removed besides the home
+    executor.run_many([['sudo', 'rm', '-f', target.path(f"/var/mail/{name}")] for name in deleted])
+    # Like userdel -r, a home is only removed when the account owned it and no account left shares it
+    other_homes = {os.path.normpath(info['home']) for info in accounts.load_accounts(target.ROOT)['users'].values()}
+    to_trash = []
+    for name in deleted:
+        home = infos[name]['home']
+        kept = home_kept(name, home, infos[name]['uid'], other_homes) if home else "no home directory"
+        if kept:
+            print(f"Warning: {kept}.")
+        else:
+            to_trash.append(target.path(home))
+    trashed = trash_homes(to_trash) if to_trash else {}
+    for home, path in trashed.items():
+        if path is None and os.path.lexists(home):
+            # Could not be renamed (a mount point or another filesystem), delete it in place
+            run_checked(['sudo', 'rm', '-rf', '--one-file-system', home])
+
+    trashes = sorted({os.path.dirname(path) for path in trashed.values() if path})
+    return deleted, failures, trashes
+
+def show_purge_progress(trashes, since, grace=10):
+    # Follows the background purges started after since until they finish, stop running
+    # (none holds its lock grace seconds after the start) or the user presses Ctrl+C
+    try:
+        while True:
+            running = any(homedir.purge_running(trash) for trash in trashes)
+            progress = [homedir.read_progress(trash) for trash in trashes]
+            # Left over from an earlier purge; the new one has not reported yet
+            progress = [p if p and p.get('started', 0) >= since else None for p in progress]
+            total = sum(p['total'] for p in progress if p)
+            removed = sum(p['removed'] for p in progress if p)
+            done = all(p and p['done'] for p in progress)
+            percent = removed * 100 // total if total else 0
+            print(f"\rRemoving home directories: {removed}/{total} entries ({percent}%)", end='', flush=True)
+            if done:
+                print()
+                return
+            if not running and time.time() - since > grace:
+                left = [trash for trash, p in zip(trashes, progress) if not (p and p['done'])]
+                print(f"\nNo cleanup is running; what is left stays in {', '.join(left)}.")
+                return
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nCleanup continues in the background.")
+
+def bulk_delete_users_menu():
+    source = input("Enter usernames separated by commas, or the path of a file with one username per line: ").strip()
+    if os.path.isfile(source):
+        try:
+            with open(source) as name_file:
+                usernames = [line.split(',')[0].strip() for line in name_file]
+        except OSError as e:
+            print(f"Could not read {source}: {e}")
+            return
+        # A CSV user list starts with a header row
+        if usernames and usernames[0] == 'name':
+            usernames = usernames[1:]
+    else:
+        usernames = [name.strip() for name in source.split(',')]
+    usernames = list(dict.fromkeys(name for name in usernames if name))
+    if not usernames:
+        print("No usernames given.")
+        return
+
+    print(f"{len(usernames)} users will be deleted together with their home directories.")
+    if input("Delete these users? (y/n): ").lower() != 'y':
+        return
+    started = time.time()
+    deleted, failures, trashes = bulk_delete_users(usernames)
+
+    print("\nBulk User Deletion Summary:")
+    if deleted:
+        print("Deleted users:")
+        for idx, username in enumerate(deleted, 1):
+            print(f"{idx}. {username}")
+    if failures:
+        print("\nUsers not deleted:")
+        for idx, (username, reason) in enumerate(failures, 1):
+            print(f"{idx}. {username}: {reason}")
+    if trashes:
+        print("\nHome directories are being removed in the background.")
+        if input("Follow the cleanup progress? (y/n): ").lower() == 'y':
+            show_purge_progress(trashes, started)
+
 def manage_user():
     username = input("Enter username to manage: ")
     if not user_exists(username):
@@ -201,12 +582,15 @@ def manage_user():
             old_username = username
             new_username = input("Enter new username: ")
             try:
-                subprocess.run(['sudo', 'usermod', '-l', new_username, old_username], check=True)
-                subprocess.run(['sudo', 'usermod', '-d', f"/home/{new_username}", '-m', new_username], check=True)
+                old_home = accounts.home_of(old_username, target.ROOT)
+                run_checked(['sudo', 'usermod', '-l', new_username, old_username])
+                run_checked(['sudo', 'usermod', '-d', f"/home/{new_username}", '-m', new_username])
                 move_data = input("Do you want to move old user data to new user? (yes/no): ")
                 if move_data.lower() == 'yes':
-                    subprocess.run(['sudo', 'mv', f"/home/{old_username}", f"/home/{new_username}"], check=True)
-                    subprocess.run(['sudo', 'chown', '-R', f"{new_username}:{new_username}", f"/home/{new_username}"], check=True)
+                    new_home = target.path(f"/home/{new_username}")
+                    info = accounts.user_info(new_username, target.ROOT)
+                    run_checked(['sudo', 'mv', target.path(old_home), new_home])
+                    run_checked(['sudo', 'chown', '-R', f"{info['uid']}:{info['gid']}", new_home])
                 print(f"Username changed from {old_username} to {new_username}.")
             except subprocess.CalledProcessError as e:
                 print(f"Error changing username: {e}")
@@ -220,10 +604,9 @@ def manage_user():
                 continue
             try:
                 # Using subprocess to handle the password change
-                process = subprocess.Popen(['sudo', 'passwd', username], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stdout, stderr = process.communicate(input=f"{password}\n{password}\n".encode())
-                if process.returncode != 0:
-                    print(f"Error changing password: {stderr.decode().strip()}")
+                result = change_password(username, password)
+                if result.returncode != 0:
+                    print(f"Error changing password: {result.stderr.strip()}")
                 else:
                     print(f"Password for user {username} changed.")
             except subprocess.CalledProcessError as e:
@@ -235,7 +618,7 @@ def manage_user():
                 print("\nSelect new authentication method:")
                 print("1. Password")
                 print("2. RSA with passphrase")
-                print("3. Generate RSA (passwordless)")
+                print("3. Generate key (passwordless)")
                 print("4. Back")
                 auth_method = input("Enter your choice (1/2/3/4): ")
 
@@ -246,10 +629,9 @@ def manage_user():
                         print("Passwords do not match! Please try again.")
                         continue
                     try:
-                        process = subprocess.Popen(['sudo', 'passwd', username], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        stdout, stderr = process.communicate(input=f"{password}\n{password}\n".encode())
-                        if process.returncode != 0:
-                            print(f"Error changing password: {stderr.decode().strip()}")
+                        result = change_password(username, password)
+                        if result.returncode != 0:
+                            print(f"Error changing password: {result.stderr.strip()}")
                         else:
                             print(f"Password for user {username} changed.")
                     except subprocess.CalledProcessError as e:
@@ -271,7 +653,9 @@ def manage_user():
                         elif rsa_source == '2':
                             rsa_key = fetch_rsa_key('github')
                         elif rsa_source == '3':
-                            rsa_key = generate_rsa_key(username, passphrase=True)
+                            rsa_key, private_key = generate_rsa_key(username, passphrase=True)
+                            if private_key:
+                                print(f"Private key saved to {private_key}.")
                         elif rsa_source == '4':
                             break
                         else:
@@ -279,22 +663,10 @@ def manage_user():
                             continue
 
                         if rsa_key:
-                            if rsa_key.startswith("<!DOCTYPE html>") or "Error: Page not found" in rsa_key:
-                                print("Invalid username or RSA key not found. Please try again.")
-                                continue
-
                             print(f"Fetched RSA key: {rsa_key}")
                             try:
-                                home_dir = f"/home/{username}"
-                                ssh_dir = os.path.join(home_dir, '.ssh')
-                                os.makedirs(ssh_dir, exist_ok=True)
-                                auth_keys_file = os.path.join(ssh_dir, 'authorized_keys')
-
-                                with open(auth_keys_file, 'w') as auth_file:
-                                    auth_file.write(rsa_key)
-                                subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", ssh_dir], check=True)
-                                subprocess.run(['sudo', 'chmod', '700', ssh_dir], check=True)
-                                subprocess.run(['sudo', 'chmod', '600', auth_keys_file], check=True)
+                                auth_keys_file = install_rsa_key(username, accounts.home_of(username, target.ROOT), rsa_key,
+                                                                 exclusive=True)
                                 print(f"RSA key for user {username} changed.")
                                 print(f"RSA key added to {auth_keys_file}.")
                             except subprocess.CalledProcessError as e:
@@ -305,31 +677,17 @@ def manage_user():
                     break
 
                 elif auth_method == '3':
-                    rsa_key = generate_rsa_key(username, passphrase=False)
+                    rsa_key, private_key = generate_rsa_key(username, passphrase=False)
                     if rsa_key:
                         try:
-                            home_dir = f"/home/{username}"
-                            ssh_dir = os.path.join(home_dir, '.ssh')
-                            os.makedirs(ssh_dir, exist_ok=True)
-                            auth_keys_file = os.path.join(ssh_dir, 'authorized_keys')
-
-                            temp_key_path = f"/tmp/{username}_rsa_key"
-                            temp_pub_key_path = f"{temp_key_path}.pub"
-                            with open(auth_keys_file, 'w') as auth_file:
-                                auth_file.write(rsa_key)
-                            shutil.move(temp_key_path, os.path.join(ssh_dir, 'id_rsa'))
-                            shutil.move(temp_pub_key_path, os.path.join(ssh_dir, 'id_rsa.pub'))
-                            subprocess.run(['sudo', 'chown', '-R', f"{username}:{username}", ssh_dir], check=True)
-                            subprocess.run(['sudo', 'chmod', '700', ssh_dir], check=True)
-                            subprocess.run(['sudo', 'chmod', '600', os.path.join(ssh_dir, 'id_rsa')], check=True)
-                            subprocess.run(['sudo', 'chmod', '644', os.path.join(ssh_dir, 'id_rsa.pub')], check=True)
-                            subprocess.run(['sudo', 'chmod', '600', auth_keys_file], check=True)
+                            auth_keys_file = install_rsa_key(username, accounts.home_of(username, target.ROOT), rsa_key,
+                                                             private_key=private_key, exclusive=True)
                             print(f"RSA key for user {username} changed.")
                             print(f"RSA key added to {auth_keys_file}.")
                         except subprocess.CalledProcessError as e:
                             print(f"Error changing RSA key: {e}")
                     else:
-                        print("Failed to generate RSA key. Please try again.")
+                        print("Failed to generate the key. Please try again.")
                     break
 
                 elif auth_method == '4':
@@ -347,20 +705,21 @@ def manage_user():
             continue
 
 def user_exists(username):
-    try:
-        subprocess.run(['id', username], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return accounts.user_exists(username, target.ROOT)
 
-def fetch_rsa_key(source):
+def key_url(source, account):
     if source == 'launchpad':
-        launchpad_username = input("Enter Launchpad username: ").lower()
-        url = f"https://launchpad.net/~{launchpad_username}/+sshkeys"
+        return f"{LAUNCHPAD_URL}/~{account.lower()}/+sshkeys"
     elif source == 'github':
-        github_username = input("Enter GitHub username: ").lower()
-        url = f"https://github.com/{github_username}.keys"
-    else:
+        return f"{GITHUB_URL}/{account.lower()}.keys"
+    return None
+
+@trace.step
+def fetch_rsa_key(source, account=None):
+    if account is None and source in ('launchpad', 'github'):
+        account = input(f"Enter {'Launchpad' if source == 'launchpad' else 'GitHub'} username: ")
+    url = key_url(source, account)
+    if url is None:
         return None
 
     rsa_key = get_rsa_from_url(url)
@@ -369,35 +728,199 @@ def fetch_rsa_key(source):
     return None
 
 def get_rsa_from_url(url):
-    try:
-        print(f"Fetching RSA key from {url}")
-        rsa_key = subprocess.check_output(['curl', '-s', url], universal_newlines=True)
-        if rsa_key.startswith("<!DOCTYPE html>") or "Error: Page not found" in rsa_key:
-            return None
-        print(f"Fetched RSA key: {rsa_key}")
-        return rsa_key
-    except subprocess.CalledProcessError as e:
-        print(f"Error fetching RSA key from {url}: {e}")
+    print(f"Fetching RSA key from {url}")
+    keys, error = keysource.default_fetcher.fetch(url)
+    if error:
+        print(f"Error fetching RSA key from {url}: {error}")
         return None
-
-def generate_rsa_key(username, passphrase=True):
-    key_path = f'/tmp/{username}_rsa_key'
-    pub_key_path = f"{key_path}.pub"
+    rsa_key = '\n'.join(keys)
+    print(f"Fetched RSA key: {rsa_key}")
+    return rsa_key
+
+def prefetch_keys(users):
+    # Warms the key cache for every Launchpad/GitHub user at once, later lookups are served from it
+    urls = [key_url(u['auth'], u.get('key_user', u['name'])) for u in users if u['auth'] in ('launchpad', 'github')]
+    keysource.default_fetcher.fetch_many(urls)
+
+@trace.step
+def generate_rsa_key(username, passphrase=True, key_type=keygen.KEY_TYPE):
+    # Returns (public key, private key path) or (None, None). The keypair is written to a
+    # private temporary directory. Passwordless keys come from the shared key pool.
     try:
         if passphrase:
             passphrase = getpass.getpass("Enter passphrase: ")
             if not passphrase:
                 print("Passphrase cannot be empty.")
-                return None
-            subprocess.run(['ssh-keygen', '-t', 'rsa', '-f', key_path, '-N', passphrase], check=True)
+                return None, None
+            private_key, rsa_key = keygen.generate_keypair(keygen.private_dir(username), key_type, passphrase,
+                                                           comment=f"{username}@{socket.gethostname()}")
         else:
-            subprocess.run(['ssh-keygen', '-t', 'rsa', '-f', key_path, '-N', ''], check=True)
-        with open(pub_key_path, 'r') as key_file:
-            rsa_key = key_file.read().strip()
-        return rsa_key
-    except subprocess.CalledProcessError as e:
+            private_key, rsa_key = keygen.shared_pool(key_type).take(username)
+        return rsa_key, private_key
+    except (OSError, subprocess.CalledProcessError) as e:
         print(f"Error generating RSA key: {e}")
-        return None
+        return None, None
+
+def sudo_members():
+    return accounts.group_members('sudo', target.ROOT)
+
+def reserve_keys(users):
+    # Has the key pool start on the keys users will get generated, as soon as they are known
+    counts = collections.Counter(u.get('key_type', keygen.KEY_TYPE) for u in users if u['auth'] == 'generate')
+    for key_type, count in counts.items():
+        keygen.shared_pool(key_type).reserve(count)
+
+def choose_key_type():
+    types = list(keygen.KEY_TYPES)
+    while True:
+        print("\nSelect key type:")
+        for idx, key_type in enumerate(types, 1):
+            print(f"{idx}. {keygen.KEY_TYPES[key_type]}{' (default)' if key_type == keygen.KEY_TYPE else ''}")
+        choice = input(f"Enter your choice (1-{len(types)}, Enter for the default): ").strip()
+        if not choice:
+            return keygen.KEY_TYPE
+        if choice.isdigit() and 1 <= int(choice) <= len(types):
+            return types[int(choice) - 1]
+        print("Invalid choice! Please enter a valid option.")
+
+def manifest_key(user):
+    # The key a manifest entry asks for, fetching it from Launchpad/GitHub when needed.
+    # Returns (public key, private key path); only generated keys have a private half.
+    if user['auth'] in ('launchpad', 'github'):
+        return fetch_rsa_key(user['auth'], user.get('key_user', user['name'])), None
+    elif user['auth'] == 'key':
+        return user['key'], None
+    elif user['auth'] == 'generate':
+        return generate_rsa_key(user['name'], passphrase=False, key_type=user.get('key_type', keygen.KEY_TYPE))
+    return None, None
+
+def plan_manifest(users, dry_run=False):
+    # Works out and prints what bringing the [[users]] entries of a setup.py manifest into
+    # place would change, touching only what differs from the current accounts. Returns the
+    # plan apply_manifest carries out, see common/manifest.py. Unless dry_run, the keys to
+    # generate are started on while the plan waits for confirmation.
+    # Passwords stay out of the recorded fingerprint
+    desired = [{k: v for k, v in user.items() if k != 'password'} for user in users]
+    watched = [target.path('/etc/passwd'), target.path('/etc/group')] + [
+        os.path.join(target.path(accounts.home_of(u['name'], target.ROOT)), '.ssh', 'authorized_keys') for u in users]
+
+    print("\nUsers:")
+    if manifest.is_converged('users', desired, watched):
+        return {'pending': 0}
+
+    actions = []
+    planned_keys = {}
+    prefetch_keys([u for u in users if user_exists(u['name'])])
+    for user in users:
+        username = user['name']
+        role = "administrator" if user.get('admin') else "standard user"
+        if not user_exists(username):
+            key_type = f", {user.get('key_type', keygen.KEY_TYPE)} key" if user['auth'] == 'generate' else ''
+            print(f"  create {username} ({role}, {user['auth']} authentication{key_type})")
+            actions.append(('create', user))
+            continue
+        if user.get('admin') and not accounts.in_group(username, 'sudo', target.ROOT):
+            print(f"  add {username} to sudo")
+            actions.append(('admin', user))
+        fetched = user['auth'] in ('launchpad', 'github', 'key')
+        if fetched or user.get('revoke'):
+            # Only accounts whose authorized_keys would actually change get a key action
+            rsa_key = manifest_key(user)[0] if fetched else None
+            if fetched and not rsa_key:
+                print(f"  update keys of {username} (no {user['auth']} key available yet)")
+                actions.append(('key', user))
+            else:
+                auth_keys_file = os.path.join(target.path(accounts.home_of(username, target.ROOT)), '.ssh', 'authorized_keys')
+                keys = [rsa_key] if rsa_key else []
+                try:
+                    lines, index = sshkeys.read_authorized_keys(auth_keys_file)
+                    note = ''
+                    changed = sshkeys.merge_authorized_keys(lines, index, keys, user.get('revoke', ()),
+                                                            user.get('exclusive', False)) != lines
+                except OSError:
+                    # Only root can read it: planned as an update, which the key helper
+                    # turns into a no-op when the keys are already in place
+                    note = ' (not readable here, checked when applied)'
+                    changed = True
+                if changed:
+                    print(f"  update authorized_keys of {username}{note}")
+                    planned_keys[username] = rsa_key
+                    actions.append(('key', user))
+        if not actions or actions[-1][1] is not user:
+            print(f"  keep {username} (already exists)")
+    if not dry_run:
+        reserve_keys([user for action, user in actions if action == 'create'])
+    return manifest.settle_plan('users', {'pending': len(actions), 'desired': desired, 'watched': watched,
+                                          'actions': actions, 'keys': planned_keys})
+
+def apply_manifest(users, dry_run=False, scheduler=None, plan=None):
+    # Applies the [[users]] entries without prompting, following plan when setup.py already
+    # made one
+    plan = plan if plan is not None else plan_manifest(users, dry_run)
+    actions, planned_keys = plan.get('actions', []), plan.get('keys', {})
+    operations = {'create': 'create', 'admin': 'admin', 'key': 'authorized_keys'}
+
+    def add_jobs(scheduler, failed):
+        jobs = []
+        creations = [user for action, user in actions if action == 'create']
+        if creations:
+            # Keys are fetched and generated without any lock, only the account file edits
+            # queue up on the passwd lock, and homes are built once the accounts exist
+            prepare = scheduler.add('users:keys', prepare_accounts, creations)
+
+            def create():
+                pending, keys, private_keys, failures = scheduler.result(prepare)
+                pending, create_failures = create_accounts(pending)
+                return pending, keys, private_keys, failures + create_failures
+            create_job = scheduler.add('users:accounts', create, deps=[prepare], lock='passwd')
+
+            def finish():
+                pending, keys, private_keys, failures = scheduler.result(create_job)
+                created, finish_failures = finish_accounts(pending, keys, private_keys)
+                for username in created:
+                    print(f"User {username} created.")
+                for username, reason in failures + finish_failures:
+                    print(f"Error creating user {username}: {reason}")
+                    failed.append(username)
+            jobs.append(scheduler.add('users:homes', finish, deps=[create_job]))
+
+        def make_admin(username):
+            journal.intent(f"users:admin:{username}")
+            try:
+                run_checked(['sudo', 'usermod', '-aG', 'sudo', username])
+                journal.done(f"users:admin:{username}")
+                print(f"User {username} added to sudo.")
+            except subprocess.CalledProcessError as e:
+                journal.failed(f"users:admin:{username}", e)
+                print(f"Error applying admin for {username}: {e}")
+                failed.append(username)
+
+        def update_keys(user):
+            username = user['name']
+            if username not in planned_keys:
+                print(f"Skipping {username}: no SSH key available from {user['auth']}.")
+                journal.failed(f"users:authorized_keys:{username}", "no key available")
+                failed.append(username)
+                return
+            journal.intent(f"users:authorized_keys:{username}")
+            try:
+                install_rsa_key(username, accounts.home_of(username, target.ROOT), planned_keys[username],
+                                exclusive=user.get('exclusive', False), revoke=user.get('revoke', ()))
+                journal.done(f"users:authorized_keys:{username}")
+                print(f"Keys of {username} updated.")
+            except (OSError, subprocess.CalledProcessError) as e:
+                journal.failed(f"users:authorized_keys:{username}", e)
+                print(f"Error applying key for {username}: {e}")
+                failed.append(username)
+
+        for action, user in actions:
+            if action == 'admin':
+                jobs.append(scheduler.add(f"users:admin:{user['name']}", make_admin, user['name'], lock='passwd'))
+            elif action == 'key':
+                jobs.append(scheduler.add(f"users:authorized_keys:{user['name']}", update_keys, user))
+        return jobs
+    return manifest.apply_plan('users', plan, [f"users:{operations[action]}:{user['name']}" for action, user in actions],
+                               add_jobs, dry_run, scheduler)
 
 def user_tool():
     while True:
@@ -405,8 +928,10 @@ def user_tool():
         print("1. Create user")
         print("2. Delete user")
         print("3. Manage user")
-        print("4. Back")
-        choice = input("Enter your choice (1/2/3/4): ")
+        print("4. Bulk create users from file")
+        print("5. Bulk delete users")
+        print("6. Back")
+        choice = input("Enter your choice (1/2/3/4/5/6): ")
 
         if choice == '1':
             create_user()
@@ -415,9 +940,16 @@ def user_tool():
         elif choice == '3':
             manage_user()
         elif choice == '4':
+            bulk_create_users()
+        elif choice == '5':
+            bulk_delete_users_menu()
+        elif choice == '6':
             return
         else:
             print("Invalid choice! Please enter a valid option.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create, delete and manage user accounts")
+    parser.add_argument('--root', default=target.ROOT, help="provision the root filesystem in this directory")
+    target.set_root(parser.parse_args().root)
     user_tool()
@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Benchmarks for the Ubuntu tools, run against the stand-in commands in shim.py and an
+# offline root tree, so they need no root, no network and change nothing on the host:
+#
+#   python3 bench/bench.py                      # run every scenario, compare with the baseline
+#   python3 bench/bench.py --save-baseline      # store this run as the new baseline
+#   python3 bench/bench.py --scenario users --users 2000 --fail newusers=0.5
+#
+# Each scenario runs in a fresh interpreter and reports wall time, the number of commands
+# the tools started and peak RSS.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, os.path.join(BASE_DIR, 'tests')]
+
+import shim
+from support import make_deb, public_key
+
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+# Roughly what the real commands cost on a quiet machine, in seconds per run
+DEFAULT_LATENCY = '0.002,apt=0.1,ssh-keygen=0.02,newusers=0.02,keyserver=0.02'
+# Allowed slowdown or memory growth against the baseline before a scenario counts as regressed
+TOLERANCE = 0.25
+
+SKEL_FILES = {'.bashrc': "# ~/.bashrc\n", '.profile': "# ~/.profile\n", '.bash_logout': "# ~/.bash_logout\n"}
+
+def write_shims(bin_dir):
+    # One executable per command, all handled by shim.py. -S skips site-packages, which
+    # takes most of an interpreter's startup time.
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in shim.SHIMS:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as wrapper:
+            wrapper.write(f"#!{sys.executable} -S\nimport sys\nsys.path.insert(0, {BENCH_DIR!r})\n"
+                          f"import shim\nshim.main({name!r})\n")
+        os.chmod(path, 0o755)
+
+def build_root(root):
+    # The smallest tree the tools work on: accounts, a skeleton home, dpkg status and apt sources
+    for directory in ('etc/skel', 'etc/apt/sources.list.d', 'var/lib/dpkg', 'var/lib/apt/lists', 'home'):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    files = {
+        'etc/passwd': "root:x:0:0:root:/root:/bin/bash\n",
+        'etc/group': "root:x:0:\nsudo:x:27:\n",
+        'etc/apt/sources.list': "deb http://archive.ubuntu.com/ubuntu jammy main\n",
+        'var/lib/dpkg/status': "Package: libc6\nStatus: install ok installed\nArchitecture: amd64\nVersion: 2.35-0ubuntu3\n",
+    }
+    files.update({f"etc/skel/{name}": content for name, content in SKEL_FILES.items()})
+    for name, content in files.items():
+        with open(os.path.join(root, name), 'w') as output:
+            output.write(content)
+
+class KeyServer(http.server.BaseHTTPRequestHandler):
+    # Answers /<account>.keys like GitHub, with the keyserver latency and failure rate
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(shim.parse_setting(os.environ.get('BENCH_LATENCY'), 'keyserver'))
+        shim.log('keyserver')
+        if shim.random.random() < shim.parse_setting(os.environ.get('BENCH_FAIL'), 'keyserver'):
+            status, body = 500, b"injected failure\n"
+        else:
+            status, body = 200, f"{public_key(self.path.strip('/'))}\n".encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_key_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeyServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+# Scenarios prepare their input, then return the function being measured. It returns
+# how many operations the tools reported as failed.
+
+def packages_scenario(work, size):
+    # One category-sized install: the package lists are refreshed, then everything goes in
+    # one apt transaction. Two of the names are unknown to apt, as typos would be.
+    import Packages
+    packages = [f"bench-tool-{idx}" for idx in range(size)]
+    for idx in (size // 3, 2 * size // 3):
+        packages[idx] = f"{shim.MISSING_PREFIX}{idx}"
+    return lambda: len(Packages.install_packages(packages))
+
+def debs_scenario(work, size):
+    # A DEB directory of libraries depending on each other, with an older version next to
+    # every twentieth package, installed with 'Install All'
+    import Packages
+    from common import debfile
+    deb_dir = os.path.join(work, 'DEB')
+    os.makedirs(deb_dir)
+    count = 0
+    idx = 0
+    payload = {'./usr/share/bench/payload': os.urandom(4096)}
+    while count < size:
+        fields = {'Package': f"bench-lib{idx}", 'Version': f"1.{idx}-1", 'Architecture': 'amd64',
+                  'Maintainer': 'Bench <bench@example.com>', 'Description': f"benchmark library {idx}"}
+        depends = []
+        if idx % 4:
+            depends.append(f"bench-lib{idx - 1} (>= 1.{idx - 1}-1)")
+        if idx % 10 == 0:
+            depends.append("libc6 (>= 2.31)")
+        if depends:
+            fields['Depends'] = ', '.join(depends)
+        make_deb(os.path.join(deb_dir, f"bench-lib{idx}_1.{idx}-1_amd64.deb"), fields, payload)
+        count += 1
+        if idx % 20 == 0 and count < size:
+            make_deb(os.path.join(deb_dir, f"bench-lib{idx}_0.9-1_amd64.deb"), dict(fields, Version='0.9-1'), payload)
+            count += 1
+        idx += 1
+
+    def run():
+        entries, errors = debfile.scan_directory(deb_dir, Packages.DEB_INDEX)
+        newest, _ = debfile.newest_versions(entries)
+        failures = Packages.install_deb_packages([e['path'] for e in newest], assume_yes=True, repo_entries=newest)
+        return len(failures) + len(errors)
+    return run
+
+def users_scenario(work, size):
+    # Onboarding a team from a user list: a third each with a password, a GitHub key and a
+    # generated key, every tenth one an admin
+    import User
+    users = []
+    for idx in range(size):
+        name = f"bench{idx:04d}"
+        user = {'name': name, 'full_name': f"Bench User {idx}", 'admin': idx % 10 == 0,
+                'auth': ('password', 'github', 'generate')[idx % 3]}
+        if user['auth'] == 'password':
+            user['password'] = f"bench-password-{idx}"
+        elif user['auth'] == 'github':
+            user['key_user'] = name
+        users.append(user)
+    return lambda: len(User.bulk_add_users(users)[1])
+
+SCENARIOS = {
+    'packages': packages_scenario,
+    'debs': debs_scenario,
+    'users': users_scenario,
+}
+
+def run_child(name, size, result_path):
+    # Runs one scenario in this process and writes its measurements to result_path
+    work = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    root = os.path.join(work, 'root')
+    build_root(root)
+    os.environ.update({'SETUP_ROOT': root, 'SETUP_CACHE_DIR': os.path.join(work, 'cache'),
+                       'SETUP_PROGRESS': 'silent', 'SETUP_KEY_TYPE': 'ed25519',
+                       'SETUP_GITHUB_URL': start_key_server()})
+    sys.path[:0] = [BASE_DIR, os.path.join(BASE_DIR, 'Ubuntu')]
+    try:
+        measured = SCENARIOS[name](work, size)
+        open(os.environ['BENCH_LOG'], 'w').close()
+        # The tools report every step; only the numbers matter here
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            failures = measured()
+            wall = time.perf_counter() - started
+        with open(os.environ['BENCH_LOG']) as log_file:
+            commands = sum(1 for _ in log_file)
+        result = {'size': size, 'wall': wall, 'commands': commands, 'failures': failures,
+                  # ru_maxrss is in kilobytes on Linux
+                  'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        with open(result_path, 'w') as result_file:
+            json.dump(result, result_file)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+def run_scenario(name, size, latency, fail, repeat):
+    # Best of repeat runs, each in a fresh interpreter so caches and RSS start from nothing
+    best = None
+    with tempfile.TemporaryDirectory(prefix='bench-') as temp:
+        bin_dir = os.path.join(temp, 'bin')
+        write_shims(bin_dir)
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                   BENCH_LOG=os.path.join(temp, 'commands.log'), BENCH_LATENCY=latency, BENCH_FAIL=fail)
+        result_path = os.path.join(temp, 'result.json')
+        for _ in range(repeat):
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, '--size', str(size),
+                            '--result', result_path], env=env, check=True)
+            with open(result_path) as result_file:
+                result = json.load(result_file)
+            if best is None or result['wall'] < best['wall']:
+                best = result
+    return best
+
+def load_baseline(path):
+    try:
+        with open(path) as baseline_file:
+            return json.load(baseline_file)
+    except (OSError, ValueError):
+        return {}
+
+def change(value, base):
+    return f"{100.0 * (value - base) / base:+.0f}%" if base else "-"
+
+def compare(results, baseline, tolerance):
+    # Prints one row per scenario; returns the names of the scenarios that regressed
+    regressed = []
+    print(f"\n{'Scenario':<10} {'Size':>5} {'Wall':>8} {'Change':>7} {'Commands':>9} {'Base':>6} "
+          f"{'Peak RSS':>10} {'Change':>7} {'Failures':>8}")
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base and (base['size'] != result['size'] or base['latency'] != result['latency']):
+            # Not comparable, the scenario or the simulated command costs differ
+            base = None
+        problems = []
+        if base:
+            if result['wall'] > base['wall'] * (1 + tolerance):
+                problems.append('wall time')
+            if result['commands'] > base['commands']:
+                problems.append('commands')
+            if result['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+                problems.append('memory')
+            if result['failures'] != base['failures']:
+                problems.append('failures')
+        print(f"{name:<10} {result['size']:>5} {result['wall']:>7.2f}s "
+              f"{change(result['wall'], base['wall']) if base else '-':>7} {result['commands']:>9} "
+              f"{base['commands'] if base else '-':>6} {result['peak_rss_kb'] / 1024:>8.1f}MB "
+              f"{change(result['peak_rss_kb'], base['peak_rss_kb']) if base else '-':>7} {result['failures']:>8}"
+              f"{'  REGRESSED: ' + ', '.join(problems) if problems else ''}")
+        if problems:
+            regressed.append(name)
+    if not baseline:
+        print("\nNo baseline to compare with; store one with --save-baseline.")
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Ubuntu tools against stand-in commands.")
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument('--packages', type=int, default=50, help="packages to install (default: 50)")
+    parser.add_argument('--debs', type=int, default=100, help=".deb files in the DEB directory (default: 100)")
+    parser.add_argument('--users', type=int, default=500, help="users to onboard (default: 500)")
+    parser.add_argument('--latency', default=DEFAULT_LATENCY,
+                        help=f"seconds each command takes, e.g. '0.01,apt=0.2' (default: {DEFAULT_LATENCY})")
+    parser.add_argument('--fail', default='', help="failure rate per command, e.g. 'newusers=0.5,apt=0.1'")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scenario, the fastest counts")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="baseline file to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help=f"allowed slowdown and memory growth as a fraction (default: {TOLERANCE})")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, args.size, args.result)
+        return 0
+
+    sizes = {'packages': args.packages, 'debs': args.debs, 'users': args.users}
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        print(f"Running {name} ({sizes[name]})...")
+        try:
+            results[name] = dict(run_scenario(name, sizes[name], args.latency, args.fail, args.repeat),
+                                 latency=args.latency)
+        except subprocess.CalledProcessError as e:
+            print(f"The {name} scenario crashed: {e}")
+            return 1
+
+    regressed = compare(results, load_baseline(args.baseline), args.tolerance)
+    if args.save_baseline:
+        baseline = load_baseline(args.baseline)
+        baseline.setdefault('results', {}).update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import grp
+import os
+import pwd
+
+from common.state import file_stamp
+
+# root -> (stamps of passwd/group, index)
+_cache = {}
+
+def _read_colon_file(path):
+    with open(path, encoding='utf-8', errors='replace') as colon_file:
+        for line in colon_file:
+            line = line.rstrip('\n')
+            if line and not line.startswith('#') and not line.startswith(('+', '-')):
+                yield line.split(':')
+
+def _build(root):
+    users = {}
+    groups = {}
+    if root == '/':
+        # Goes through NSS, so directory services show up as well
+        for entry in pwd.getpwall():
+            users.setdefault(entry.pw_name, {'uid': entry.pw_uid, 'gid': entry.pw_gid, 'gecos': entry.pw_gecos,
+                                             'home': entry.pw_dir, 'shell': entry.pw_shell})
+        for entry in grp.getgrall():
+            groups.setdefault(entry.gr_name, {'gid': entry.gr_gid, 'members': set(entry.gr_mem)})
+    else:
+        for fields in _read_colon_file(os.path.join(root, 'etc/passwd')):
+            if len(fields) >= 7:
+                users.setdefault(fields[0], {'uid': int(fields[2]), 'gid': int(fields[3]), 'gecos': fields[4],
+                                             'home': fields[5], 'shell': fields[6]})
+        for fields in _read_colon_file(os.path.join(root, 'etc/group')):
+            if len(fields) >= 4:
+                groups.setdefault(fields[0], {'gid': int(fields[2]),
+                                              'members': set(m for m in fields[3].split(',') if m)})
+    return {'users': users, 'groups': groups}
+
+def load_accounts(root='/'):
+    # Index of users and groups under root, rebuilt only when /etc/passwd or /etc/group change
+    paths = [os.path.join(root, 'etc/passwd'), os.path.join(root, 'etc/group')]
+    stamps = [file_stamp(path) for path in paths]
+    cached = _cache.get(root)
+    if cached and cached[0] == stamps:
+        return cached[1]
+    try:
+        index = _build(root)
+    except OSError:
+        index = {'users': {}, 'groups': {}}
+    _cache[root] = (stamps, index)
+    return index
+
+def user_exists(name, root='/'):
+    return name in load_accounts(root)['users']
+
+def user_info(name, root='/'):
+    return load_accounts(root)['users'].get(name)
+
+def home_of(name, root='/'):
+    info = user_info(name, root)
+    return info['home'] if info else os.path.join('/home', name)
+
+def group_members(group, root='/'):
+    entry = load_accounts(root)['groups'].get(group)
+    return set(entry['members']) if entry else set()
+
+def in_group(name, group, root='/'):
+    index = load_accounts(root)
+    entry = index['groups'].get(group)
+    if entry is None:
+        return False
+    user = index['users'].get(name)
+    return name in entry['members'] or (user is not None and user['gid'] == entry['gid'])
@@ -0,0 +1,89 @@
+import gzip
+import hashlib
+import os
+import time
+
+# Fields apt expects near the top of a stanza, everything else keeps the control file order
+LEADING_FIELDS = ('Package', 'Version', 'Architecture')
+
+def package_stanza(entry):
+    control = entry['control']
+    fields = [(key, control[key]) for key in LEADING_FIELDS if key in control]
+    fields += [(key, value) for key, value in control.items()
+               if key not in LEADING_FIELDS and key not in ('Description', 'Filename')]
+    # The repository is rooted at file:/ so Filename is the absolute path without its leading slash
+    fields += [('Filename', entry['path'].lstrip('/')), ('Size', str(entry['size'])), ('SHA256', entry['sha256'])]
+    if 'Description' in control:
+        fields.append(('Description', control['Description']))
+    return ''.join(f"{key}: {value.replace(chr(10), chr(10) + ' ')}\n" for key, value in fields)
+
+def _write_if_changed(path, data):
+    try:
+        with open(path, 'rb') as existing:
+            if existing.read() == data:
+                return False
+    except OSError:
+        pass
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as output:
+        output.write(data)
+    os.replace(temp_path, path)
+    return True
+
+def write_repository(repo_dir, entries, compress=True):
+    # Writes Packages (and Packages.gz) plus a Release file; returns True if anything changed
+    os.makedirs(repo_dir, exist_ok=True)
+    entries = sorted(entries, key=lambda e: (e['control'].get('Package', ''), e['path']))
+    packages = '\n'.join(package_stanza(entry) for entry in entries).encode()
+
+    indexes = {'Packages': packages}
+    if compress:
+        # mtime=0 keeps the compressed file byte-identical while the contents are unchanged
+        indexes['Packages.gz'] = gzip.compress(packages, mtime=0)
+
+    changed = False
+    for name, data in indexes.items():
+        changed = _write_if_changed(os.path.join(repo_dir, name), data) or changed
+    if not compress and os.path.exists(os.path.join(repo_dir, 'Packages.gz')):
+        os.remove(os.path.join(repo_dir, 'Packages.gz'))
+        changed = True
+
+    release_path = os.path.join(repo_dir, 'Release')
+    if changed or not os.path.exists(release_path):
+        checksums = ''.join(f" {hashlib.sha256(data).hexdigest()} {len(data)} {name}\n"
+                            for name, data in indexes.items())
+        date = time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())
+        # apt compares the suite of a flat repository with the directory named in the source line
+        suite = distribution(repo_dir)
+        release = f"Origin: setup-local\nLabel: setup-local\nSuite: {suite}\nDate: {date}\nSHA256:\n{checksums}"
+        _write_if_changed(release_path, release.encode())
+    return changed
+
+def distribution(repo_dir):
+    return f"{os.path.abspath(repo_dir).lstrip('/')}/"
+
+def source_line(repo_dir):
+    return f"deb [trusted=yes] file:/ {distribution(repo_dir)}\n"
+
+def register_source(repo_dir, system_parts='/etc/apt/sources.list.d'):
+    # Builds a private sources.list.d holding the system sources plus the local repository.
+    # Returns (update options, install options): the first refreshes only the local
+    # repository's lists, the second lets apt resolve against every source at once.
+    list_path = os.path.join(repo_dir, 'local.list')
+    _write_if_changed(list_path, source_line(repo_dir).encode())
+
+    parts_dir = os.path.join(repo_dir, 'sources.list.d')
+    empty_dir = os.path.join(repo_dir, 'empty.d')
+    os.makedirs(parts_dir, exist_ok=True)
+    os.makedirs(empty_dir, exist_ok=True)
+    for name in os.listdir(parts_dir):
+        os.remove(os.path.join(parts_dir, name))
+    if os.path.isdir(system_parts):
+        for name in os.listdir(system_parts):
+            os.symlink(os.path.join(system_parts, name), os.path.join(parts_dir, name))
+    os.symlink(list_path, os.path.join(parts_dir, 'setup-local.list'))
+
+    update_options = ['-o', f"Dir::Etc::SourceList={list_path}", '-o', f"Dir::Etc::SourceParts={empty_dir}",
+                      '-o', 'APT::Get::List-Cleanup=0']
+    install_options = ['-o', f"Dir::Etc::SourceParts={parts_dir}"]
+    return update_options, install_options
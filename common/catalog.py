@@ -0,0 +1,192 @@
+import bz2
+import difflib
+import gzip
+import json
+import lzma
+import os
+import subprocess
+
+from common import dpkg, executor
+from common.state import file_stamp
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Index of every package apt's lists offer: name -> (version, download size, installed
+# size in KB, section), and virtual name -> the packages providing it. Kept per list file
+# with the file's stamp, so after an apt update only the lists that changed are parsed again.
+LIST_SUFFIXES = ('_Packages', '_Packages.gz', '_Packages.xz', '_Packages.bz2', '_Packages.lz4', '_Packages.zst')
+FIELDS = ('Version', 'Size', 'Installed-Size', 'Section', 'Provides')
+# Bumped whenever the stored lists or index change shape, so older caches are parsed again
+FORMAT = 2
+APT_HELPER = '/usr/lib/apt/apt-helper'
+OPENERS = {'.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open}
+
+# (lists dir, catalog dir) -> (list stamps, Catalog), reused while no list changes
+_catalogs = {}
+
+def list_files(lists_dir):
+    try:
+        names = sorted(os.listdir(lists_dir))
+    except OSError:
+        return []
+    return [os.path.join(lists_dir, name) for name in names if name.endswith(LIST_SUFFIXES)]
+
+def read_list(path):
+    # Text of a list file in whatever compression apt stored it with
+    ext = os.path.splitext(path)[1]
+    if ext in OPENERS:
+        with OPENERS[ext](path) as list_file:
+            data = list_file.read()
+    elif ext == '.lz4' and lz4 is not None:
+        with lz4.frame.open(path) as list_file:
+            data = list_file.read()
+    elif ext in ('.lz4', '.zst'):
+        # apt-helper reads every compression apt itself can write
+        return executor.run_sync([APT_HELPER, 'cat-file', path], check=True).stdout
+    else:
+        with open(path, 'rb') as list_file:
+            data = list_file.read()
+    return data.decode('utf-8', 'replace')
+
+def parse_list(path):
+    # [[name, version, size, installed size, section, provides]] for a Packages file. Only the few
+    # fields the catalog keeps are looked at, which is much faster than dpkg.parse_control.
+    packages = []
+    fields = {}
+    for line in read_list(path).splitlines():
+        if not line:
+            if 'Package' in fields:
+                packages.append([fields['Package']] + [fields.get(f, '') for f in FIELDS])
+            fields = {}
+            continue
+        key, sep, value = line.partition(': ')
+        if sep and (key == 'Package' or key in FIELDS):
+            fields[key] = value.strip()
+    if 'Package' in fields:
+        packages.append([fields['Package']] + [fields.get(f, '') for f in FIELDS])
+    return packages
+
+def _load(path):
+    try:
+        with open(path) as stored:
+            return json.load(stored)
+    except (OSError, ValueError):
+        return {}
+
+def _save(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as stored:
+        json.dump(data, stored, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+def merge(lists):
+    # The newest version wins when several lists (pockets, architectures) carry a package.
+    # Returns (packages, provides) as the Catalog takes them.
+    packages = {}
+    for entries in lists:
+        for name, *info in entries:
+            current = packages.get(name)
+            if current is None or (current[0] != info[0] and dpkg.compare_versions(info[0], current[0]) > 0):
+                packages[name] = info
+    provides = {}
+    for name, info in packages.items():
+        for group in dpkg.parse_relations(info[4]):
+            provides.setdefault(group[0][0], set()).add(name)
+    return ({name: info[:4] for name, info in packages.items()},
+            {virtual: sorted(providers) for virtual, providers in provides.items()})
+
+def load_catalog(lists_dir, catalog_dir):
+    # The Catalog of the lists in lists_dir. catalog_dir keeps the parsed packages of each
+    # list and the merged index; only lists added or changed since are parsed again.
+    # Returns (catalog, errors) with errors as (list, reason).
+    paths = list_files(lists_dir)
+    stamps = {path: file_stamp(path) for path in paths}
+    key = (lists_dir, catalog_dir)
+    cached = _catalogs.get(key)
+    if cached and cached[0] == stamps:
+        return cached[1], []
+
+    index_path = os.path.join(catalog_dir, 'index.json')
+    index = _load(index_path)
+    errors = []
+    if index.get('format') != FORMAT or index.get('stamps') != stamps:
+        lists_cache = os.path.join(catalog_dir, 'lists')
+        os.makedirs(lists_cache, exist_ok=True)
+        lists = []
+        for path in paths:
+            list_path = os.path.join(lists_cache, f"{os.path.basename(path)}.json")
+            entry = _load(list_path)
+            if entry.get('format') != FORMAT or entry.get('stamp') != stamps[path]:
+                try:
+                    entry = {'format': FORMAT, 'stamp': stamps[path], 'packages': parse_list(path)}
+                except (OSError, EOFError, ValueError, lzma.LZMAError, subprocess.CalledProcessError) as e:
+                    errors.append((os.path.basename(path), str(e)))
+                    continue
+                _save(list_path, entry)
+            lists.append(entry['packages'])
+        # Forget the lists apt no longer has
+        for name in set(os.listdir(lists_cache)) - {f"{os.path.basename(path)}.json" for path in paths}:
+            os.remove(os.path.join(lists_cache, name))
+        packages, provides = merge(lists)
+        index = {'format': FORMAT, 'stamps': stamps, 'packages': packages, 'provides': provides}
+        if not errors:
+            _save(index_path, index)
+    catalog = Catalog(index['packages'], index['provides'])
+    _catalogs[key] = (stamps, catalog)
+    return catalog, errors
+
+class Catalog:
+    def __init__(self, packages, provides=None):
+        # packages: {name: [version, size, installed size, section]},
+        # provides: {virtual name: [providing packages]}
+        self.packages = packages
+        self.provides = provides or {}
+
+    def __len__(self):
+        return len(self.packages)
+
+    def get(self, name):
+        # {'version', 'size', 'installed_size' (bytes), 'section'} or None. Accepts name:arch
+        # and name=version like apt does.
+        info = self.packages.get(name.split('=')[0].split(':')[0])
+        if info is None:
+            return None
+        version, size, installed_size, section = info
+        return {'version': version, 'size': int(size or 0), 'installed_size': int(installed_size or 0) * 1024,
+                'section': section}
+
+    def providers(self, name):
+        # The packages providing a virtual name, [] for names nothing provides
+        return self.provides.get(name.split('=')[0].split(':')[0], [])
+
+    def suggest(self, name, limit=3):
+        # Close spellings of a name the catalog doesn't have. Only names with the same first
+        # letter and about the same length are compared, so this stays fast on a full archive.
+        name = name.split('=')[0].split(':')[0]
+        candidates = [n for n in self.packages if n[:1] == name[:1] and abs(len(n) - len(name)) <= 3]
+        matches = difflib.get_close_matches(name, candidates, limit, 0.75)
+        if len(matches) < limit:
+            # Names that merely extend it, e.g. docker -> docker.io
+            longer = sorted((n for n in self.packages if n.startswith(name) and n not in matches), key=len)
+            matches += longer[:limit - len(matches)]
+        return matches
+
+    def search(self, term, limit=20):
+        # Exact name first, then names starting with term, then names containing it,
+        # then close spellings
+        term = term.lower()
+        prefix = []
+        contains = []
+        for name in self.packages:
+            if name.startswith(term):
+                prefix.append(name)
+            elif term in name:
+                contains.append(name)
+        results = sorted(prefix, key=lambda n: (n != term, len(n), n)) + sorted(contains, key=lambda n: (len(n), n))
+        if len(results) < limit:
+            results += [n for n in self.suggest(term, limit) if n not in results]
+        return results[:limit]
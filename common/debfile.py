@@ -0,0 +1,136 @@
+import hashlib
+import io
+import json
+import os
+import subprocess
+import tarfile
+
+from common import executor
+from common.dpkg import compare_versions, parse_control
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+def ar_members(deb_file):
+    # Yields (name, size) for each member and leaves the file positioned at its data
+    if deb_file.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError("not a Debian package (bad ar header)")
+    while True:
+        header = deb_file.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+        name = header[:16].decode('ascii', 'replace').strip().rstrip('/')
+        size = int(header[48:58].decode('ascii').strip())
+        start = deb_file.tell()
+        yield name, size
+        # Members are padded to an even offset
+        deb_file.seek(start + size + (size % 2))
+
+def _control_from_tar(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as control_tar:
+        for member in control_tar.getmembers():
+            if member.name in ('control', './control'):
+                return control_tar.extractfile(member).read().decode('utf-8', 'replace')
+    raise ValueError("control.tar has no control file")
+
+def read_control(path):
+    # Returns the control fields of a .deb without unpacking it or starting dpkg
+    with open(path, 'rb') as deb_file:
+        for name, size in ar_members(deb_file):
+            if not name.startswith('control.tar'):
+                continue
+            data = deb_file.read(size)
+            if name.endswith('.zst'):
+                # tarfile cannot read zstd, use the zstandard module or fall back to dpkg-deb
+                if zstandard is None:
+                    control = executor.run_sync(['dpkg-deb', '--field', path], check=True).stdout
+                    return parse_control(control)[0]
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+            stanzas = parse_control(_control_from_tar(data))
+            if not stanzas:
+                raise ValueError("empty control file")
+            return stanzas[0]
+    raise ValueError("no control member found")
+
+# (path, size, mtime_ns) -> index entry, shared by every scan in this process
+_entry_cache = {}
+
+def file_key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as deb_file:
+        for chunk in iter(lambda: deb_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_index(index_path):
+    try:
+        with open(index_path) as index_file:
+            entries = json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+    for entry in entries:
+        _entry_cache[(entry['path'], entry['size'], entry['mtime_ns'])] = entry
+    return {entry['path']: entry for entry in entries}
+
+def save_index(index_path, entries):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, 'w') as index_file:
+        json.dump(entries, index_file)
+    os.replace(temp_path, index_path)
+
+def index_entry(path):
+    # Control fields and sha256 of a .deb, only reopening the archive when its size or mtime changed
+    key = file_key(path)
+    entry = _entry_cache.get(key)
+    if entry is None:
+        entry = {'path': key[0], 'size': key[1], 'mtime_ns': key[2],
+                 'control': read_control(path), 'sha256': sha256sum(path)}
+        _entry_cache[key] = entry
+    return entry
+
+def scan_directory(deb_dir, index_path):
+    # Returns (entries, errors) for every .deb in deb_dir, persisting the index when it changes
+    previous = load_index(index_path)
+    entries = []
+    errors = []
+    for filename in sorted(os.listdir(deb_dir)):
+        if not filename.endswith('.deb'):
+            continue
+        path = os.path.join(deb_dir, filename)
+        try:
+            entries.append(index_entry(path))
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            errors.append((filename, str(e)))
+
+    current = {entry['path']: entry for entry in entries}
+    if current.keys() != previous.keys() or any(previous[p] is not e for p, e in current.items()):
+        save_index(index_path, entries)
+    return entries, errors
+
+def newest_versions(entries):
+    # Keep the newest version per (package, architecture); returns (offered, superseded)
+    newest = {}
+    superseded = []
+    for entry in entries:
+        control = entry['control']
+        key = (control.get('Package'), control.get('Architecture'))
+        current = newest.get(key)
+        if current is None:
+            newest[key] = entry
+        elif compare_versions(control.get('Version', '0'), current['control'].get('Version', '0')) > 0:
+            superseded.append(current)
+            newest[key] = entry
+        else:
+            superseded.append(entry)
+    offered = [entry for entry in entries if entry in newest.values()]
+    return offered, superseded
@@ -0,0 +1,122 @@
+import collections
+import re
+
+from common import dpkg
+
+# What removing packages takes along, worked out from the installed packages without
+# asking apt: the packages whose dependencies break (apt remove removes them too) and the
+# automatically installed ones nothing needs anymore (apt autoremove removes those).
+
+Node = collections.namedtuple('Node', 'version installed_size depends recommends suggests provides essential required')
+
+class DependencyGraph:
+    # keep_recommends, keep_suggests and never_autoremove (regular expressions) follow apt's
+    # APT::AutoRemove::RecommendsImportant, ::SuggestsImportant and APT::NeverAutoRemove
+    def __init__(self, keep_recommends=True, keep_suggests=True, never_autoremove=()):
+        self.keep_recommends = keep_recommends
+        self.keep_suggests = keep_suggests
+        self.never_autoremove = [re.compile(pattern) for pattern in never_autoremove]
+        self.packages = {}
+        # name (real or virtual) -> installed packages with a Depends/Pre-Depends
+        # alternative naming it
+        self.reverse = collections.defaultdict(set)
+        # virtual name -> installed packages providing it
+        self.providers = collections.defaultdict(set)
+        self.auto = set()
+        self._status = None
+
+    def _add(self, name, fields):
+        depends = dpkg.parse_relations(fields.get('Pre-Depends', '')) + dpkg.parse_relations(fields.get('Depends', ''))
+        recommends = dpkg.parse_relations(fields.get('Recommends', ''))
+        suggests = dpkg.parse_relations(fields.get('Suggests', ''))
+        provides = [group[0][0] for group in dpkg.parse_relations(fields.get('Provides', ''))]
+        # apt refuses to remove these without extra confirmation and never autoremoves them
+        essential = any(fields.get(field) == 'yes' for field in ('Essential', 'Important', 'Protected'))
+        # apt autoremove also leaves required-priority packages alone
+        required = essential or fields.get('Priority') == 'required'
+        node = Node(fields.get('Version'), int(fields.get('Installed-Size') or 0) * 1024, depends, recommends,
+                    suggests, provides, essential, required)
+        self.packages[name] = node
+        for group in depends:
+            for dependency, _, _ in group:
+                self.reverse[dependency].add(name)
+        for virtual in provides:
+            self.providers[virtual].add(name)
+
+    def _remove(self, name):
+        node = self.packages.pop(name)
+        for group in node.depends:
+            for dependency, _, _ in group:
+                self.reverse[dependency].discard(name)
+        for virtual in node.provides:
+            self.providers[virtual].discard(name)
+
+    def update(self, status, auto=()):
+        # Brings the graph in line with a dpkg.load_status() result, touching only the
+        # packages that were installed, removed or changed version since the last update
+        if status is self._status:
+            self.auto = set(auto) & set(self.packages)
+            return
+        installed = {name: fields for name, fields in status.items() if dpkg.package_state(fields) == 'installed'}
+        for name in [n for n in self.packages if n not in installed]:
+            self._remove(name)
+        for name, fields in installed.items():
+            node = self.packages.get(name)
+            if node is not None and node.version == fields.get('Version'):
+                continue
+            if node is not None:
+                self._remove(name)
+            self._add(name, fields)
+        self.auto = set(auto) & set(self.packages)
+        self._status = status
+
+    def _satisfied(self, group, gone):
+        for name, op, version in group:
+            node = self.packages.get(name)
+            if node is not None and name not in gone and dpkg.version_satisfies(node.version, op, version):
+                return True
+            # Versioned dependencies on virtual packages are rare; any provider counts
+            if any(provider not in gone for provider in self.providers.get(name, ())):
+                return True
+        return False
+
+    def removal(self, names):
+        # Returns (removed, autoremoved). removed maps every package apt remove takes out to
+        # the package whose removal broke it (None for the ones asked for); autoremoved are
+        # the automatically installed packages nothing left installed needs.
+        removed = {name: None for name in names if name in self.packages}
+        queue = list(removed)
+        while queue:
+            name = queue.pop()
+            affected = set(self.reverse.get(name, ()))
+            for virtual in self.packages[name].provides:
+                affected |= self.reverse.get(virtual, set())
+            for dependent in affected:
+                if dependent in removed:
+                    continue
+                if not all(self._satisfied(group, removed) for group in self.packages[dependent].depends):
+                    removed[dependent] = name
+                    queue.append(dependent)
+
+        # Everything reachable from a manually installed or required package stays
+        needed = set()
+        stack = [name for name, node in self.packages.items() if name not in removed and
+                 (name not in self.auto or node.required or any(p.search(name) for p in self.never_autoremove))]
+        while stack:
+            name = stack.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            node = self.packages[name]
+            groups = node.depends + (node.recommends if self.keep_recommends else []) + \
+                (node.suggests if self.keep_suggests else [])
+            for group in groups:
+                for dependency, _, _ in group:
+                    for candidate in [dependency] + sorted(self.providers.get(dependency, ())):
+                        if candidate in self.packages and candidate not in removed and candidate not in needed:
+                            stack.append(candidate)
+        autoremoved = sorted(name for name in self.packages if name not in removed and name not in needed)
+        return removed, autoremoved
+
+    def size_of(self, names):
+        return sum(self.packages[name].installed_size for name in names if name in self.packages)
@@ -0,0 +1,219 @@
+import os
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+# apt's record of which packages were only installed as dependencies
+EXTENDED_STATES = '/var/lib/apt/extended_states'
+
+# path -> ((inode, size, mtime_ns), packages)
+_status_cache = {}
+# path -> ((inode, size, mtime_ns), names)
+_auto_cache = {}
+
+def parse_control(text):
+    # Parse RFC 822 style control data (dpkg status, .deb control, Packages files) into a list of dicts
+    stanzas = []
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if not line.strip():
+            if fields:
+                stanzas.append(fields)
+            fields = {}
+            key = None
+        elif line[0] in ' \t':
+            if key is not None:
+                fields[key] += '\n' + line[1:]
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            fields[key] = value.strip()
+    if fields:
+        stanzas.append(fields)
+    return stanzas
+
+def parse_relations(value):
+    # "a (>= 1.0) | b, c:any" -> [[('a', '>=', '1.0'), ('b', None, None)], [('c', None, None)]]
+    relations = []
+    for group in value.split(','):
+        alternatives = []
+        for alternative in group.split('|'):
+            alternative = alternative.strip()
+            if not alternative:
+                continue
+            op = version = None
+            if '(' in alternative:
+                name, constraint = alternative.split('(', 1)
+                constraint = constraint.rstrip(')').strip()
+                for candidate in ('<<', '<=', '>=', '>>', '=', '<', '>'):
+                    if constraint.startswith(candidate):
+                        op, version = candidate, constraint[len(candidate):].strip()
+                        break
+            else:
+                name = alternative
+            name = name.split('[')[0].split('<')[0].strip()
+            alternatives.append((name.split(':')[0], op, version))
+        if alternatives:
+            relations.append(alternatives)
+    return relations
+
+def package_state(fields):
+    # The last word of "Status: install ok installed"
+    status = fields.get('Status', '').split()
+    return status[-1] if status else 'not-installed'
+
+def load_status(path=DPKG_STATUS):
+    # Returns {name: fields} for every package dpkg knows about, re-parsed only when the file changes
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _status_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with open(path, encoding='utf-8', errors='replace') as status_file:
+        stanzas = parse_control(status_file.read())
+
+    packages = {}
+    for fields in stanzas:
+        name = fields.get('Package')
+        if not name:
+            continue
+        # Multi-arch packages appear once per architecture, prefer an installed entry
+        if name not in packages or package_state(fields) == 'installed':
+            packages[name] = fields
+    _status_cache[path] = (signature, packages)
+    return packages
+
+def auto_installed(path=EXTENDED_STATES):
+    # Names apt marked as automatically installed, the candidates for autoremove
+    try:
+        st = os.stat(path)
+    except OSError:
+        return set()
+    signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _auto_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(path, encoding='utf-8', errors='replace') as states_file:
+        names = {fields['Package'] for fields in parse_control(states_file.read())
+                 if fields.get('Auto-Installed') == '1' and 'Package' in fields}
+    _auto_cache[path] = (signature, names)
+    return names
+
+def installed_packages(path=DPKG_STATUS):
+    return {name: fields for name, fields in load_status(path).items() if package_state(fields) == 'installed'}
+
+def is_installed(name, path=DPKG_STATUS):
+    fields = load_status(path).get(name.split(':')[0])
+    return fields is not None and package_state(fields) == 'installed'
+
+def installed_version(name, path=DPKG_STATUS):
+    fields = load_status(path).get(name.split(':')[0])
+    if fields is None or package_state(fields) != 'installed':
+        return None
+    return fields.get('Version')
+
+def state_of(name, path=DPKG_STATUS):
+    fields = load_status(path).get(name.split(':')[0])
+    return package_state(fields) if fields else 'not-installed'
+
+def _order(char):
+    if char.isdigit():
+        return 0
+    elif char.isalpha():
+        return ord(char)
+    elif char == '~':
+        return -1
+    return ord(char) + 256
+
+def _compare_fragment(a, b):
+    # dpkg's verrevcmp: alternating non-digit and digit runs, '~' sorts before everything
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        first_diff = 0
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+def _split_version(version):
+    # The epoch ends at the first colon; later ones belong to the upstream version
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '0')
+    return int(epoch) if epoch.isdigit() else 0, upstream, revision
+
+def compare_versions(a, b):
+    # Negative, zero or positive like cmp(), following Debian version ordering
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _compare_fragment(a_upstream, b_upstream) or _compare_fragment(a_revision, b_revision)
+
+def version_satisfies(version, op, required):
+    if op is None:
+        return True
+    if version is None:
+        return False
+    result = compare_versions(version, required)
+    if op == '<<':
+        return result < 0
+    elif op in ('<=', '<'):
+        return result <= 0
+    elif op == '=':
+        return result == 0
+    elif op in ('>=', '>'):
+        return result >= 0
+    elif op == '>>':
+        return result > 0
+    return False
+
+def provided_by(packages):
+    # {virtual name: [(provider, provided version or None)]} for a {name: fields} mapping
+    provides = {}
+    for name, fields in packages.items():
+        for group in parse_relations(fields.get('Provides', '')):
+            virtual, _, version = group[0]
+            provides.setdefault(virtual, []).append((name, version))
+    return provides
+
+def unsatisfied_relations(fields, available, provides=None):
+    # Depends/Pre-Depends groups of fields that no package in available ({name: fields}) satisfies
+    if provides is None:
+        provides = provided_by(available)
+    missing = []
+    for field in ('Pre-Depends', 'Depends'):
+        for group in parse_relations(fields.get(field, '')):
+            satisfied = False
+            for name, op, version in group:
+                candidate = available.get(name)
+                if candidate is not None and version_satisfies(candidate.get('Version'), op, version):
+                    satisfied = True
+                elif any(version_satisfies(provided, op, version) if provided else op is None
+                         for _, provided in provides.get(name, [])):
+                    satisfied = True
+                if satisfied:
+                    break
+            if not satisfied:
+                missing.append(group)
+    return missing
@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import os
+import subprocess
+import threading
+import time
+
+from common import trace
+
+CommandResult = collections.namedtuple('CommandResult', 'command returncode stdout stderr duration')
+
+# How many commands may run at once, and the default per-command timeout in seconds (none if unset)
+DEFAULT_LIMIT = int(os.environ.get('SETUP_JOBS', min(32, (os.cpu_count() or 1) + 4)))
+DEFAULT_TIMEOUT = float(os.environ['SETUP_COMMAND_TIMEOUT']) if os.environ.get('SETUP_COMMAND_TIMEOUT') else None
+# How long to wait for a dpkg or passwd lock held by another process before giving up, in seconds
+LOCK_TIMEOUT = int(os.environ.get('SETUP_LOCK_TIMEOUT', 300))
+
+class Slots:
+    # A semaphore for the whole process. run_sync() starts a new event loop for every call
+    # and scheduler jobs call it from several threads at once, so anything per loop (an
+    # asyncio.Semaphore) would only hold within one call. Waiters are served in order.
+    def __init__(self, count):
+        self._count = count
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        with self._lock:
+            if self._count > 0 and not self._waiters:
+                self._count -= 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # Cancelled as the slot was handed over; _wake passes on a cancelled waiter's slot
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                try:
+                    waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+                    return
+                except RuntimeError:
+                    # Its event loop has been closed
+                    continue
+            self._count += 1
+
+    def _wake(self, waiter):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+class CommandLock(Slots):
+    # Serializes commands that share one resource, such as the dpkg database or the passwd
+    # files, across all threads
+    def __init__(self, name):
+        super().__init__(1)
+        self.name = name
+
+DPKG_LOCK = CommandLock('dpkg')
+PASSWD_LOCK = CommandLock('passwd')
+
+class Executor:
+    def __init__(self, limit=DEFAULT_LIMIT, timeout=DEFAULT_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = Slots(limit)
+
+    async def _read_lines(self, stream, lines, on_line):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace')
+            lines.append(line)
+            if on_line is not None:
+                on_line(line)
+
+    async def _execute(self, command, input, timeout, on_line):
+        started = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdin=subprocess.PIPE if input is not None else None,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            trace.command(command, 127, started, time.monotonic() - started, '', str(e))
+            return CommandResult(command, 127, '', str(e), time.monotonic() - started)
+
+        stdout_lines = []
+        stderr_lines = []
+
+        async def communicate():
+            if input is not None:
+                process.stdin.write(input.encode() if isinstance(input, str) else input)
+                await process.stdin.drain()
+                process.stdin.close()
+            await asyncio.gather(self._read_lines(process.stdout, stdout_lines, on_line),
+                                 self._read_lines(process.stderr, stderr_lines, None))
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            stderr_lines.append(f"Timed out after {timeout} seconds\n")
+            returncode = -9
+        result = CommandResult(command, returncode, ''.join(stdout_lines), ''.join(stderr_lines),
+                               time.monotonic() - started)
+        trace.command(command, returncode, started, result.duration, result.stdout, result.stderr)
+        return result
+
+    async def run(self, command, input=None, timeout=None, lock=None, on_line=None, check=False):
+        # Runs one command, streaming stdout lines to on_line as they arrive
+        timeout = timeout if timeout is not None else self.timeout
+        async with self._slots:
+            if lock is not None:
+                async with lock:
+                    result = await self._execute(command, input, timeout, on_line)
+            else:
+                result = await self._execute(command, input, timeout, on_line)
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+        return result
+
+    async def run_all(self, commands, **kwargs):
+        # Independent commands overlap up to the concurrency limit; results keep the input order
+        return await asyncio.gather(*(self.run(command, **kwargs) for command in commands))
+
+default_executor = Executor()
+
+def run_sync(command, **kwargs):
+    return asyncio.run(default_executor.run(command, **kwargs))
+
+def run_many(commands, **kwargs):
+    return asyncio.run(default_executor.run_all(commands, **kwargs))
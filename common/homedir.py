@@ -0,0 +1,384 @@
+import argparse
+import concurrent.futures
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import sshkeys
+
+# This module only uses the standard library and common/sshkeys.py so that it can be run
+# on its own under sudo:
+#   sudo python3 common/homedir.py build --skel /etc/skel --login-defs /etc/login.defs alice:1001:1001:/home/alice ...
+#   sudo python3 common/homedir.py keys < entries.json
+#   sudo python3 common/homedir.py trash --purge /home/alice /home/bob
+#   sudo python3 common/homedir.py purge --rate 2000 /home/.setup-trash
+
+FICLONE = 0x40049409
+# Skeleton files up to this size are kept in memory and written straight into each home
+INLINE_LIMIT = 64 * 1024
+# Deleted homes are renamed into this directory next to them and removed in the background
+TRASH_NAME = '.setup-trash'
+PROGRESS_FILE = '.progress.json'
+LOCK_FILE = '.purge.lock'
+# Entries removed per second by the background purge, 0 for no limit
+PURGE_RATE = int(os.environ.get('SETUP_PURGE_RATE', '2000'))
+LOGIN_DEFS = '/etc/login.defs'
+
+def login_defs_home_mode(path=LOGIN_DEFS, default=0o750):
+    # useradd creates homes with HOME_MODE (or UMASK) from login.defs, follow the same setting
+    settings = {}
+    try:
+        with open(path) as login_defs:
+            for line in login_defs:
+                fields = line.split()
+                if len(fields) >= 2 and not fields[0].startswith('#'):
+                    settings[fields[0]] = fields[1]
+    except OSError:
+        return default
+    if 'HOME_MODE' in settings:
+        return int(settings['HOME_MODE'], 8)
+    if 'UMASK' in settings:
+        return 0o777 & ~int(settings['UMASK'], 8)
+    return default
+
+# skel path -> (signature of the skel tree, entries)
+_snapshots = {}
+
+def skel_snapshot(skel):
+    # One walk over skel: (relative path, kind, mode, data or link target or source path).
+    # The walk only stats; file contents are read again when any entry's stat changed.
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(skel):
+        dirnames.sort()
+        for name in sorted(dirnames) + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            stats.append((path, os.lstat(path)))
+    signature = [(path, st.st_ino, st.st_mode, st.st_size, st.st_mtime_ns) for path, st in stats]
+    cached = _snapshots.get(skel)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    entries = []
+    for path, st in stats:
+        relative = os.path.relpath(path, skel)
+        if stat.S_ISLNK(st.st_mode):
+            entries.append((relative, 'link', 0, os.readlink(path)))
+        elif stat.S_ISDIR(st.st_mode):
+            entries.append((relative, 'dir', stat.S_IMODE(st.st_mode), None))
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_size <= INLINE_LIMIT:
+                with open(path, 'rb') as skel_file:
+                    entries.append((relative, 'data', stat.S_IMODE(st.st_mode), skel_file.read()))
+            else:
+                entries.append((relative, 'file', stat.S_IMODE(st.st_mode), path))
+    _snapshots[skel] = (signature, entries)
+    return entries
+
+def copy_into(source_path, fd):
+    # Share extents where the filesystem can (btrfs, xfs), else copy in the kernel, else in Python
+    with open(source_path, 'rb') as source:
+        try:
+            fcntl.ioctl(fd, FICLONE, source.fileno())
+            return
+        except OSError:
+            pass
+        try:
+            while os.copy_file_range(source.fileno(), fd, 1 << 30):
+                pass
+            return
+        except (AttributeError, OSError):
+            source.seek(0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+        with os.fdopen(os.dup(fd), 'wb') as target:
+            shutil.copyfileobj(source, target)
+
+def build_home(entries, home, uid, gid, home_mode=0o750):
+    # Creates home and the skeleton inside it with the final owner and mode set as each entry
+    # is created. Existing entries are left as they are.
+    if not os.path.isdir(home):
+        os.makedirs(os.path.dirname(home), exist_ok=True)
+        os.mkdir(home, home_mode)
+        os.chmod(home, home_mode)
+    os.chown(home, uid, gid)
+
+    for relative, kind, mode, payload in entries:
+        target = os.path.join(home, relative)
+        if os.path.lexists(target):
+            continue
+        if kind == 'dir':
+            os.mkdir(target, mode)
+            os.chown(target, uid, gid)
+            os.chmod(target, mode)
+        elif kind == 'link':
+            os.symlink(payload, target)
+            os.lchown(target, uid, gid)
+        else:
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            try:
+                os.fchown(fd, uid, gid)
+                if kind == 'data':
+                    os.write(fd, payload)
+                else:
+                    copy_into(payload, fd)
+                os.fchmod(fd, mode)
+            finally:
+                os.close(fd)
+
+def build_homes(specs, skel='/etc/skel', workers=8, login_defs=LOGIN_DEFS):
+    # specs: iterable of (home, uid, gid). Returns [(home, error or None)]. skel and
+    # login_defs are those of the system the homes are for.
+    entries = skel_snapshot(skel)
+    home_mode = login_defs_home_mode(login_defs)
+
+    def build(spec):
+        home, uid, gid = spec
+        try:
+            build_home(entries, home, uid, gid, home_mode)
+            return home, None
+        except OSError as e:
+            return home, str(e)
+
+    specs = list(specs)
+    if not specs:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(specs))) as pool:
+        return list(pool.map(build, specs))
+
+def install_keys(home, uid, gid, add=(), revoke=(), exclusive=False, private_key=None):
+    # Merges the keys into ~/.ssh/authorized_keys like sshkeys.update_authorized_keys and moves
+    # a generated keypair (private_key and the .pub next to it) into ~/.ssh, all owned by the
+    # account and with the modes sshd expects. Returns the authorized_keys path.
+    ssh_dir = os.path.join(home, '.ssh')
+    try:
+        os.mkdir(ssh_dir, 0o700)
+    except FileExistsError:
+        pass
+    # The account owns .ssh and everything in it, and could swap any of it for a link to a
+    # file only root may touch: all of it is reached through this descriptor, and links
+    # are refused or replaced, never followed
+    try:
+        dir_fd = os.open(ssh_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError as e:
+        if e.errno in (errno.ELOOP, errno.ENOTDIR):
+            raise OSError(e.errno, f"{ssh_dir} is not a directory")
+        raise
+    try:
+        os.fchown(dir_fd, uid, gid)
+        os.fchmod(dir_fd, 0o700)
+        sshkeys.update_authorized_keys('authorized_keys', add, revoke, exclusive, uid, gid, 0o600, dir_fd)
+        if private_key:
+            name = os.path.basename(private_key)
+            for source, target, mode in ((private_key, name, 0o600), (f"{private_key}.pub", f"{name}.pub", 0o644)):
+                with open(source, 'rb') as key_file:
+                    sshkeys.replace_file(target, key_file.read(), mode, uid, gid, dir_fd)
+            shutil.rmtree(os.path.dirname(private_key), ignore_errors=True)
+    finally:
+        os.close(dir_fd)
+    return os.path.join(ssh_dir, 'authorized_keys')
+
+def install_all_keys(entries):
+    # entries: dicts of install_keys arguments, one per account. Returns {home: error}
+    # for the ones that failed.
+    errors = {}
+    for entry in entries:
+        try:
+            install_keys(**entry)
+        except OSError as e:
+            errors[entry['home']] = str(e)
+    return errors
+
+def trash_dir(home):
+    # On the same filesystem as home, so moving a home into it is a rename
+    return os.path.join(os.path.dirname(os.path.abspath(home)), TRASH_NAME)
+
+def trash_home(home):
+    # Renames home into the trash and returns the new path. Returns None when home does
+    # not exist; raises OSError when it cannot be renamed (e.g. it is a mount point).
+    trash = trash_dir(home)
+    os.makedirs(trash, exist_ok=True)
+    # Not listable, but the progress and lock files can be read without root
+    os.chmod(trash, 0o711)
+    target = os.path.join(trash, f"{os.path.basename(home)}-{uuid.uuid4().hex[:8]}")
+    try:
+        os.rename(home, target)
+    except FileNotFoundError:
+        return None
+    return target
+
+def start_purge(trash, rate=PURGE_RATE):
+    # Starts purge in a detached process at idle I/O priority, so the caller can return
+    # (or exit) while it runs; raises OSError when it cannot be started. Returns the command.
+    command = ['nice', '-n', '19', sys.executable, os.path.abspath(__file__), 'purge', '--rate', str(rate), trash]
+    if shutil.which('ionice'):
+        command = ['ionice', '-c', '3'] + command
+    subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+    return command
+
+def purge_running(trash):
+    # A running purge holds the lock on LOCK_FILE for as long as it runs
+    try:
+        lock = open(os.path.join(trash, LOCK_FILE))
+    except OSError:
+        return False
+    try:
+        fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        lock.close()
+
+def write_progress(trash, progress):
+    temp_path = os.path.join(trash, f"{PROGRESS_FILE}.tmp")
+    with open(temp_path, 'w') as progress_file:
+        json.dump(progress, progress_file)
+    os.replace(temp_path, os.path.join(trash, PROGRESS_FILE))
+
+def read_progress(trash):
+    # {'total', 'removed', 'done', 'started', 'updated'} as last written by purge, or None
+    try:
+        with open(os.path.join(trash, PROGRESS_FILE)) as progress_file:
+            return json.load(progress_file)
+    except (OSError, ValueError):
+        return None
+
+def purge(trash, rate=PURGE_RATE):
+    # Deletes everything in the trash directory, at most rate entries per second, and keeps
+    # PROGRESS_FILE up to date. Only one purge runs per trash directory; a second one
+    # returns False at once and leaves the work (including newly trashed homes) to the first.
+    lock = open(os.path.join(trash, LOCK_FILE), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return False
+    try:
+        progress = {'total': 0, 'removed': 0, 'done': False, 'started': time.time()}
+        while True:
+            trees = [os.path.join(trash, name) for name in os.listdir(trash)
+                     if name not in (LOCK_FILE, PROGRESS_FILE, f"{PROGRESS_FILE}.tmp")]
+            if not trees:
+                break
+            for tree in trees:
+                progress['total'] += 1 + sum(len(dirs) + len(files) for _, dirs, files in os.walk(tree))
+            progress['updated'] = time.time()
+            write_progress(trash, progress)
+            for tree in trees:
+                _purge_tree(tree, progress, trash, rate)
+        progress['done'] = True
+        progress['updated'] = time.time()
+        write_progress(trash, progress)
+    finally:
+        lock.close()
+    return True
+
+def _purge_tree(tree, progress, trash, rate):
+    started = time.monotonic()
+    removed = 0
+    last_report = 0
+
+    def throttle():
+        nonlocal removed, last_report
+        removed += 1
+        progress['removed'] += 1
+        if rate and removed % 100 == 0:
+            # Sleep off whatever is ahead of the allowed rate
+            ahead = removed / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+        if time.monotonic() - last_report >= 1:
+            last_report = time.monotonic()
+            progress['updated'] = time.time()
+            write_progress(trash, progress)
+
+    if not os.path.isdir(tree) or os.path.islink(tree):
+        os.unlink(tree)
+        throttle()
+        return
+    for root, dirs, files in os.walk(tree, topdown=False):
+        for name in files:
+            try:
+                os.unlink(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+            throttle()
+        for name in dirs:
+            path = os.path.join(root, name)
+            try:
+                # Symlinks to directories are listed in dirs but removed like files
+                os.unlink(path) if os.path.islink(path) else os.rmdir(path)
+            except FileNotFoundError:
+                pass
+            throttle()
+    os.rmdir(tree)
+    throttle()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home directory helper for the Ubuntu user tool")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help="create home directories from a skeleton")
+    build_parser.add_argument('--skel', default='/etc/skel')
+    build_parser.add_argument('--login-defs', default=LOGIN_DEFS, help="login.defs giving the mode of new homes")
+    build_parser.add_argument('--workers', type=int, default=8)
+    build_parser.add_argument('specs', nargs='+', metavar='user:uid:gid:home')
+    commands.add_parser('keys', help="install SSH keys, given as a JSON list of install_keys arguments on stdin")
+    trash_parser = commands.add_parser('trash', help="move home directories into the trash")
+    trash_parser.add_argument('--purge', action='store_true', help="start a background purge of each trash used")
+    trash_parser.add_argument('--rate', type=int, default=PURGE_RATE, help="entries per second for the purge")
+    trash_parser.add_argument('homes', nargs='+')
+    purge_parser = commands.add_parser('purge', help="delete the contents of a trash directory")
+    purge_parser.add_argument('--rate', type=int, default=PURGE_RATE, help="entries per second, 0 for no limit")
+    purge_parser.add_argument('trash')
+    args = parser.parse_args(argv)
+
+    failed = False
+    if args.command == 'build':
+        specs = []
+        for spec in args.specs:
+            _, uid, gid, home = spec.split(':', 3)
+            specs.append((home, int(uid), int(gid)))
+        for home, error in build_homes(specs, args.skel, args.workers, args.login_defs):
+            if error:
+                print(f"{home}: {error}", file=sys.stderr)
+                failed = True
+    elif args.command == 'keys':
+        # Prints "home<TAB>error" per account whose keys could not be installed
+        for home, error in install_all_keys(json.load(sys.stdin)).items():
+            print(f"{home}\t{error}")
+            failed = True
+    elif args.command == 'trash':
+        # Prints "home<TAB>trashed path" per home, an empty path when it did not exist
+        trashes = set()
+        for home in args.homes:
+            try:
+                path = trash_home(home)
+            except OSError as e:
+                print(f"{home}: {e}", file=sys.stderr)
+                failed = True
+                continue
+            print(f"{home}\t{path or ''}")
+            if path:
+                trashes.add(os.path.dirname(path))
+        for trash in sorted(trashes) if args.purge else []:
+            try:
+                start_purge(trash, args.rate)
+            except OSError as e:
+                print(f"Could not start the purge of {trash}: {e}", file=sys.stderr)
+                failed = True
+    elif args.command == 'purge':
+        purge(args.trash, args.rate)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from common import state
+
+# Append-only record of long operations, so a batch cut short by a crash, a reboot or
+# Ctrl+C can be picked up with 'setup.py resume' instead of being redone from scratch.
+# Each line is one JSON event: a batch begins (with what it was started from), operations
+# record their intent and then done or failed, and the batch ends. Ended batches are
+# dropped when the journal is compacted.
+JOURNAL_FILE = os.path.join(state.CACHE_DIR, 'journal.jsonl')
+
+_lock = threading.Lock()
+# Batch operations are being recorded for, None outside a batch
+_active = None
+
+def _append(record):
+    record['time'] = time.time()
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _lock:
+        os.makedirs(os.path.dirname(JOURNAL_FILE), exist_ok=True)
+        fd = os.open(JOURNAL_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # One write per event and synced before the operation goes ahead
+            os.write(fd, line.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def read():
+    # All events in order; a line torn by a crash mid-write is skipped
+    events = []
+    try:
+        with open(JOURNAL_FILE) as journal_file:
+            for line in journal_file:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return events
+
+def begin(source, root='/'):
+    global _active
+    batch = uuid.uuid4().hex[:12]
+    _append({'batch': batch, 'event': 'begin', 'source': source, 'root': root})
+    _active = batch
+    return batch
+
+def reopen(batch):
+    # Records the operations of a resumed batch under its original id
+    global _active
+    _active = batch
+
+def intent(op):
+    if _active:
+        _append({'batch': _active, 'event': 'intent', 'op': op})
+
+def done(op):
+    if _active:
+        _append({'batch': _active, 'event': 'done', 'op': op})
+
+def failed(op, reason):
+    if _active:
+        _append({'batch': _active, 'event': 'failed', 'op': op, 'reason': str(reason)})
+
+def end(batch=None):
+    global _active
+    batch = batch or _active
+    _append({'batch': batch, 'event': 'end'})
+    if batch == _active:
+        _active = None
+    compact()
+
+@contextlib.contextmanager
+def batch(source, root='/'):
+    # Journals the block as one batch. A batch already running takes the operations
+    # instead; an exception (or a crash) leaves the batch open for resume.
+    global _active
+    if _active:
+        yield _active
+        return
+    batch_id = begin(source, root)
+    try:
+        yield batch_id
+    except BaseException:
+        _active = None
+        raise
+    end(batch_id)
+
+def unfinished():
+    # {batch: {'source', 'root', 'started', 'ops': [operations with intent but no outcome]}}
+    # for every batch that never ended, oldest first
+    batches = {}
+    for event in read():
+        batch_id = event.get('batch')
+        if event['event'] == 'begin':
+            batches[batch_id] = {'source': event['source'], 'root': event.get('root', '/'),
+                                 'started': event['time'], 'ops': {}}
+        elif batch_id not in batches:
+            continue
+        elif event['event'] == 'intent':
+            batches[batch_id]['ops'][event['op']] = True
+        elif event['event'] in ('done', 'failed'):
+            batches[batch_id]['ops'].pop(event['op'], None)
+        elif event['event'] == 'end':
+            del batches[batch_id]
+    for info in batches.values():
+        info['ops'] = list(info['ops'])
+    return batches
+
+def compact():
+    # Rewrites the journal with only the events of batches that have not ended
+    with _lock:
+        events = read()
+        ended = {event['batch'] for event in events if event['event'] == 'end'}
+        events = [event for event in events if event.get('batch') not in ended]
+        if not events:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(JOURNAL_FILE)
+            return
+        temp_path = f"{JOURNAL_FILE}.tmp"
+        with open(temp_path, 'w') as journal_file:
+            journal_file.write(''.join(json.dumps(event, sort_keys=True) + '\n' for event in events))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, JOURNAL_FILE)
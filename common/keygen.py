@@ -0,0 +1,142 @@
+import atexit
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+
+from common import executor
+
+# Types of generated keys, offered in the menus and as key_type in manifests and user lists
+KEY_TYPES = {'rsa': "RSA 3072 (widest compatibility)", 'ed25519': "Ed25519 (much faster, short keys)",
+             'ecdsa': "ECDSA P-256"}
+# Used when neither the menu nor the manifest picks one
+KEY_TYPE = os.environ.get('SETUP_KEY_TYPE', 'rsa')
+
+def key_filename(key_type):
+    return f"id_{key_type}"
+
+def private_dir(owner):
+    # mkdtemp creates the directory 0700 with an unpredictable name
+    return tempfile.mkdtemp(prefix=f"{owner}-key-")
+
+def generate_keypair(directory, key_type=KEY_TYPE, passphrase='', comment=''):
+    # Returns (private key path, public key line); raises CalledProcessError
+    path = os.path.join(directory, key_filename(key_type))
+    command = ['ssh-keygen', '-q', '-t', key_type, '-N', passphrase, '-C', comment, '-f', path]
+    if key_type == 'rsa':
+        command[4:4] = ['-b', '3072']
+    executor.run_sync(command, input='', check=True)
+    with open(f"{path}.pub") as public_file:
+        return path, public_file.read().strip()
+
+class KeyPool:
+    # Generates passwordless keypairs in the background ahead of need: callers reserve() the
+    # keys they are going to take as soon as they know about them (a plan, a user list, the
+    # create user menu), and take() them once the accounts get created. Each worker thread
+    # drives its own ssh-keygen processes, so generation runs on up to workers CPUs.
+    def __init__(self, key_type=KEY_TYPE, workers=None):
+        self.key_type = key_type
+        self.workers = workers or os.cpu_count() or 1
+        self._stock = queue.Queue()
+        # Keys still to start, and keys being made
+        self._wanted = 0
+        self._making = 0
+        self._stopped = False
+        # Guards the counters and stocking a key, so no key is stocked after close emptied the stock
+        self._cond = threading.Condition()
+        self._threads = []
+        # At exit, wait for keys still being generated so their directories are removed too
+        atexit.register(self.close, True)
+
+    def reserve(self, count):
+        # Makes sure count keys are stocked or on their way
+        with self._cond:
+            if self._stopped:
+                return self
+            missing = count - self._stock.qsize() - self._making - self._wanted
+            if missing > 0:
+                self._wanted += missing
+                self._cond.notify_all()
+            for _ in range(min(self.workers, self._wanted + self._making) - len(self._threads)):
+                thread = threading.Thread(target=self._fill, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def _fill(self):
+        # A worker owns the directory of the key it is making until the key is stocked
+        while True:
+            with self._cond:
+                while not self._wanted and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._wanted -= 1
+                self._making += 1
+            directory = private_dir('pool')
+            try:
+                path, public_key = generate_keypair(directory, self.key_type)
+            except (OSError, subprocess.CalledProcessError):
+                path = None
+            with self._cond:
+                self._making -= 1
+                if path and not self._stopped:
+                    self._stock.put((directory, path, public_key))
+                    continue
+            # Failed, or closed while this key was being made; take() makes its own keys now
+            shutil.rmtree(directory, ignore_errors=True)
+            if not path:
+                return
+
+    def take(self, owner):
+        # Moves a stocked keypair into a fresh private directory for owner, generating one
+        # on the spot if none is ready yet. Returns (private key path, public key line).
+        try:
+            directory, path, public_key = self._stock.get_nowait()
+        except queue.Empty:
+            with self._cond:
+                # This key is made here, so the pool makes one less
+                self._wanted = max(0, self._wanted - 1)
+            return generate_keypair(private_dir(owner), self.key_type, comment=f"{owner}@{socket.gethostname()}")
+
+        target_dir = private_dir(owner)
+        target = os.path.join(target_dir, os.path.basename(path))
+        os.rename(path, target)
+        # The stocked key has no comment yet; name it after its owner in the public half
+        public_key = f"{public_key} {owner}@{socket.gethostname()}"
+        with open(f"{target}.pub", 'w') as public_file:
+            public_file.write(public_key + '\n')
+        os.remove(f"{path}.pub")
+        os.rmdir(directory)
+        return target, public_key
+
+    def close(self, wait=False):
+        # Stops the workers and deletes the stocked keys nobody took; workers remove the
+        # keys they are still making themselves. wait also waits for those workers.
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            stocked = []
+            while True:
+                try:
+                    stocked.append(self._stock.get_nowait())
+                except queue.Empty:
+                    break
+        for directory, _, _ in stocked:
+            shutil.rmtree(directory, ignore_errors=True)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+# key type -> the KeyPool every caller in this process shares
+_pools = {}
+_pools_lock = threading.Lock()
+
+def shared_pool(key_type=KEY_TYPE):
+    with _pools_lock:
+        if key_type not in _pools:
+            _pools[key_type] = KeyPool(key_type)
+        return _pools[key_type]
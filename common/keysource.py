@@ -0,0 +1,125 @@
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from common.sshkeys import parse_key_line
+from common.state import CACHE_DIR
+
+KEY_CACHE_DIR = os.path.join(CACHE_DIR, 'keys')
+# Cached keys younger than this many seconds are used without asking the server again
+KEY_CACHE_TTL = int(os.environ.get('SETUP_KEY_TTL', 3600))
+OFFLINE = os.environ.get('SETUP_OFFLINE') == '1'
+MAX_REDIRECTS = 3
+
+class KeyFetcher:
+    # Fetches public keys over kept-alive HTTP(S) connections (one pool per thread and host),
+    # with an on-disk cache revalidated through ETag/Last-Modified and an offline mode
+    def __init__(self, cache_dir=KEY_CACHE_DIR, ttl=KEY_CACHE_TTL, offline=OFFLINE, workers=8, timeout=15):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.workers = workers
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def _load_cached(self, url):
+        try:
+            with open(self._cache_path(url)) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, url, entry):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        path = self._cache_path(url)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(temp_path, path)
+
+    def _connection(self, scheme, netloc):
+        pool = self._local.__dict__.setdefault('connections', {})
+        connection = pool.get((scheme, netloc))
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connection = pool[(scheme, netloc)] = connection_class(netloc, timeout=self.timeout)
+        return connection
+
+    def _request(self, url, headers):
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        for attempt in range(2):
+            connection = self._connection(parsed.scheme, parsed.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have dropped an idle keep-alive connection; reconnect once
+                connection.close()
+                if attempt:
+                    raise
+
+    def fetch(self, url):
+        # Returns (key lines, None) or (None, reason)
+        cached = self._load_cached(url)
+        if cached and (self.offline or time.time() - cached['fetched_at'] < self.ttl):
+            return cached['keys'], None
+        if self.offline:
+            return None, "offline and no cached keys"
+
+        headers = {'User-Agent': 'setup-scripts', 'Accept': 'text/plain'}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        target = url
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                status, response_headers, body = self._request(target, headers)
+                response_headers = {k.lower(): v for k, v in response_headers}
+                if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                    target = urllib.parse.urljoin(target, response_headers['location'])
+                    continue
+                break
+        except (OSError, http.client.HTTPException) as e:
+            if cached:
+                return cached['keys'], None
+            return None, f"request failed: {e}"
+
+        if status == 304 and cached:
+            cached['fetched_at'] = time.time()
+            self._store(url, cached)
+            return cached['keys'], None
+        if status == 404:
+            return None, "account not found"
+        if status != 200:
+            return None, f"server answered {status}"
+
+        keys = [line.strip() for line in body.decode('utf-8', 'replace').splitlines() if parse_key_line(line)]
+        if not keys:
+            return None, "no valid public keys published"
+        self._store(url, {'url': url, 'fetched_at': time.time(), 'etag': response_headers.get('etag'),
+                          'last_modified': response_headers.get('last-modified'), 'keys': keys})
+        return keys, None
+
+    def fetch_many(self, urls):
+        # {url: (keys, error)}, fetching concurrently
+        urls = list(dict.fromkeys(urls))
+        if not urls:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(urls))) as pool:
+            return dict(zip(urls, pool.map(self.fetch, urls)))
+
+default_fetcher = KeyFetcher()
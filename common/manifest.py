@@ -0,0 +1,143 @@
+import collections
+import csv
+import json
+import re
+
+from common import journal, keygen, state, target
+from common.scheduler import Scheduler
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+AUTH_METHODS = ('password', 'launchpad', 'github', 'generate', 'key')
+USERNAME_RE = re.compile(r'^[a-z_][a-z0-9_-]{0,31}$')
+USER_FIELDS = ('name', 'full_name', 'admin', 'auth', 'key_user', 'key', 'key_type', 'password')
+
+def _check_list(value, name):
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"{name} must be a list of strings")
+
+def validate_user(user, idx):
+    if not isinstance(user, dict) or not user.get('name'):
+        raise ValueError(f"user {idx} needs a name")
+    if not USERNAME_RE.match(user['name']):
+        raise ValueError(f"user {idx}: {user['name']!r} is not a valid username")
+    if any(c in str(user.get('full_name', '')) for c in ':\n'):
+        raise ValueError(f"user {user['name']}: full_name may not contain ':' or newlines")
+    auth = user.get('auth')
+    if auth not in AUTH_METHODS:
+        raise ValueError(f"user {user['name']}: auth must be one of {', '.join(AUTH_METHODS)}")
+    if auth == 'password' and not user.get('password'):
+        raise ValueError(f"user {user['name']}: password authentication needs a password")
+    if '\n' in str(user.get('password', '')):
+        raise ValueError(f"user {user['name']}: password may not contain newlines")
+    if auth == 'key' and not user.get('key'):
+        raise ValueError(f"user {user['name']}: key authentication needs a key")
+    if 'key_type' in user and user['key_type'] not in keygen.KEY_TYPES:
+        raise ValueError(f"user {user['name']}: key_type must be one of {', '.join(keygen.KEY_TYPES)}")
+    if not isinstance(user.get('exclusive', False), bool):
+        raise ValueError(f"user {user['name']}: exclusive must be true or false")
+    _check_list(user.get('revoke', []), f"user {user['name']}: revoke")
+
+def validate_manifest(manifest):
+    if not isinstance(manifest.get('os', 'Ubuntu'), str):
+        raise ValueError("os must be a string")
+
+    packages = manifest.get('packages', {})
+    if not isinstance(packages, dict):
+        raise ValueError("[packages] must be a table")
+    for key in ('categories', 'install', 'debs'):
+        _check_list(packages.get(key, []), f"packages.{key}")
+
+    users = manifest.get('users', [])
+    if not isinstance(users, list):
+        raise ValueError("[[users]] must be an array of tables")
+    for idx, user in enumerate(users, 1):
+        validate_user(user, idx)
+
+def load_manifest(path):
+    # TOML manifests need Python 3.11+ (or tomli); JSON manifests with the same layout always work
+    if path.endswith('.json'):
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    else:
+        if tomllib is None:
+            raise ValueError("reading TOML needs Python 3.11+ or the 'tomli' package, use a .json manifest instead")
+        with open(path, 'rb') as manifest_file:
+            try:
+                manifest = tomllib.load(manifest_file)
+            except tomllib.TOMLDecodeError as e:
+                raise ValueError(str(e))
+    validate_manifest(manifest)
+    return manifest
+
+def load_user_list(path):
+    # A JSON array of user tables, or a CSV file with a header row using the same field names:
+    # name, full_name, admin, auth, key_user, key, key_type, password
+    with open(path, newline='') as user_file:
+        if path.endswith('.json'):
+            users = json.load(user_file)
+            if not isinstance(users, list):
+                raise ValueError("expected a JSON array of users")
+        else:
+            users = []
+            for row in csv.DictReader(user_file):
+                user = {key: value.strip() for key, value in row.items() if key in USER_FIELDS and value and value.strip()}
+                user['admin'] = user.get('admin', '').lower() in ('1', 'y', 'yes', 'true')
+                users.append(user)
+    for idx, user in enumerate(users, 1):
+        validate_user(user, idx)
+    counts = collections.Counter(user['name'] for user in users)
+    duplicates = sorted(name for name, count in counts.items() if count > 1)
+    if duplicates:
+        raise ValueError(f"duplicate users: {', '.join(duplicates)}")
+    return users
+
+# Planning and applying a manifest section, shared by the tools' plan_manifest and
+# apply_manifest. A plan is a dict with 'pending' (the number of actions), and unless that
+# is 0, 'desired' and 'watched': what was asked for and the files whose change means the
+# host may have drifted from it.
+
+def is_converged(scope, desired, watched_paths):
+    # Same request as the last successful apply and none of the watched files touched
+    # since: nothing can have drifted
+    if not state.is_converged(target.scope(scope), desired, watched_paths):
+        return False
+    print("  unchanged since the last apply, nothing to do")
+    return True
+
+def settle_plan(scope, plan):
+    if not plan['pending']:
+        # Already in the desired state, remember that so the next run can skip the checks
+        state.record_applied(target.scope(scope), plan['desired'], plan['watched'])
+    return plan
+
+def apply_plan(scope, plan, operations, add_jobs, dry_run=False, scheduler=None):
+    # Carries out plan. add_jobs(scheduler, failures) adds its work as jobs and returns the
+    # ones the state is recorded after, unless a job appended to failures. The jobs run here
+    # unless scheduler is given (setup.py runs the package and user jobs together).
+    # Returns the number of pending actions.
+    if dry_run or not plan['pending']:
+        return plan['pending']
+    # Journal the whole plan up front, so work that never got to start is resumed as well
+    for operation in operations:
+        journal.intent(operation)
+    own_scheduler = scheduler is None
+    scheduler = scheduler or Scheduler()
+    failures = []
+    jobs = add_jobs(scheduler, failures)
+
+    def record():
+        if not failures:
+            state.record_applied(target.scope(scope), plan['desired'], plan['watched'])
+    scheduler.add(f"{scope}:record", record, deps=jobs)
+    if own_scheduler:
+        scheduler.run()
+        for name, error in scheduler.failures():
+            print(f"{name} failed: {error}")
+    return plan['pending']
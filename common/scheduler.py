@@ -0,0 +1,133 @@
+import collections
+import concurrent.futures
+import contextvars
+import time
+
+from common import executor, trace
+
+# Jobs are plain callables run on worker threads. Each may name jobs it depends on and
+# one lock ('dpkg', 'passwd', ...): jobs sharing a lock queue up in the order they became
+# ready and run one at a time, without holding a worker while they wait.
+
+JobResult = collections.namedtuple('JobResult', 'name value error started finished')
+
+class JobFailed(Exception):
+    pass
+
+class Job:
+    def __init__(self, name, func, args, kwargs, deps, lock):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = tuple(deps)
+        self.lock = lock
+
+class Scheduler:
+    def __init__(self, workers=executor.DEFAULT_LIMIT, on_done=None):
+        self.workers = workers
+        self.on_done = on_done
+        self.jobs = {}
+        self.results = {}
+
+    def add(self, name, func, *args, deps=(), lock=None, **kwargs):
+        # Returns name so callers can chain: deps=[scheduler.add(...)]
+        if name in self.jobs:
+            raise ValueError(f"duplicate job {name}")
+        for dep in deps:
+            if dep not in self.jobs:
+                raise ValueError(f"job {name} depends on unknown job {dep}")
+        self.jobs[name] = Job(name, func, args, kwargs, deps, lock)
+        return name
+
+    def result(self, name):
+        # Value a finished job returned; for use inside jobs that depend on it
+        job_result = self.results[name]
+        if job_result.error is not None:
+            raise JobFailed(f"{name} failed: {job_result.error}")
+        return job_result.value
+
+    def _call(self, job):
+        started = time.monotonic()
+        try:
+            with trace.span(job.name, 'job'):
+                value, error = job.func(*job.args, **job.kwargs), None
+        except Exception as e:
+            value, error = None, e
+        return JobResult(job.name, value, error, started, time.monotonic())
+
+    def run(self):
+        # Runs every job once its dependencies have succeeded; jobs whose dependencies
+        # failed are skipped with a JobFailed error. Returns {name: JobResult}.
+        waiting = {name: set(job.deps) for name, job in self.jobs.items()}
+        dependents = collections.defaultdict(list)
+        for name, job in self.jobs.items():
+            for dep in job.deps:
+                dependents[dep].append(name)
+        lock_queues = collections.defaultdict(collections.deque)
+        held_locks = {}
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            def dispatch(name):
+                job = self.jobs[name]
+                if job.lock is not None:
+                    if job.lock in held_locks:
+                        lock_queues[job.lock].append(name)
+                        return
+                    held_locks[job.lock] = name
+                # Jobs run in a copy of the caller's context, so traces nest them under its span
+                running[pool.submit(contextvars.copy_context().run, self._call, job)] = name
+
+            def finish(job_result):
+                self.results[job_result.name] = job_result
+                if self.on_done is not None:
+                    self.on_done(job_result)
+                lock = self.jobs[job_result.name].lock
+                if lock is not None and held_locks.get(lock) == job_result.name:
+                    del held_locks[lock]
+                    if lock_queues[lock]:
+                        dispatch(lock_queues[lock].popleft())
+                for dependent in dependents[job_result.name]:
+                    if job_result.error is not None:
+                        # Skip everything downstream of a failure
+                        if dependent in waiting:
+                            del waiting[dependent]
+                            now = time.monotonic()
+                            finish(JobResult(dependent, None, JobFailed(f"{job_result.name} failed"), now, now))
+                        continue
+                    if dependent in waiting:
+                        waiting[dependent].discard(job_result.name)
+                        if not waiting[dependent]:
+                            del waiting[dependent]
+                            dispatch(dependent)
+
+            for name in [name for name, deps in waiting.items() if not deps]:
+                del waiting[name]
+                dispatch(name)
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    finish(future.result())
+        return self.results
+
+    def failures(self):
+        # (name, exception) for every job that raised, leaving out the jobs skipped because of it
+        return [(r.name, r.error) for r in self.results.values()
+                if r.error is not None and not isinstance(r.error, JobFailed)]
+
+    def critical_path(self):
+        # The chain of dependent jobs that took longest; total wall time can't go below its length
+        longest = {}
+
+        def chain(name):
+            if name not in longest:
+                job_result = self.results[name]
+                duration = job_result.finished - job_result.started
+                best = max((chain(dep) for dep in self.jobs[name].deps if dep in self.results),
+                           key=lambda c: c[0], default=(0.0, []))
+                longest[name] = (best[0] + duration, best[1] + [name])
+            return longest[name]
+
+        return max((chain(name) for name in self.results), key=lambda c: c[0], default=(0.0, []))
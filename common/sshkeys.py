@@ -0,0 +1,142 @@
+import base64
+import binascii
+import errno
+import hashlib
+import os
+import stat
+
+KEY_TYPES = ('ssh-rsa', 'ssh-dss', 'ssh-ed25519', 'ecdsa-sha2-nistp256', 'ecdsa-sha2-nistp384',
+             'ecdsa-sha2-nistp521', 'sk-ssh-ed25519@openssh.com', 'sk-ecdsa-sha2-nistp256@openssh.com')
+
+def parse_key_line(line):
+    # Returns (options, key type, base64 blob, comment) for a public key or authorized_keys line, else None
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    fields = line.split()
+    for idx, field in enumerate(fields[:-1]):
+        if field in KEY_TYPES:
+            blob = fields[idx + 1]
+            try:
+                decoded = base64.b64decode(blob, validate=True)
+            except (binascii.Error, ValueError):
+                return None
+            # The blob starts with the length-prefixed key type it claims to be
+            if decoded[4:4 + len(field)] != field.encode():
+                return None
+            options = line[:line.index(field)].strip()
+            comment = ' '.join(fields[idx + 2:])
+            return options, field, blob, comment
+    return None
+
+def key_fingerprint(line):
+    # Same value as ssh-keygen -l: SHA256 over the decoded key blob
+    parsed = parse_key_line(line)
+    if parsed is None:
+        return None
+    digest = hashlib.sha256(base64.b64decode(parsed[2])).digest()
+    return 'SHA256:' + base64.b64encode(digest).decode().rstrip('=')
+
+def open_regular(path, dir_fd=None):
+    # Opens path for reading, refusing anything but a plain file. Key files live in a
+    # directory their account controls; root editing them must not follow a symbolic or
+    # hard link the account put there to another file (/etc/shadow, ...).
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            raise OSError(errno.ELOOP, f"{path} is a symbolic link")
+        raise
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1:
+        os.close(fd)
+        raise OSError(errno.EPERM, f"{path} is not a regular file")
+    return fd
+
+def read_authorized_keys(path, dir_fd=None):
+    # Returns (lines, index) where index maps each key's fingerprint to its line number.
+    # A missing file reads as empty. path is relative to dir_fd when one is given.
+    try:
+        fd = open_regular(path, dir_fd)
+    except FileNotFoundError:
+        return [], {}
+    with os.fdopen(fd) as key_file:
+        lines = key_file.read().splitlines()
+    index = {}
+    for idx, line in enumerate(lines):
+        fp = key_fingerprint(line)
+        if fp and fp not in index:
+            index[fp] = idx
+    return lines, index
+
+def key_ids(keys):
+    # Fingerprints for a mix of key lines and SHA256:... fingerprints
+    ids = set()
+    for key in keys:
+        for line in key.splitlines():
+            line = line.strip()
+            ids.add(line if line.startswith('SHA256:') else key_fingerprint(line))
+    return ids - {None}
+
+def merge_authorized_keys(lines, index, add=(), remove=(), exclusive=False):
+    # Returns the new list of lines: keys in remove dropped, keys in add appended unless
+    # already present, and with exclusive every other key dropped as well. Comments, options
+    # and the order of the kept lines are left as they were; duplicate keys are collapsed.
+    new_keys = {}
+    for key in add:
+        for line in key.splitlines():
+            fp = key_fingerprint(line)
+            if fp and fp not in new_keys:
+                new_keys[fp] = line.strip()
+    dropped = key_ids(remove) - set(new_keys)
+
+    merged = []
+    for idx, line in enumerate(lines):
+        fp = key_fingerprint(line)
+        if fp is None:
+            merged.append(line)
+        elif index.get(fp) == idx and fp not in dropped and (not exclusive or fp in new_keys):
+            merged.append(line)
+    merged += [line for fp, line in new_keys.items() if fp not in index]
+    return merged
+
+def replace_file(path, data, mode, uid=-1, gid=-1, dir_fd=None):
+    # Writes data to a new file in the same directory and renames it over path, so readers
+    # never see a half-written file and a link at path is replaced, never followed. path is
+    # relative to dir_fd when one is given.
+    name = f".{os.path.basename(path)}-{os.urandom(4).hex()}"
+    temp_path = name if dir_fd is not None else os.path.join(os.path.dirname(path), name)
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600, dir_fd=dir_fd)
+    try:
+        with os.fdopen(fd, 'wb') as new_file:
+            new_file.write(data)
+            new_file.flush()
+            if uid != -1 or gid != -1:
+                os.fchown(new_file.fileno(), uid, gid)
+            os.fchmod(new_file.fileno(), mode)
+            os.fsync(new_file.fileno())
+        os.replace(temp_path, path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except BaseException:
+        os.unlink(temp_path, dir_fd=dir_fd)
+        raise
+
+def write_authorized_keys(path, lines, uid=-1, gid=-1, mode=None, dir_fd=None):
+    # Replaces path atomically with lines. mode defaults to that of the file it replaces
+    # (0600 if new).
+    if mode is None:
+        try:
+            st = os.stat(path, dir_fd=dir_fd, follow_symlinks=False)
+            mode = stat.S_IMODE(st.st_mode) if stat.S_ISREG(st.st_mode) else 0o600
+        except FileNotFoundError:
+            mode = 0o600
+    replace_file(path, ''.join(f"{line}\n" for line in lines).encode(), mode, uid, gid, dir_fd)
+
+def update_authorized_keys(path, add=(), remove=(), exclusive=False, uid=-1, gid=-1, mode=None, dir_fd=None):
+    # Applies add/remove/exclusive to path and returns True, or returns False without
+    # touching the file when nothing would change
+    lines, index = read_authorized_keys(path, dir_fd)
+    merged = merge_authorized_keys(lines, index, add, remove, exclusive)
+    if merged == lines:
+        return False
+    write_authorized_keys(path, merged, uid, gid, mode, dir_fd)
+    return True
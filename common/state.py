@@ -0,0 +1,42 @@
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.environ.get('SETUP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'setup'))
+STATE_FILE = os.path.join(CACHE_DIR, 'applied-state.json')
+
+def fingerprint(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+def file_stamp(path):
+    # Cheap change detector: any rewrite of the file changes at least one of these
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+def _load():
+    try:
+        with open(STATE_FILE) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+def is_converged(scope, desired, watched_paths):
+    # True when desired equals what was last applied for scope and none of the
+    # watched files (dpkg status, passwd, ...) has changed since
+    record = _load().get(scope)
+    if not record:
+        return False
+    return (record['desired'] == fingerprint(desired)
+            and record['stamps'] == [file_stamp(path) for path in watched_paths])
+
+def record_applied(scope, desired, watched_paths):
+    records = _load()
+    records[scope] = {'desired': fingerprint(desired), 'stamps': [file_stamp(path) for path in watched_paths]}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{STATE_FILE}.tmp"
+    with open(temp_path, 'w') as state_file:
+        json.dump(records, state_file)
+    os.replace(temp_path, STATE_FILE)
@@ -0,0 +1,36 @@
+import os
+
+# The system being provisioned: '/' for the running host, or the directory of an offline
+# root filesystem (an image or chroot being built). Set with --root or SETUP_ROOT.
+ROOT = os.path.abspath(os.environ.get('SETUP_ROOT', '/'))
+
+def set_root(root):
+    global ROOT
+    ROOT = os.path.abspath(root or '/')
+    os.environ['SETUP_ROOT'] = ROOT
+
+def is_host():
+    return ROOT == '/'
+
+def path(system_path):
+    # Where a path of the target system lives as seen from here
+    return os.path.join(ROOT, system_path.lstrip('/')) if not is_host() else system_path
+
+def scope(name):
+    # Convergence state is kept per target, so a host and the images it builds don't mix
+    return name if is_host() else f"{name}@{ROOT}"
+
+def apt_options():
+    # apt reads its configuration, lists and cache from the tree and dpkg installs into it.
+    # dpkg --root also runs maintainer scripts chrooted into the tree.
+    if is_host():
+        return []
+    return ['-o', f"Dir={ROOT}", '-o', f"Dir::State::status={path('/var/lib/dpkg/status')}",
+            '-o', f"DPkg::Options::=--root={ROOT}"]
+
+def account_command(command):
+    # shadow-utils commands chroot into the tree with --root and edit its account files there
+    if is_host():
+        return command
+    idx = 1 if command[0] == 'sudo' else 0
+    return command[:idx + 1] + ['--root', ROOT] + command[idx + 1:]
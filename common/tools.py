@@ -0,0 +1,87 @@
+import collections
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from common import trace
+
+# Each OS directory describes its tools in tools.json:
+#   {"os": "Ubuntu", "tools": [{"name": "User", "file": "User.py", "entry": "user_tool",
+#                               "description": "...", "group": "..."}]}
+# Python tools are imported into the running process on first use and called through
+# their entry function; PowerShell (.ps1) tools run under pwsh/powershell.
+MANIFEST_NAME = 'tools.json'
+
+Tool = collections.namedtuple('Tool', 'os name path kind entry description group')
+
+# Imported tool modules by path, reused every time the tool is opened again
+_modules = {}
+# base directory -> (registry, errors)
+_registries = {}
+
+def tool_kind(path):
+    return 'powershell' if path.endswith('.ps1') else 'python'
+
+def read_manifest(os_dir):
+    with open(os.path.join(os_dir, MANIFEST_NAME)) as manifest_file:
+        manifest = json.load(manifest_file)
+    os_name = manifest.get('os', os.path.basename(os_dir))
+    tools = []
+    for entry in manifest.get('tools', []):
+        path = os.path.join(os_dir, entry['file'])
+        kind = tool_kind(path)
+        if kind == 'python' and not entry.get('entry'):
+            raise ValueError(f"{entry['file']}: Python tools need an entry function")
+        tools.append(Tool(os_name, entry.get('name', os.path.splitext(os.path.basename(path))[0]), path, kind,
+                          entry.get('entry'), entry.get('description', ''), entry.get('group')))
+    return os_name, tools
+
+def load_registry(base_dir):
+    # {os name: [Tool]} for every directory under base_dir with a tools.json; read once
+    # at startup. Returns (registry, errors) so a broken manifest only hides its own OS.
+    if base_dir in _registries:
+        return _registries[base_dir]
+    registry = {}
+    errors = []
+    for name in sorted(os.listdir(base_dir)):
+        os_dir = os.path.join(base_dir, name)
+        if name.startswith('.') or not os.path.isfile(os.path.join(os_dir, MANIFEST_NAME)):
+            continue
+        try:
+            os_name, tools = read_manifest(os_dir)
+        except (OSError, ValueError, KeyError) as e:
+            errors.append(f"{os.path.join(name, MANIFEST_NAME)}: {e}")
+            continue
+        registry[os_name] = tools
+    _registries[base_dir] = (registry, errors)
+    return registry, errors
+
+def load_module(path):
+    # Imported under its file name, the same module 'import User' would give, so a tool
+    # and code importing it share one instance and its caches
+    module = _modules.get(path)
+    if module is None:
+        tool_dir = os.path.dirname(path)
+        if tool_dir not in sys.path:
+            sys.path.insert(0, tool_dir)
+        module = _modules[path] = importlib.import_module(os.path.splitext(os.path.basename(path))[0])
+    return module
+
+def powershell():
+    return shutil.which('pwsh') or shutil.which('powershell')
+
+def run_tool(tool):
+    if tool.kind == 'python':
+        return getattr(load_module(tool.path), tool.entry)()
+    shell = powershell()
+    if shell is None:
+        raise FileNotFoundError(f"{tool.name} is a PowerShell tool and needs pwsh or powershell on PATH")
+    command = [shell, '-NoProfile', '-File', tool.path]
+    started = time.monotonic()
+    result = subprocess.run(command)
+    trace.command(command, result.returncode, started, time.monotonic() - started)
+    result.check_returncode()
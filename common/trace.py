@@ -0,0 +1,188 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+# Timing instrumentation behind 'setup.py --trace out.json'. Tools, steps and scheduler
+# jobs open spans; every external command run through the executor is recorded with
+# the tool and step it ran under. Nothing is recorded unless tracing was started.
+ENABLED = False
+
+_lock = threading.Lock()
+_records = []
+_origin = time.monotonic()
+_origin_wall = time.time()
+# Spans open around the current code, innermost last. A context variable rather than a
+# thread local, so asyncio tasks and scheduler jobs see the span they were started from.
+_stack = contextvars.ContextVar('trace_stack', default=())
+
+# Options whose value is a secret, by program; the value is replaced in recorded commands
+SECRET_OPTIONS = {
+    'ssh-keygen': {'-N', '-P'},
+    'useradd': {'-p', '--password'},
+    'usermod': {'-p', '--password'},
+}
+SECRET_ANY = {'--password', '--passphrase'}
+URL_CREDENTIALS_RE = re.compile(r'(://)[^/@\s]+@')
+REDACTED = '***'
+
+def start():
+    global ENABLED, _origin, _origin_wall
+    with _lock:
+        _records.clear()
+    _origin = time.monotonic()
+    _origin_wall = time.time()
+    ENABLED = True
+
+def program(command):
+    for arg in command:
+        name = os.path.basename(arg)
+        if name not in ('sudo', 'env'):
+            return name
+    return ''
+
+def redact(command):
+    secret = SECRET_OPTIONS.get(program(command), set()) | SECRET_ANY
+    redacted = []
+    hide_next = False
+    for arg in map(str, command):
+        if hide_next:
+            redacted.append(REDACTED)
+            hide_next = False
+            continue
+        option, equals, _ = arg.partition('=')
+        if option in secret:
+            if equals:
+                arg = f"{option}={REDACTED}"
+            else:
+                hide_next = True
+        redacted.append(URL_CREDENTIALS_RE.sub(rf'\1{REDACTED}@', arg))
+    return redacted
+
+def _record(record):
+    with _lock:
+        _records.append(record)
+
+def _context():
+    # (tool, step) the current code runs under
+    tool = step = None
+    for kind, name in _stack.get():
+        if kind == 'tool':
+            tool = name
+        else:
+            step = name
+    return tool, step
+
+@contextlib.contextmanager
+def span(name, kind='step'):
+    # kind is 'tool' for a whole tool or run, 'job' for a scheduler job, 'step' otherwise
+    if not ENABLED:
+        yield
+        return
+    parent = _context()
+    token = _stack.set(_stack.get() + ((kind, name),))
+    started = time.monotonic()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        _stack.reset(token)
+        _record({'type': 'span', 'kind': kind, 'name': name, 'tool': parent[0], 'step': parent[1],
+                 'start': started, 'duration': time.monotonic() - started,
+                 'thread': threading.get_ident(), 'ok': ok})
+
+def step(func):
+    # Decorator recording every call of func as a step named after it
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def command(argv, returncode, started, duration, stdout='', stderr=''):
+    # started is a time.monotonic() value, as the executor measures it
+    if not ENABLED:
+        return
+    tool, step_name = _context()
+    _record({'type': 'command', 'argv': redact(argv), 'returncode': returncode,
+             'start': started, 'duration': duration, 'tool': tool, 'step': step_name,
+             'stdout_bytes': len(stdout.encode()), 'stderr_bytes': len(stderr.encode()),
+             'thread': threading.get_ident()})
+
+def records():
+    with _lock:
+        return sorted(_records, key=lambda record: record['start'])
+
+def _jsonl_line(record):
+    record = dict(record, start=round(_origin_wall + record['start'] - _origin, 6),
+                  duration=round(record['duration'], 6))
+    record.pop('thread')
+    return json.dumps(record, sort_keys=True) + '\n'
+
+def _chrome_events(traced):
+    # Spans are laid out per thread. Commands may overlap on one thread (the executor runs
+    # them concurrently), so each gets the first free lane of a separate 'commands' row.
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'setup.py'}},
+              {'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'commands'}}]
+    threads = {}
+    lanes = []
+    for record in traced:
+        ts = (record['start'] - _origin) * 1e6
+        dur = record['duration'] * 1e6
+        if record['type'] == 'span':
+            tid = threads.setdefault(record['thread'], len(threads) + 1)
+            events.append({'name': record['name'], 'cat': record['kind'], 'ph': 'X', 'ts': ts, 'dur': dur,
+                           'pid': 1, 'tid': tid, 'args': {'ok': record['ok']}})
+            continue
+        lane = next((idx for idx, end in enumerate(lanes) if end <= ts), len(lanes))
+        if lane == len(lanes):
+            lanes.append(0)
+        lanes[lane] = ts + dur
+        events.append({'name': program(record['argv']) or 'command', 'cat': 'command', 'ph': 'X',
+                       'ts': ts, 'dur': dur, 'pid': 2, 'tid': lane + 1,
+                       'args': {key: record[key] for key in ('argv', 'returncode', 'tool', 'step',
+                                                             'stdout_bytes', 'stderr_bytes')}})
+    return events
+
+def save(path):
+    # Writes the Chrome trace (chrome://tracing, Perfetto) to path and the raw records as
+    # JSONL next to it. Returns (chrome path, jsonl path).
+    base, ext = os.path.splitext(path)
+    chrome_path, jsonl_path = (f"{base}.json", path) if ext == '.jsonl' else (path, f"{base}.jsonl")
+    traced = records()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(jsonl_path, 'w') as jsonl_file:
+        jsonl_file.write(''.join(_jsonl_line(record) for record in traced))
+    with open(chrome_path, 'w') as chrome_file:
+        json.dump({'traceEvents': _chrome_events(traced), 'displayTimeUnit': 'ms'}, chrome_file)
+    return chrome_path, jsonl_path
+
+def summary(limit=10):
+    traced = records()
+    spans = sorted((r for r in traced if r['type'] == 'span'), key=lambda r: r['duration'], reverse=True)
+    commands = sorted((r for r in traced if r['type'] == 'command'), key=lambda r: r['duration'], reverse=True)
+    print(f"\nTrace: {len(spans)} steps, {len(commands)} commands "
+          f"({sum(r['duration'] for r in commands):.1f}s spent in commands)")
+    if spans:
+        print("\nSlowest steps:")
+        print(f"{'Time':>8}  {'Kind':<5} Step")
+        for record in spans[:limit]:
+            status = "" if record['ok'] else " (failed)"
+            print(f"{record['duration']:>7.2f}s  {record['kind']:<5} {record['name']}{status}")
+    if commands:
+        print("\nSlowest commands:")
+        print(f"{'Time':>8}  {'Exit':>4}  {'Step':<24} Command")
+        for record in commands[:limit]:
+            text = ' '.join(record['argv'])
+            text = text if len(text) <= 60 else text[:57] + '...'
+            print(f"{record['duration']:>7.2f}s  {record['returncode']:>4}  "
+                  f"{record['step'] or record['tool'] or '-':<24} {text}")
@@ -3,8 +3,9 @@
         Write-Host "`nWelcome to the setup script!"
         Write-Host "Please select your OS flavor:"
 
-        # Get the list of directories and filter out 'DEB', 'Downloads', and hidden directories
-        $osDirectories = @(Get-ChildItem -Directory -Path . | Where-Object { $_.Name -ne 'DEB' -and $_.Name -ne 'Downloads' -and $_.Name -notmatch '^\.' } | Select-Object -ExpandProperty Name)
+        # OS flavors are the directories with a tools.json registry, as in setup.py; this leaves out
+        # 'DEB', 'Downloads', 'common', 'bench' and hidden directories
+        $osDirectories = @(Get-ChildItem -Directory -Path . | Where-Object { $_.Name -notmatch '^\.' -and (Test-Path (Join-Path $_.FullName 'tools.json')) } | Select-Object -ExpandProperty Name)
 
         $osDirectories += "Exit"
 
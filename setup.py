@@ -1,24 +1,42 @@
+import argparse
+import collections
 import os
 import subprocess
+import sys
+import time
+
+from common import journal, target, tools, trace
+from common.manifest import load_manifest, load_user_list
+from common.scheduler import JobFailed, Scheduler
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Exit code of apply_manifest and resume_tool_batch when the work could not even start
+# (unreadable manifest or user list, unsupported OS); resume keeps such batches open
+NOT_RUN = 2
 
 def setup():
+    # The registry is read once; tools are imported on first use and kept, so going
+    # back and forth between tools doesn't start anything new
+    registry, errors = tools.load_registry(BASE_DIR)
+    for error in errors:
+        print(f"Skipping {error}")
+    os_flavors = list(registry)
     while True:
         print("\nWelcome to the setup script!")
         print("Please select your OS flavor:")
-        
-        os_directories = [d for d in os.listdir(os.getcwd()) if os.path.isdir(d) and not d.startswith('.') and d != 'DEB']
-        for idx, os_dir in enumerate(os_directories, start=1):
-            print(f"{idx}. {os_dir}")
-        print(f"{len(os_directories) + 1}. Exit")
 
-        choice = input(f"Enter your choice (1-{len(os_directories)+1}): ")
+        for idx, os_flavor in enumerate(os_flavors, start=1):
+            print(f"{idx}. {os_flavor}")
+        print(f"{len(os_flavors) + 1}. Exit")
+
+        choice = input(f"Enter your choice (1-{len(os_flavors)+1}): ")
 
         if choice.isdigit():
             choice = int(choice)
-            if 1 <= choice <= len(os_directories):
-                os_flavor = os_directories[choice - 1]
-                list_tools(os_flavor)
-            elif choice == len(os_directories) + 1:
+            if 1 <= choice <= len(os_flavors):
+                os_flavor = os_flavors[choice - 1]
+                list_tools(os_flavor, registry[os_flavor])
+            elif choice == len(os_flavors) + 1:
                 print("Exiting...")
                 break
             else:
@@ -26,49 +44,255 @@ def setup():
         else:
             print("Invalid input. Please enter a number.")
 
-def list_tools(os_flavor):
+def list_tools(os_flavor, tool_list):
+    if not tool_list:
+        print("No tools found for the selected OS.")
+        return
     while True:
-        os_path = os.path.join(os.getcwd(), os_flavor)
-        try:
-            tool_scripts = [f[:-3] for f in os.listdir(os_path) if f.endswith('.py')]
-            if not tool_scripts:
-                print("No tools found for the selected OS.")
-                return
-
-            print(f"\nAvailable tools for {os_flavor}:")
-            for idx, tool in enumerate(tool_scripts, start=1):
-                print(f"{idx}. {tool}")
-            print(f"{len(tool_scripts) + 1}. Back")
-            print(f"{len(tool_scripts) + 2}. Exit")
-
-            tool_choice = input("Enter the number of the tool you want to run: ")
-            
-            if tool_choice.isdigit():
-                tool_choice = int(tool_choice) - 1
-                if 0 <= tool_choice < len(tool_scripts):
-                    selected_tool = tool_scripts[tool_choice] + '.py'
-                    run_tool_script(os_path, selected_tool)
-                elif tool_choice == len(tool_scripts):
-                    return  # Back to OS flavor selection
-                elif tool_choice == len(tool_scripts) + 1:
-                    print("Exiting...")
-                    exit()
-                else:
-                    print("Invalid choice!")
+        print(f"\nAvailable tools for {os_flavor}:")
+        for idx, tool in enumerate(tool_list, start=1):
+            group = f" ({tool.group})" if tool.group else ""
+            print(f"{idx}. {tool.name}{group} - {tool.description}")
+        print(f"{len(tool_list) + 1}. Back")
+        print(f"{len(tool_list) + 2}. Exit")
+
+        tool_choice = input("Enter the number of the tool you want to run: ")
+
+        if tool_choice.isdigit():
+            tool_choice = int(tool_choice) - 1
+            if 0 <= tool_choice < len(tool_list):
+                run_tool_script(tool_list[tool_choice])
+            elif tool_choice == len(tool_list):
+                return  # Back to OS flavor selection
+            elif tool_choice == len(tool_list) + 1:
+                print("Exiting...")
+                exit()
             else:
-                print("Invalid input. Please enter a number.")
-        except FileNotFoundError:
-            print("No tools directory found for the selected OS.")
-            return
-    
-def run_tool_script(os_path, tool_script):
-    script_path = os.path.join(os_path, tool_script)
+                print("Invalid choice!")
+        else:
+            print("Invalid input. Please enter a number.")
+
+def run_tool_script(tool):
+    # Python tools run in this process and act on the same target (see --root)
     try:
-        subprocess.run(['python3', script_path], check=True)
-    except FileNotFoundError:
-        print(f"Tool script {tool_script} not found.")
+        with trace.span(f"{tool.os}/{tool.name}", 'tool'):
+            tools.run_tool(tool)
+    except FileNotFoundError as e:
+        print(f"Tool {tool.name} could not be started: {e}")
     except subprocess.CalledProcessError as e:
         print(f"An error occurred while running the script: {e}")
+    except KeyboardInterrupt:
+        print(f"\n{tool.name} interrupted.")
+    except Exception as e:
+        # A failing tool must not take the launcher down with it
+        print(f"An error occurred while running {tool.name}: {e}")
 
-if __name__ == "__main__":
+def load_tool_module(os_flavor, tool):
+    registry, _ = tools.load_registry(BASE_DIR)
+    for entry in registry.get(os_flavor, []):
+        if entry.name == tool and entry.kind == 'python':
+            return tools.load_module(entry.path)
+    raise ImportError(f"{os_flavor} has no {tool} tool")
+
+def apply_manifest(manifest_path, dry_run=False, assume_yes=False, resume_ops=None):
+    # Provisions the host from a manifest in this process: print the plan, then apply it.
+    # resume_ops limits it to the unfinished operations of an interrupted run.
+    try:
+        manifest = load_manifest(manifest_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read manifest {manifest_path}: {e}")
+        return NOT_RUN
+    if resume_ops is not None:
+        manifest = unfinished_part(manifest, resume_ops)
+
+    os_flavor = manifest.get('os', 'Ubuntu')
+    try:
+        packages = load_tool_module(os_flavor, 'Packages')
+        users = load_tool_module(os_flavor, 'User')
+    except ImportError as e:
+        print(f"No manifest support for {os_flavor}: {e}")
+        return NOT_RUN
+
+    print(f"Plan for {manifest_path}:")
+    try:
+        with trace.span('plan'):
+            package_plan = packages.plan_manifest(manifest.get('packages', {}))
+            user_plan = users.plan_manifest(manifest.get('users', []), dry_run)
+    except ValueError as e:
+        print(f"Invalid manifest: {e}")
+        return NOT_RUN
+    if not package_plan['pending'] + user_plan['pending']:
+        print("\nNothing to do.")
+        return 0
+    if dry_run:
+        return 0
+
+    if not assume_yes and input("\nApply this plan? (y/n): ").lower() != 'y':
+        print("Nothing was changed.")
+        return 1
+
+    # Package and user work go into one job graph: independent jobs (apt update, key
+    # fetches, home builds) overlap, and jobs sharing the dpkg or passwd lock queue up
+    packages.PROGRESS_MODE = 'silent'
+    scheduler = Scheduler(on_done=report_job)
+    print()
+    # Journaled: if this run is cut short, 'setup.py resume' finishes only what is left
+    try:
+        with journal.batch({'manifest': os.path.abspath(manifest_path), 'os': os_flavor}, target.ROOT):
+            # The plan printed above is what gets applied; nothing is worked out twice
+            packages.apply_manifest(manifest.get('packages', {}), scheduler=scheduler, plan=package_plan)
+            users.apply_manifest(manifest.get('users', []), scheduler=scheduler, plan=user_plan)
+            started = time.monotonic()
+            scheduler.run()
+            elapsed = time.monotonic() - started
+    except KeyboardInterrupt:
+        print("\nInterrupted. Run 'python3 setup.py resume' to finish the remaining work.")
+        return 130
+
+    failures = scheduler.failures()
+    for name, error in failures:
+        print(f"{name} failed: {error}")
+    length, path = scheduler.critical_path()
+    print(f"\nDone in {elapsed:.1f}s (critical path {length:.1f}s: {' -> '.join(path)})")
+    return 1 if failures else 0
+
+def unfinished_part(manifest, ops):
+    # The part of a manifest covered by journal operations ('packages:install:jq',
+    # 'users:create:alice', ...) that never completed
+    subjects = collections.defaultdict(list)
+    for op in ops:
+        module, action, subject = (op.split(':', 2) + [''])[:3]
+        subjects[(module, action)].append(subject)
+    section = {'install': subjects[('packages', 'install')], 'debs': subjects[('packages', 'deb')],
+               'upgrade': ('packages', 'upgrade') in subjects}
+    names = {name for (module, _), values in subjects.items() if module == 'users' for name in values}
+    return dict(manifest, packages=section, users=[u for u in manifest.get('users', []) if u['name'] in names])
+
+def describe_source(source):
+    if 'manifest' in source:
+        return f"manifest {source['manifest']}"
+    if 'user_list' in source:
+        return f"user list {source['user_list']}"
+    if 'debs' in source:
+        return f"{len(source['debs'])} .deb files"
+    return f"{len(source['packages'])} packages"
+
+def resume(assume_yes=False, discard=False):
+    # Finishes (or with discard forgets) the batches the journal shows were cut short
+    batches = journal.unfinished()
+    if not batches:
+        print("No interrupted runs to resume.")
+        return 0
+
+    failed = False
+    for batch, info in batches.items():
+        source = info['source']
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(info['started']))
+        where = "" if info['root'] == '/' else f" on {info['root']}"
+        print(f"\nInterrupted run from {describe_source(source)}{where}, started {started}:")
+        for op in info['ops']:
+            print(f"  {op}")
+        if not info['ops']:
+            print("  nothing recorded as unfinished")
+        if discard:
+            journal.end(batch)
+            print("Discarded.")
+            continue
+        if not assume_yes and input("Resume this run? (y/n): ").lower() != 'y':
+            continue
+
+        target.set_root(info['root'])
+        journal.reopen(batch)
+        os_flavor = source.get('os', 'Ubuntu')
+        try:
+            if 'manifest' in source:
+                result = apply_manifest(source['manifest'], assume_yes=True, resume_ops=info['ops'])
+            else:
+                result = resume_tool_batch(os_flavor, source, info['ops'])
+        except KeyboardInterrupt:
+            print("\nInterrupted. Run 'python3 setup.py resume' to finish the remaining work.")
+            return 130
+        # The batch only ends once its replay ran to completion; failed operations are
+        # recorded as such, work that never started stays open for the next resume
+        if result == 130:
+            return 130
+        if result == NOT_RUN:
+            print("Kept for a later 'setup.py resume'.")
+            failed = True
+            continue
+        failed = failed or result != 0
+        journal.end(batch)
+    return 1 if failed else 0
+
+def resume_tool_batch(os_flavor, source, ops):
+    # Batches started from the tool menus, rerun for the operations that did not complete
+    subjects = [op.split(':', 2)[2] for op in ops]
+    try:
+        tool = load_tool_module(os_flavor, 'User' if 'user_list' in source else 'Packages')
+    except ImportError as e:
+        print(f"Cannot resume on {os_flavor}: {e}")
+        return NOT_RUN
+    if 'user_list' in source:
+        try:
+            wanted = set(subjects)
+            pending = [u for u in load_user_list(source['user_list']) if u['name'] in wanted]
+        except (OSError, ValueError) as e:
+            print(f"Could not read {source['user_list']}: {e}")
+            return NOT_RUN
+        created, failures = tool.bulk_add_users(pending)
+        for username in created:
+            print(f"User {username} created.")
+        for username, reason in failures:
+            print(f"Error creating user {username}: {reason}")
+        return 1 if failures else 0
+    if 'debs' in source:
+        return 1 if tool.install_deb_packages(subjects, assume_yes=True) else 0
+    return 1 if tool.install_packages(subjects) else 0
+
+def report_job(result):
+    status = "skipped" if isinstance(result.error, JobFailed) else "failed" if result.error else "done"
+    print(f"[{status}] {result.name} ({result.finished - result.started:.1f}s)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Set up a machine interactively, or from a manifest with 'apply'.")
+    parser.add_argument('--root', default=target.ROOT,
+                        help="provision the root filesystem in this directory (e.g. an image being built) instead of this host")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="record the run's steps and commands as a Chrome trace in FILE and as JSONL next to it")
+    commands = parser.add_subparsers(dest='command')
+    apply_parser = commands.add_parser('apply', help="provision this host from a TOML or JSON manifest")
+    apply_parser.add_argument('manifest', help="path to the manifest")
+    apply_parser.add_argument('--dry-run', action='store_true', help="only print the plan")
+    apply_parser.add_argument('--yes', action='store_true', help="apply the plan without asking")
+    resume_parser = commands.add_parser('resume', help="finish runs that were interrupted")
+    resume_parser.add_argument('--yes', action='store_true', help="resume without asking")
+    resume_parser.add_argument('--discard', action='store_true', help="forget interrupted runs instead")
+    args = parser.parse_args(argv)
+    target.set_root(args.root)
+
+    if args.trace is None:
+        return run(args)
+    trace.start()
+    try:
+        return run(args)
+    finally:
+        # Written however the run ends, including Ctrl+C and Exit from a menu
+        trace.summary()
+        try:
+            chrome_path, jsonl_path = trace.save(args.trace)
+            print(f"\nTrace written to {chrome_path} (chrome://tracing, Perfetto) and {jsonl_path}")
+        except OSError as e:
+            print(f"\nCould not write trace {args.trace}: {e}")
+
+def run(args):
+    if args.command == 'apply':
+        with trace.span(f"apply {os.path.basename(args.manifest)}", 'tool'):
+            return apply_manifest(args.manifest, dry_run=args.dry_run, assume_yes=args.yes)
+    if args.command == 'resume':
+        with trace.span('resume', 'tool'):
+            return resume(assume_yes=args.yes, discard=args.discard)
     setup()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
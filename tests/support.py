@@ -0,0 +1,36 @@
+import base64
+import io
+import os
+import struct
+import tarfile
+
+# Builders for the inputs the tests and the benchmarks (bench/bench.py) feed the tools
+
+def ar_member(name, data):
+    header = f"{name:<16}{0:<12}{0:<6}{0:<6}{'100644':<8}{len(data):<10}`\n".encode()
+    return header + data + (b'\n' if len(data) % 2 else b'')
+
+def tar_gz(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def make_deb(path, control, files=None):
+    # control is the control file, or a dict of its fields; files maps the paths the
+    # package installs to their contents
+    if isinstance(control, dict):
+        control = ''.join(f"{key}: {value}\n" for key, value in control.items()).encode()
+    with open(path, 'wb') as deb_file:
+        deb_file.write(b'!<arch>\n' + ar_member('debian-binary', b'2.0\n') +
+                       ar_member('control.tar.gz', tar_gz({'./control': control})) +
+                       ar_member('data.tar.gz', tar_gz(files or {})))
+
+def public_key(comment='', seed=None):
+    # A well-formed ed25519 public key line; the same seed gives the same key, no seed a new one
+    key = bytes([seed]) * 32 if seed is not None else os.urandom(32)
+    blob = struct.pack('>I', 11) + b'ssh-ed25519' + struct.pack('>I', 32) + key
+    return f"ssh-ed25519 {base64.b64encode(blob).decode()} {comment}".strip()
@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import aptrepo, debfile, dpkg
+from support import make_deb
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class LocalRepositoryTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.TemporaryDirectory()
+        self.deb_dir = os.path.join(self.work.name, 'DEB')
+        self.repo_dir = os.path.join(self.work.name, 'repo')
+        os.makedirs(self.deb_dir)
+        with open(os.path.join(FIXTURES, 'control'), 'rb') as control_file:
+            make_deb(os.path.join(self.deb_dir, 'hello-local_1.0_amd64.deb'), control_file.read(),
+                     {'./usr/bin/hello-local': b'#!/bin/sh\n'})
+        make_deb(os.path.join(self.deb_dir, 'base-alt_3.0_all.deb'),
+                 {'Package': 'base-alt', 'Version': '3.0', 'Architecture': 'all', 'Description': 'alternative base'})
+        self.entries, errors = debfile.scan_directory(self.deb_dir, os.path.join(self.work.name, 'index.json'))
+        self.assertEqual(errors, [])
+
+    def tearDown(self):
+        self.work.cleanup()
+
+    def read(self, name, mode='rb'):
+        with open(os.path.join(self.repo_dir, name), mode) as repo_file:
+            return repo_file.read()
+
+    def test_packages_index(self):
+        self.assertTrue(aptrepo.write_repository(self.repo_dir, self.entries))
+        stanzas = dpkg.parse_control(self.read('Packages', 'r'))
+        self.assertEqual([s['Package'] for s in stanzas], ['base-alt', 'hello-local'])
+        hello = stanzas[1]
+        path = os.path.join(self.deb_dir, 'hello-local_1.0_amd64.deb')
+        # Relative to the file:/ repository root
+        self.assertEqual(hello['Filename'], os.path.abspath(path).lstrip('/'))
+        self.assertEqual(int(hello['Size']), os.path.getsize(path))
+        self.assertEqual(hello['SHA256'], debfile.sha256sum(path))
+        self.assertEqual(hello['Depends'], 'libc6 (>= 2.34), base | base-alt')
+        self.assertEqual(hello['Description'], "greets the local user\nA longer description that spans\ntwo lines.")
+        self.assertEqual(list(hello)[:3], ['Package', 'Version', 'Architecture'])
+        self.assertEqual(gzip.decompress(self.read('Packages.gz')), self.read('Packages'))
+
+    def test_release_lists_the_indexes(self):
+        aptrepo.write_repository(self.repo_dir, self.entries)
+        release = dpkg.parse_control(self.read('Release', 'r'))[0]
+        self.assertEqual(release['Suite'], aptrepo.distribution(self.repo_dir))
+        listed = {line.split()[2]: line.split()[0] for line in release['SHA256'].splitlines() if line.strip()}
+        for name in ('Packages', 'Packages.gz'):
+            self.assertEqual(listed[name], hashlib.sha256(self.read(name)).hexdigest())
+
+    def test_unchanged_entries_leave_the_files_alone(self):
+        aptrepo.write_repository(self.repo_dir, self.entries)
+        stamp = os.stat(os.path.join(self.repo_dir, 'Release')).st_mtime_ns
+        self.assertFalse(aptrepo.write_repository(self.repo_dir, list(reversed(self.entries))))
+        self.assertEqual(os.stat(os.path.join(self.repo_dir, 'Release')).st_mtime_ns, stamp)
+        self.assertTrue(aptrepo.write_repository(self.repo_dir, self.entries[:1]))
+
+    def test_source_parts(self):
+        system_parts = os.path.join(self.work.name, 'sources.list.d')
+        os.makedirs(system_parts)
+        with open(os.path.join(system_parts, 'ppa.list'), 'w') as source_file:
+            source_file.write("deb http://ppa.example.com/ubuntu jammy main\n")
+        aptrepo.write_repository(self.repo_dir, self.entries)
+        update_options, install_options = aptrepo.register_source(self.repo_dir, system_parts)
+
+        list_path = os.path.join(self.repo_dir, 'local.list')
+        self.assertEqual(self.read('local.list', 'r'), f"deb [trusted=yes] file:/ {aptrepo.distribution(self.repo_dir)}\n")
+        parts_dir = os.path.join(self.repo_dir, 'sources.list.d')
+        self.assertEqual(sorted(os.listdir(parts_dir)), ['ppa.list', 'setup-local.list'])
+        self.assertEqual(os.readlink(os.path.join(parts_dir, 'setup-local.list')), list_path)
+        self.assertEqual(install_options, ['-o', f"Dir::Etc::SourceParts={parts_dir}"])
+        # apt update only reads the local repository
+        empty_dir = os.path.join(self.repo_dir, 'empty.d')
+        self.assertIn(f"Dir::Etc::SourceList={list_path}", update_options)
+        self.assertIn(f"Dir::Etc::SourceParts={empty_dir}", update_options)
+        self.assertEqual(os.listdir(empty_dir), [])
+        # Registering again picks up removed system sources
+        os.remove(os.path.join(system_parts, 'ppa.list'))
+        aptrepo.register_source(self.repo_dir, system_parts)
+        self.assertEqual(os.listdir(parts_dir), ['setup-local.list'])
+
+if __name__ == '__main__':
+    unittest.main()
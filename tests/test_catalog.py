@@ -0,0 +1,88 @@
+import gzip
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import catalog
+
+MAIN = """Package: mawk
+Version: 1.3.4-1
+Size: 100
+Installed-Size: 200
+Section: interpreters
+Provides: awk
+
+Package: postfix
+Version: 3.6.4-1
+Size: 1000
+Installed-Size: 4000
+Section: mail
+Provides: default-mta, mail-transport-agent (= 3.6.4-1)
+
+Package: exim4-daemon-light
+Version: 4.95-4
+Size: 600
+Installed-Size: 1500
+Section: mail
+Provides: mail-transport-agent
+"""
+
+UPDATES = """Package: mawk
+Version: 1.3.4-2
+Size: 110
+Installed-Size: 210
+Section: interpreters
+"""
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.TemporaryDirectory()
+        self.lists = os.path.join(self.work.name, 'lists')
+        self.cache = os.path.join(self.work.name, 'catalog')
+        os.makedirs(self.lists)
+        with open(os.path.join(self.lists, 'archive_jammy_main_binary-amd64_Packages'), 'w') as list_file:
+            list_file.write(MAIN)
+        with gzip.open(os.path.join(self.lists, 'archive_jammy-updates_main_binary-amd64_Packages.gz'), 'wt') as list_file:
+            list_file.write(UPDATES)
+        catalog._catalogs.clear()
+
+    def tearDown(self):
+        catalog._catalogs.clear()
+        self.work.cleanup()
+
+    def test_newest_version_and_providers(self):
+        package_index, errors = catalog.load_catalog(self.lists, self.cache)
+        self.assertEqual(errors, [])
+        self.assertEqual(package_index.get('mawk')['version'], '1.3.4-2')
+        self.assertEqual(package_index.get('postfix:amd64')['installed_size'], 4000 * 1024)
+        self.assertIsNone(package_index.get('mail-transport-agent'))
+        self.assertEqual(package_index.providers('mail-transport-agent'), ['exim4-daemon-light', 'postfix'])
+        self.assertEqual(package_index.providers('default-mta'), ['postfix'])
+        # Only the newest mawk counts, and it no longer provides awk
+        self.assertEqual(package_index.providers('awk'), [])
+        self.assertEqual(package_index.providers('postfix'), [])
+
+    def test_older_caches_are_parsed_again(self):
+        catalog.load_catalog(self.lists, self.cache)
+        catalog._catalogs.clear()
+        # A cache written before Provides was recorded: same stamps, no format
+        for dirpath, _, names in os.walk(self.cache):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                with open(path) as stored:
+                    data = json.load(stored)
+                data.pop('format')
+                data.pop('provides', None)
+                for entry in data['packages'] if 'stamp' in data else []:
+                    del entry[5:]
+                with open(path, 'w') as stored:
+                    json.dump(data, stored)
+        package_index, _ = catalog.load_catalog(self.lists, self.cache)
+        self.assertEqual(package_index.providers('default-mta'), ['postfix'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import debfile
+from support import ar_member, make_deb
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class ReadControlTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.TemporaryDirectory()
+        with open(os.path.join(FIXTURES, 'control'), 'rb') as control_file:
+            self.control = control_file.read()
+
+    def tearDown(self):
+        self.work.cleanup()
+
+    def test_fields_from_control_member(self):
+        path = os.path.join(self.work.name, 'hello-local.deb')
+        make_deb(path, self.control)
+        fields = debfile.read_control(path)
+        self.assertEqual(fields['Package'], 'hello-local')
+        self.assertEqual(fields['Version'], '2:1.0~rc1-0ubuntu1')
+        self.assertEqual(fields['Depends'], 'libc6 (>= 2.34), base | base-alt')
+        self.assertEqual(fields['Description'], "greets the local user\nA longer description that spans\ntwo lines.")
+
+    def test_not_a_deb(self):
+        path = os.path.join(self.work.name, 'broken.deb')
+        with open(path, 'wb') as deb_file:
+            deb_file.write(b'not an archive')
+        with self.assertRaises(ValueError):
+            debfile.read_control(path)
+
+    def test_no_control_member(self):
+        path = os.path.join(self.work.name, 'empty.deb')
+        with open(path, 'wb') as deb_file:
+            deb_file.write(debfile.AR_MAGIC + ar_member('debian-binary', b'2.0\n'))
+        with self.assertRaises(ValueError):
+            debfile.read_control(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import depgraph, dpkg
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_graph(**settings):
+    graph = depgraph.DependencyGraph(**settings)
+    graph.update(dpkg.load_status(os.path.join(FIXTURES, 'status')),
+                 dpkg.auto_installed(os.path.join(FIXTURES, 'extended_states')))
+    return graph
+
+class RemovalTest(unittest.TestCase):
+    def test_dependents_follow_with_their_cause(self):
+        removed, _ = load_graph().removal(['libfoo'])
+        self.assertEqual(removed, {'libfoo': None, 'app': 'libfoo', 'plugin': 'app'})
+
+    def test_no_longer_needed_packages(self):
+        _, autoremoved = load_graph(never_autoremove=['^linux-image-']).removal(['app'])
+        # libfoo and what it and app recommend; old-lib was orphaned already
+        self.assertEqual(autoremoved, ['foo-data', 'foo-doc', 'libfoo', 'old-lib'])
+
+    def test_virtual_package_providers(self):
+        graph = load_graph()
+        removed, _ = graph.removal(['smtp-server'])
+        self.assertEqual(removed, {'smtp-server': None, 'mutt': 'smtp-server'})
+        # mutt needs mail-transport-agent, so its only provider stays
+        self.assertNotIn('smtp-server', graph.removal(['old-lib'])[1])
+
+    def test_suggests_follow_apt_setting(self):
+        self.assertNotIn('helper', load_graph(keep_suggests=True).removal(['old-lib'])[1])
+        self.assertIn('helper', load_graph(keep_suggests=False).removal(['old-lib'])[1])
+
+    def test_required_and_never_autoremove_stay(self):
+        autoremoved = load_graph(never_autoremove=['^linux-image-']).removal(['old-lib'])[1]
+        self.assertNotIn('req-lib', autoremoved)
+        self.assertNotIn('linux-image-generic', autoremoved)
+        self.assertIn('linux-image-generic', load_graph().removal(['old-lib'])[1])
+
+    def test_essential_packages_are_flagged(self):
+        graph = load_graph()
+        removed, _ = graph.removal(['base'])
+        self.assertTrue(graph.packages['base'].essential)
+        self.assertIn('app', removed)
+
+    def test_not_installed_names_are_ignored(self):
+        removed, _ = load_graph().removal(['broken', 'missing'])
+        self.assertEqual(removed, {})
+
+    def test_update_applies_changes(self):
+        graph = load_graph()
+        status = dict(dpkg.load_status(os.path.join(FIXTURES, 'status')))
+        del status['plugin']
+        status['app'] = dict(status['app'], Version='1:2.1-1', Depends='base')
+        graph.update(status, graph.auto)
+        self.assertNotIn('plugin', graph.packages)
+        removed, autoremoved = graph.removal(['libfoo'])
+        self.assertEqual(removed, {'libfoo': None})
+        self.assertIn('foo-data', autoremoved)
+        self.assertEqual(graph.size_of(['libfoo', 'foo-data']), (4096 + 512) * 1024)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import dpkg
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+STATUS = os.path.join(FIXTURES, 'status')
+
+# (a, b, sign of compare_versions(a, b)) as 'dpkg --compare-versions' orders them
+VERSION_ORDER = [
+    ('1.0', '1.0-0', 0),
+    ('0:1.0', '1.0', 0),
+    ('1.0', '1.0.0', -1),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~', 1),
+    ('1.0+dfsg', '1.0', 1),
+    ('1.0a', '1.0', 1),
+    ('1.0-rc1', '1.0', 1),
+    ('2.30', '2.4', 1),
+    ('9', '10', -1),
+    ('1:0.9', '2.0', 1),
+    ('1:2.0:3-1', '1:2.0:2-1', 1),
+    ('1:2.0:3-1', '1:2.0-1', 1),
+    ('2.0-1ubuntu1', '2.0-1', 1),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    ('1.0-1.1', '1.0-1', 1),
+]
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+class CompareVersionsTest(unittest.TestCase):
+    def test_matches_dpkg_ordering(self):
+        for a, b, expected in VERSION_ORDER:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(sign(dpkg.compare_versions(a, b)), expected)
+                self.assertEqual(sign(dpkg.compare_versions(b, a)), -expected)
+
+    def test_epoch_ends_at_first_colon(self):
+        self.assertEqual(dpkg._split_version('1:2.0:3-1'), (1, '2.0:3', '1'))
+        self.assertEqual(dpkg._split_version('2.0'), (0, '2.0', '0'))
+
+    def test_version_satisfies(self):
+        self.assertTrue(dpkg.version_satisfies('1.2-1', '>=', '1.0'))
+        self.assertFalse(dpkg.version_satisfies('1.2-1', '<<', '1.2-1'))
+        self.assertTrue(dpkg.version_satisfies('1.2-1', '=', '1.2-1'))
+        self.assertTrue(dpkg.version_satisfies(None, None, None))
+        self.assertFalse(dpkg.version_satisfies(None, '>=', '1.0'))
+
+class StatusIndexTest(unittest.TestCase):
+    def test_states_and_versions(self):
+        self.assertTrue(dpkg.is_installed('app', STATUS))
+        self.assertEqual(dpkg.installed_version('app', STATUS), '1:2.0:3-1')
+        self.assertEqual(dpkg.state_of('broken', STATUS), 'half-installed')
+        self.assertFalse(dpkg.is_installed('broken', STATUS))
+        self.assertFalse(dpkg.is_installed('missing', STATUS))
+
+    def test_installed_architecture_wins(self):
+        # libfoo:i386 only has its config files left
+        self.assertEqual(dpkg.installed_version('libfoo', STATUS), '1.2-1')
+
+    def test_continuation_lines(self):
+        fields = dpkg.load_status(STATUS)['app']
+        self.assertEqual(fields['Description'], "an application\nwith a continuation line")
+
+    def test_installed_packages(self):
+        installed = dpkg.installed_packages(STATUS)
+        self.assertIn('plugin', installed)
+        self.assertNotIn('broken', installed)
+
+    def test_auto_installed(self):
+        auto = dpkg.auto_installed(os.path.join(FIXTURES, 'extended_states'))
+        self.assertIn('libfoo', auto)
+        self.assertNotIn('plugin', auto)
+        self.assertEqual(dpkg.auto_installed(os.path.join(FIXTURES, 'missing')), set())
+
+class RelationsTest(unittest.TestCase):
+    def test_alternatives_and_versions(self):
+        self.assertEqual(dpkg.parse_relations('a (>= 1.0) | b, c:any'),
+                         [[('a', '>=', '1.0'), ('b', None, None)], [('c', None, None)]])
+        self.assertEqual(dpkg.parse_relations(''), [])
+
+if __name__ == '__main__':
+    unittest.main()
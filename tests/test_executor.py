@@ -0,0 +1,66 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import executor
+
+class Counter:
+    # Tracks how many of the commands run at once from the lines they print
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def on_line(self, line):
+        with self.lock:
+            self.running += 1 if line.startswith('started') else -1
+            self.peak = max(self.peak, self.running)
+
+COMMAND = [sys.executable, '-S', '-c', "import time; print('started', flush=True); time.sleep(0.1); print('done')"]
+
+class LimitTest(unittest.TestCase):
+    def run_in_threads(self, run, threads=4):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            return [future.result() for future in [pool.submit(run) for _ in range(threads)]]
+
+    def test_limit_holds_across_threads_and_calls(self):
+        runner = executor.Executor(limit=2)
+        counter = Counter()
+
+        def run():
+            # One event loop per call, as run_sync and run_many do
+            results = asyncio.run(runner.run_all([COMMAND] * 3, on_line=counter.on_line))
+            return [result.returncode for result in results]
+        self.assertEqual(self.run_in_threads(run), [[0, 0, 0]] * 4)
+        self.assertEqual(counter.peak, 2)
+
+    def test_command_lock_holds_across_threads(self):
+        lock = executor.CommandLock('test')
+        counter = Counter()
+
+        def run():
+            return asyncio.run(executor.default_executor.run(COMMAND, lock=lock, on_line=counter.on_line)).returncode
+        self.assertEqual(self.run_in_threads(run), [0] * 4)
+        self.assertEqual(counter.peak, 1)
+
+    def test_cancelled_waiters_give_their_slot_back(self):
+        slots = executor.Slots(1)
+
+        async def scenario():
+            await slots.acquire()
+            waiter = asyncio.ensure_future(slots.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            slots.release()
+            await asyncio.gather(waiter, return_exceptions=True)
+            # The slot is free again
+            await asyncio.wait_for(slots.acquire(), 1)
+        asyncio.run(scenario())
+
+if __name__ == '__main__':
+    unittest.main()
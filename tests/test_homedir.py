@@ -0,0 +1,68 @@
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import homedir
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as output:
+        output.write(data)
+
+def read(path):
+    with open(path) as input_file:
+        return input_file.read()
+
+class HomeTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.TemporaryDirectory()
+        self.skel = os.path.join(self.work.name, 'skel')
+        write(os.path.join(self.skel, '.bashrc'), "# bashrc\n")
+        write(os.path.join(self.skel, '.config', 'app', 'settings'), "color=blue\n")
+        os.symlink('.bashrc', os.path.join(self.skel, '.bash_aliases'))
+        self.ids = os.getuid(), os.getgid()
+
+    def tearDown(self):
+        self.work.cleanup()
+
+    def build(self, name, login_defs=homedir.LOGIN_DEFS):
+        home = os.path.join(self.work.name, 'home', name)
+        self.assertEqual(homedir.build_homes([(home, *self.ids)], self.skel, login_defs=login_defs), [(home, None)])
+        return home
+
+    def test_home_gets_the_skeleton(self):
+        home = self.build('alice')
+        self.assertEqual(read(os.path.join(home, '.bashrc')), "# bashrc\n")
+        self.assertEqual(read(os.path.join(home, '.config', 'app', 'settings')), "color=blue\n")
+        self.assertEqual(os.readlink(os.path.join(home, '.bash_aliases')), '.bashrc')
+
+    def test_skel_edits_reach_later_homes(self):
+        self.build('alice')
+        # Same size, nested, with the skel directory's own mtime unchanged
+        settings = os.path.join(self.skel, '.config', 'app', 'settings')
+        skel_mtime = os.stat(self.skel).st_mtime_ns
+        write(settings, "color=pink\n")
+        st = os.stat(settings)
+        os.utime(settings, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+        self.assertEqual(os.stat(self.skel).st_mtime_ns, skel_mtime)
+        self.assertEqual(read(os.path.join(self.build('bob'), '.config', 'app', 'settings')), "color=pink\n")
+        os.chmod(settings, 0o600)
+        home = self.build('carol')
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(home, '.config', 'app', 'settings')).st_mode), 0o600)
+
+    def test_home_mode_from_login_defs(self):
+        login_defs = os.path.join(self.work.name, 'login.defs')
+        write(login_defs, "# HOME_MODE 0755\nUMASK 027\n")
+        self.assertEqual(homedir.login_defs_home_mode(login_defs), 0o750)
+        write(login_defs, "UMASK 022\nHOME_MODE 0700\n")
+        self.assertEqual(homedir.login_defs_home_mode(login_defs), 0o700)
+        home = self.build('dave', login_defs)
+        self.assertEqual(stat.S_IMODE(os.stat(home).st_mode), 0o700)
+        self.assertEqual(homedir.login_defs_home_mode(os.path.join(self.work.name, 'missing')), 0o750)
+
+if __name__ == '__main__':
+    unittest.main()
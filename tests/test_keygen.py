@@ -0,0 +1,67 @@
+import os
+import shutil
+import stat
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import keygen, sshkeys
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.02)
+
+@unittest.skipUnless(shutil.which('ssh-keygen'), "needs ssh-keygen")
+class KeyPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = keygen.KeyPool('ed25519', workers=2)
+        self.taken = []
+
+    def tearDown(self):
+        self.pool.close(wait=True)
+        for path in self.taken:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def take(self, owner):
+        path, public_key = self.pool.take(owner)
+        self.taken.append(path)
+        return path, public_key
+
+    def test_reserved_keys_are_made_ahead(self):
+        self.pool.reserve(3)
+        wait_for(lambda: self.pool._stock.qsize() == 3)
+        # Reserving what is already there makes nothing more
+        self.pool.reserve(2)
+        self.assertEqual((self.pool._wanted, self.pool._making), (0, 0))
+        path, public_key = self.take('alice')
+        self.assertEqual(self.pool._stock.qsize(), 2)
+        self.assertEqual(os.path.basename(path), 'id_ed25519')
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode), 0o700)
+        self.assertTrue(public_key.startswith('ssh-ed25519 '))
+        self.assertTrue(public_key.split()[-1].startswith('alice@'))
+        with open(f"{path}.pub") as public_file:
+            self.assertEqual(public_file.read().strip(), public_key)
+        self.assertIsNotNone(sshkeys.key_fingerprint(public_key))
+
+    def test_take_without_stock_makes_a_key(self):
+        path, public_key = self.take('bob')
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(public_key.split()[-1].startswith('bob@'))
+        self.assertEqual(self.pool._threads, [])
+
+    def test_close_removes_untaken_keys(self):
+        self.pool.reserve(2)
+        wait_for(lambda: self.pool._stock.qsize() == 2)
+        directories = [entry[0] for entry in list(self.pool._stock.queue)]
+        self.pool.close(wait=True)
+        self.assertFalse(any(os.path.exists(directory) for directory in directories))
+        self.pool.reserve(1)
+        self.assertEqual(self.pool._wanted, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import keysource
+from support import public_key
+
+class KeyServer(http.server.BaseHTTPRequestHandler):
+    # /<account>.keys like GitHub, with an ETag; /moved/<account>.keys redirects there
+    protocol_version = 'HTTP/1.1'
+    keys = {'alice': public_key('alice', 1), 'bob': public_key('bob', 2)}
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        account = self.path.rsplit('/', 1)[-1].replace('.keys', '')
+        if self.path.startswith('/moved/'):
+            self.reply(301, b'', {'Location': f"/{account}.keys"})
+        elif account not in self.keys:
+            self.reply(404, b"Not Found\n")
+        elif self.headers.get('If-None-Match') == f'"{account}"':
+            self.reply(304, b'')
+        else:
+            self.reply(200, f"{self.keys[account]}\nnot a key\n".encode(), {'ETag': f'"{account}"'})
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class KeyFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeyServer)
+        self.server.requests = []
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.cache = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache.cleanup()
+
+    def fetcher(self, **options):
+        return keysource.KeyFetcher(cache_dir=self.cache.name, **options)
+
+    def test_fetch_keeps_only_key_lines(self):
+        self.assertEqual(self.fetcher().fetch(f"{self.url}/alice.keys"), ([KeyServer.keys['alice']], None))
+        self.assertEqual(self.fetcher().fetch(f"{self.url}/nobody.keys"), (None, "account not found"))
+
+    def test_fresh_cache_skips_the_server(self):
+        fetcher = self.fetcher()
+        fetcher.fetch(f"{self.url}/alice.keys")
+        self.assertEqual(fetcher.fetch(f"{self.url}/alice.keys"), ([KeyServer.keys['alice']], None))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_stale_cache_is_revalidated_by_etag(self):
+        fetcher = self.fetcher(ttl=0)
+        fetcher.fetch(f"{self.url}/alice.keys")
+        self.assertEqual(fetcher.fetch(f"{self.url}/alice.keys"), ([KeyServer.keys['alice']], None))
+        self.assertEqual(self.server.requests[-1], ('/alice.keys', '"alice"'))
+
+    def test_offline_uses_the_cache_only(self):
+        url = f"{self.url}/alice.keys"
+        self.assertEqual(self.fetcher(offline=True).fetch(url), (None, "offline and no cached keys"))
+        self.fetcher().fetch(url)
+        self.assertEqual(self.fetcher(offline=True, ttl=0).fetch(url), ([KeyServer.keys['alice']], None))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cached_keys_when_unreachable(self):
+        self.fetcher().fetch(f"{self.url}/alice.keys")
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self.fetcher(ttl=0).fetch(f"{self.url}/alice.keys"), ([KeyServer.keys['alice']], None))
+        self.assertIn("request failed", self.fetcher().fetch(f"{self.url}/bob.keys")[1])
+
+    def test_connection_is_reused(self):
+        fetcher = self.fetcher(ttl=0)
+        for account in ('alice', 'bob', 'alice', 'bob'):
+            fetcher.fetch(f"{self.url}/{account}.keys")
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirects_are_followed(self):
+        self.assertEqual(self.fetcher().fetch(f"{self.url}/moved/bob.keys"), ([KeyServer.keys['bob']], None))
+
+    def test_fetch_many(self):
+        urls = [f"{self.url}/{account}.keys" for account in ('alice', 'bob', 'carol', 'alice')]
+        results = self.fetcher(workers=3).fetch_many(urls)
+        self.assertEqual(sorted(results), sorted(set(urls)))
+        self.assertEqual(results[urls[1]], ([KeyServer.keys['bob']], None))
+        self.assertEqual(results[urls[2]], (None, "account not found"))
+
+if __name__ == '__main__':
+    unittest.main()
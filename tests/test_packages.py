@@ -0,0 +1,154 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BASE_DIR, os.path.join(BASE_DIR, 'Ubuntu')]
+
+import Packages
+from common import catalog, executor, target
+from support import make_deb
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class FakeApt:
+    # Stands in for run_with_progress: fails any transaction holding one of the broken
+    # packages, or every transaction with error when one is given
+    def __init__(self, broken=(), error=None):
+        self.broken = set(broken)
+        self.error = error
+        self.runs = []
+
+    def __call__(self, command, description):
+        packages = command[command.index('-y') + 1:]
+        self.runs.append(packages)
+        if self.error:
+            return False, self.error
+        unknown = [p for p in packages if p in self.broken]
+        if unknown:
+            return False, '\n'.join(f"E: Unable to locate package {p}" for p in unknown)
+        if any(p.startswith('conflicting') for p in packages):
+            return False, "E: Unable to correct problems, you have held broken packages."
+        return True, ''
+
+def install_batch(packages, fake_apt):
+    with mock.patch.object(Packages, 'run_with_progress', fake_apt), \
+         mock.patch.object(Packages, 'status_path', lambda: os.path.join(FIXTURES, 'status')):
+        return Packages.install_batch(packages)
+
+class InstallBatchTest(unittest.TestCase):
+    def test_one_transaction(self):
+        fake_apt = FakeApt()
+        self.assertEqual(install_batch(['a', 'b', 'c'], fake_apt), (['a', 'b', 'c'], []))
+        self.assertEqual(len(fake_apt.runs), 1)
+
+    def test_unknown_names_are_dropped_without_bisecting(self):
+        fake_apt = FakeApt(broken=['typo'])
+        success, failures = install_batch(['a', 'typo', 'b=1.0'], fake_apt)
+        self.assertEqual(success, ['a', 'b=1.0'])
+        self.assertEqual(failures, [('typo', "Package not found")])
+        self.assertEqual(len(fake_apt.runs), 2)
+
+    def test_bisects_to_the_failing_package(self):
+        fake_apt = FakeApt()
+        packages = ['a', 'b', 'conflicting', 'd']
+        success, failures = install_batch(packages, fake_apt)
+        self.assertEqual(success, ['a', 'b', 'd'])
+        self.assertEqual([p for p, _ in failures], ['conflicting'])
+
+    def test_batch_wide_failures_stop_at_once(self):
+        for error, reason in (
+                ("E: Could not get lock /var/lib/dpkg/lock-frontend. It is held by process 1234",
+                 "Package database is locked by another process"),
+                ("W: Failed to fetch http://archive.ubuntu.com/  Temporary failure resolving 'archive.ubuntu.com'",
+                 "Package archive unreachable"),
+                ("E: You don't have enough free space in /var/cache/apt/archives/.", "Not enough disk space")):
+            with self.subTest(reason=reason):
+                fake_apt = FakeApt(error=error)
+                packages = [f"pkg{idx}" for idx in range(8)]
+                self.assertEqual(install_batch(packages, fake_apt), ([], [(p, reason) for p in packages]))
+                self.assertEqual(len(fake_apt.runs), 1)
+
+class StatusProgressTest(unittest.TestCase):
+    def test_apt_status_lines(self):
+        self.assertEqual(Packages.status_progress("dlstatus:1:50.0:Retrieving file 1 of 2\n"), 15.0)
+        self.assertEqual(Packages.status_progress("pmstatus:jq:100:Installed jq\n"), 100.0)
+        self.assertIsNone(Packages.status_progress("Setting up jq (1.6-2.1ubuntu3) ...\n"))
+
+class ChooseCustomPackagesTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.TemporaryDirectory()
+        self.package_index = catalog.Catalog(
+            {'postfix': ['3.6.4-1', '1000', '4000', 'mail'], 'exim4-daemon-light': ['4.95-4', '600', '1500', 'mail'],
+             'jq': ['1.6-2.1', '50', '100', 'utils']},
+            {'default-mta': ['postfix'], 'mail-transport-agent': ['exim4-daemon-light', 'postfix']})
+
+    def tearDown(self):
+        self.work.cleanup()
+
+    def choose(self, text):
+        answers = iter([text, 'y'])
+        with mock.patch.object(Packages, 'package_catalog', lambda: self.package_index), \
+             mock.patch.object(Packages, 'status_path', lambda: os.path.join(FIXTURES, 'status')), \
+             mock.patch('builtins.input', lambda prompt: next(answers)), \
+             mock.patch('builtins.print'):
+            return Packages.choose_custom_packages()
+
+    def test_virtual_names_and_local_debs(self):
+        deb_file = os.path.join(self.work.name, 'tool_1.0_amd64.deb')
+        make_deb(deb_file, {'Package': 'tool', 'Version': '1.0', 'Architecture': 'amd64'})
+        local = os.path.relpath(deb_file)
+        if os.sep not in local:
+            local = os.path.join('.', local)
+        self.assertEqual(self.choose(f"jq default-mta {local} typo mail-transport-agent"),
+                         ['jq', 'default-mta', deb_file])
+
+    def test_unreadable_local_debs_are_left_out(self):
+        broken = os.path.join(self.work.name, 'broken.deb')
+        with open(broken, 'wb') as deb_file:
+            deb_file.write(b'not an archive')
+        self.assertEqual(self.choose(f"{broken} {os.path.join(self.work.name, 'gone.deb')} jq"), ['jq'])
+
+class TargetCachesTest(unittest.TestCase):
+    # Switching the target root (--root, resume) must not reuse another root's apt state
+    def setUp(self):
+        self.saved = target.ROOT, os.environ.get('SETUP_ROOT')
+        self.work = tempfile.TemporaryDirectory()
+        self.roots = {}
+        for name, status, never in (('web', 'status', '^linux-image-'), ('empty', None, '^app$')):
+            root = self.roots[name] = os.path.join(self.work.name, name)
+            os.makedirs(os.path.join(root, 'var/lib/dpkg'))
+            os.makedirs(os.path.join(root, 'var/lib/apt'))
+            if status:
+                shutil.copy(os.path.join(FIXTURES, 'status'), os.path.join(root, 'var/lib/dpkg/status'))
+            with open(os.path.join(root, 'apt-config'), 'w') as config_file:
+                config_file.write(f'APT::NeverAutoRemove:: "{never}";\n')
+
+    def tearDown(self):
+        target.ROOT = self.saved[0]
+        if self.saved[1] is None:
+            os.environ.pop('SETUP_ROOT', None)
+        else:
+            os.environ['SETUP_ROOT'] = self.saved[1]
+        self.work.cleanup()
+
+    def apt_config(self, command, **kwargs):
+        # apt-config dump, as configured in the tree named by Dir=
+        root = next(arg.split('=', 1)[1] for arg in command if arg.startswith('Dir='))
+        with open(os.path.join(root, 'apt-config')) as config_file:
+            return executor.CommandResult(command, 0, config_file.read(), '', 0.0)
+
+    def test_each_root_has_its_own_graph_and_settings(self):
+        with mock.patch.object(Packages.executor, 'run_sync', self.apt_config):
+            target.set_root(self.roots['web'])
+            self.assertIn('app', Packages.dependency_graph().packages)
+            self.assertEqual(Packages.autoremove_settings(target.ROOT)[2], ('^linux-image-',))
+            target.set_root(self.roots['empty'])
+            self.assertEqual(Packages.dependency_graph().packages, {})
+            self.assertEqual(Packages.autoremove_settings(target.ROOT)[2], ('^app$',))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import base64
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import sshkeys
+from support import public_key
+
+def key_line(seed, comment='', options=''):
+    line = public_key(comment, seed)
+    return f"{options} {line}" if options else line
+
+def merge(lines, add=(), remove=(), exclusive=False):
+    index = {}
+    for idx, line in enumerate(lines):
+        fp = sshkeys.key_fingerprint(line)
+        if fp and fp not in index:
+            index[fp] = idx
+    return sshkeys.merge_authorized_keys(lines, index, add, remove, exclusive)
+
+class MergeAuthorizedKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.alice = key_line(1, 'alice@laptop')
+        self.bob = key_line(2, 'bob@desktop', options='no-port-forwarding')
+        self.carol = key_line(3, 'carol@phone')
+        self.lines = ['# managed keys', self.alice, self.bob]
+
+    def test_add_new_key(self):
+        self.assertEqual(merge(self.lines, add=[self.carol]), self.lines + [self.carol])
+
+    def test_add_known_key_changes_nothing(self):
+        # Same key with another comment is the same key
+        self.assertEqual(merge(self.lines, add=[key_line(1, 'alice@elsewhere')]), self.lines)
+
+    def test_remove_by_line_or_fingerprint(self):
+        self.assertEqual(merge(self.lines, remove=[self.alice]), ['# managed keys', self.bob])
+        fingerprint = sshkeys.key_fingerprint(self.bob)
+        self.assertEqual(merge(self.lines, remove=[fingerprint]), ['# managed keys', self.alice])
+
+    def test_exclusive_keeps_only_added_keys(self):
+        self.assertEqual(merge(self.lines, add=[self.bob, self.carol], exclusive=True),
+                         ['# managed keys', self.bob, self.carol])
+
+    def test_duplicates_collapse(self):
+        self.assertEqual(merge(self.lines + [key_line(1, 'again')]), self.lines)
+
+    def test_invalid_lines_are_not_keys(self):
+        self.assertIsNone(sshkeys.key_fingerprint('ssh-ed25519 not-base64!'))
+        # A blob that claims another key type
+        blob = base64.b64encode(struct.pack('>I', 7) + b'ssh-rsa' + b'\0' * 8).decode()
+        self.assertIsNone(sshkeys.key_fingerprint(f"ssh-ed25519 {blob}"))
+
+class KeyFileLinksTest(unittest.TestCase):
+    # As root these files are edited in a directory the account controls
+    def setUp(self):
+        self.work = tempfile.TemporaryDirectory()
+        self.secret = os.path.join(self.work.name, 'secret')
+        with open(self.secret, 'w') as secret_file:
+            secret_file.write("root:hash:19000::::::\n")
+        self.path = os.path.join(self.work.name, 'authorized_keys')
+
+    def tearDown(self):
+        self.work.cleanup()
+
+    def test_links_are_not_read(self):
+        os.symlink(self.secret, self.path)
+        with self.assertRaises(OSError):
+            sshkeys.read_authorized_keys(self.path)
+        os.unlink(self.path)
+        os.link(self.secret, self.path)
+        with self.assertRaises(OSError):
+            sshkeys.update_authorized_keys(self.path, add=[public_key('new', 4)])
+
+    def test_links_are_replaced_not_followed(self):
+        os.symlink(self.secret, self.path)
+        sshkeys.write_authorized_keys(self.path, [public_key('new', 4)])
+        self.assertFalse(os.path.islink(self.path))
+        with open(self.secret) as secret_file:
+            self.assertEqual(secret_file.read(), "root:hash:19000::::::\n")
+
+if __name__ == '__main__':
+    unittest.main()
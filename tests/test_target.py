@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BASE_DIR, os.path.join(BASE_DIR, 'Ubuntu')]
+
+from common import accounts, dpkg, target
+import Packages
+import User
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class RootTreeTest(unittest.TestCase):
+    # Everything acts on an offline root filesystem once --root points at one
+    def setUp(self):
+        self.saved = target.ROOT, os.environ.get('SETUP_ROOT')
+        self.work = tempfile.TemporaryDirectory()
+        self.root = self.work.name
+        for directory in ('etc', 'var/lib/dpkg'):
+            os.makedirs(os.path.join(self.root, directory))
+        with open(os.path.join(self.root, 'etc/passwd'), 'w') as passwd_file:
+            passwd_file.write("root:x:0:0:root:/root:/bin/bash\nalice:x:1001:1001:Alice:/srv/alice:/bin/bash\n")
+        with open(os.path.join(self.root, 'etc/group'), 'w') as group_file:
+            group_file.write("root:x:0:\nsudo:x:27:alice\nalice:x:1001:\n")
+        shutil.copy(os.path.join(FIXTURES, 'status'), os.path.join(self.root, 'var/lib/dpkg/status'))
+        target.set_root(self.root)
+
+    def tearDown(self):
+        target.ROOT = self.saved[0]
+        if self.saved[1] is None:
+            os.environ.pop('SETUP_ROOT', None)
+        else:
+            os.environ['SETUP_ROOT'] = self.saved[1]
+        self.work.cleanup()
+
+    def test_paths_resolve_into_the_tree(self):
+        self.assertFalse(target.is_host())
+        self.assertEqual(target.path('/etc/passwd'), os.path.join(self.root, 'etc/passwd'))
+        self.assertEqual(Packages.status_path(), os.path.join(self.root, 'var/lib/dpkg/status'))
+        self.assertEqual(os.environ['SETUP_ROOT'], self.root)
+        self.assertNotEqual(target.scope('users'), 'users')
+
+    def test_apt_installs_into_the_tree(self):
+        command = Packages.apt_command('install', '-y', 'jq')
+        for option in (f"Dir={self.root}", f"Dir::State::status={self.root}/var/lib/dpkg/status",
+                       f"DPkg::Options::=--root={self.root}"):
+            self.assertEqual(command[command.index(option) - 1], '-o')
+        self.assertEqual(command[-3:], ['install', '-y', 'jq'])
+
+    def test_account_tools_edit_the_tree(self):
+        self.assertEqual(User.account_command(['sudo', 'useradd', '-m', 'bob']),
+                         ['sudo', 'useradd', '--root', self.root, '-m', 'bob'])
+        self.assertEqual(User.account_command(['usermod', '-aG', 'sudo', 'bob']),
+                         ['usermod', '--root', self.root, '-aG', 'sudo', 'bob'])
+        # Not an account tool
+        self.assertEqual(User.account_command(['sudo', 'chown', 'bob', '/x']), ['sudo', 'chown', 'bob', '/x'])
+
+    def test_accounts_and_packages_come_from_the_tree(self):
+        self.assertTrue(User.user_exists('alice'))
+        self.assertEqual(accounts.home_of('alice', target.ROOT), '/srv/alice')
+        self.assertTrue(accounts.in_group('alice', 'sudo', target.ROOT))
+        self.assertTrue(dpkg.is_installed('app', Packages.status_path()))
+
+    def test_host(self):
+        target.set_root('/')
+        self.assertTrue(target.is_host())
+        self.assertEqual(target.path('/etc/passwd'), '/etc/passwd')
+        self.assertEqual(target.apt_options(), [])
+        self.assertEqual(target.account_command(['useradd', 'bob']), ['useradd', 'bob'])
+
+if __name__ == '__main__':
+    unittest.main()